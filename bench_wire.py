@@ -0,0 +1,78 @@
+"""
+Compare encoding and decoding throughput of PyON and the binary wire
+format for a full-chain reply. Usage: python bench_wire.py [blocks]
+"""
+
+import ast
+import sys
+import time
+from uuid import uuid4 as uuid
+
+import wire
+
+
+def make_chain(length, transactions_per_block=2):
+    address = b"a" * 64
+    blocks = []
+    previous_id, previous_hash = 0, 0
+    for _ in range(length):
+        transactions = tuple(
+            {
+                "inputs": (str(uuid()),),
+                "outputs": [(str(uuid()), 10, address), (str(uuid()), 5, address)],
+                "from": address,
+                "signature": bytes(64),
+            }
+            for _ in range(transactions_per_block)
+        )
+        block = {
+            "version": 1,
+            "id": str(uuid()),
+            "transactions": transactions,
+            "mine": (str(uuid()), 1000, address),
+            "timestamp": int(time.time()),
+            "previous_block": previous_id,
+            "previous_block_hash": previous_hash,
+            "nonce": 12345,
+            "hash": (1 << 500) + len(blocks),
+        }
+        blocks.append(block)
+        previous_id, previous_hash = block["id"], block["hash"]
+    return blocks
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def compare(message):
+    """Time both formats on one message; return a dict of results."""
+    results = {}
+    formats = {
+        "pyon": (lambda m: repr(m), ast.literal_eval),
+        "wire": (wire.encode, wire.decode),
+    }
+    for name, (encode, decode) in formats.items():
+        data, encode_time = timed(encode, message)
+        decoded, decode_time = timed(decode, data)
+        assert decoded == message
+        results[name] = {
+            "bytes": len(data),
+            "encode_seconds": encode_time,
+            "decode_seconds": decode_time,
+        }
+    return results
+
+
+if __name__ == "__main__":
+    length = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    results = compare({"blocks": make_chain(length)})
+    for name, result in results.items():
+        mb = result["bytes"] / 1e6
+        print(
+            f"{name}: {mb:.1f} MB, "
+            f"encode {mb / result['encode_seconds']:.1f} MB/s, "
+            f"decode {mb / result['decode_seconds']:.1f} MB/s"
+        )
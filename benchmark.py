@@ -0,0 +1,366 @@
+"""
+Benchmarks for the node's hot paths, run on synthetic chains and mempools
+so they need no network. Results are saved as JSON, so runs on two commits
+can be compared.
+
+Usage: python benchmark.py [--blocks N] [--transactions N] [--forks N]
+    [--repeat N] [--seed N] [--output FILE] [--compare FILE]
+"""
+
+import contextlib
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import bench_wire
+import codec
+import miner
+from gossip import argument
+from hashing import cryptographic_hash, LEGACY_VERSION, MERKLE_VERSION
+from merkle import transactions_root
+from records import freeze_block
+from signing import generate_keypair, sign_transaction, signature_cache
+
+DEFAULTS = {
+    # Length of synthetic chains, and transactions in each of their blocks.
+    "blocks": 1000,
+    "block_transactions": 10,
+    # Transactions in the one large block used for hashing and validation.
+    "transactions": 1000,
+    "forks": 50,
+    "repeat": 3,
+    "seed": 0,
+    # Throughput benchmarks run for at least this long each time.
+    "seconds": 0.2,
+}
+
+ADDRESS = b"a" * 64
+
+
+async def send_nowhere(data, fallback=None):
+    pass
+
+
+async def request_nowhere(request, callback):
+    pass
+
+
+@contextlib.contextmanager
+def quiet():
+    """Throw away the node's logging while it's being timed."""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def random_id(rng):
+    return f"{rng.getrandbits(128):032x}"
+
+
+def best_of(repeat, run, setup=lambda: None):
+    """The fastest of several runs, in seconds, each after an untimed setup."""
+    best = float("inf")
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def rate(repeat, seconds, fn):
+    """The best number of calls to fn per second, over several timed runs."""
+    best = 0.0
+    for _ in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        elapsed = 0.0
+        while elapsed < seconds:
+            fn(calls)
+            calls += 1
+            elapsed = time.perf_counter() - start
+        best = max(best, calls / elapsed)
+    return best
+
+
+def make_node():
+    with quiet():
+        return miner.Miner(send_nowhere, request_nowhere)
+
+
+def make_transaction(rng, inputs):
+    return {
+        "inputs": tuple(inputs),
+        "outputs": [(random_id(rng), 5, ADDRESS), (random_id(rng), 5, ADDRESS)],
+        "from": ADDRESS,
+        "signature": bytes(64),
+    }
+
+
+def make_block(rng, transactions, version, previous_block=0):
+    block = {
+        "version": version,
+        "id": random_id(rng),
+        "transactions": tuple(transactions),
+        "mine": (random_id(rng), 1000, ADDRESS),
+        "timestamp": 0,
+        "previous_block": previous_block,
+        "previous_block_hash": 0,
+        "nonce": 0,
+    }
+    if version >= MERKLE_VERSION:
+        block["merkle_root"] = transactions_root(transactions)
+    elif version == LEGACY_VERSION:
+        del block["version"]
+    return block
+
+
+def make_chain(rng, length, transactions_per_block):
+    """A chain whose transactions spend outputs from earlier blocks."""
+    blocks = []
+    unspent = []
+    previous_block = 0
+    for _ in range(length):
+        transactions = []
+        for _ in range(min(transactions_per_block, len(unspent))):
+            # Spend a random output, swapping the last into its place.
+            index = rng.randrange(len(unspent))
+            unspent[index], unspent[-1] = unspent[-1], unspent[index]
+            transactions.append(make_transaction(rng, [unspent.pop()]))
+        block = make_block(rng, transactions, MERKLE_VERSION, previous_block)
+        unspent.append(block["mine"][0])
+        unspent.extend(o[0] for t in transactions for o in t["outputs"])
+        blocks.append(block)
+        previous_block = block["id"]
+    return blocks
+
+
+def bench_hashing(rng, params):
+    """Hashes per second of one large block, by block version."""
+    transactions = [
+        make_transaction(rng, [random_id(rng)]) for _ in range(params["transactions"])
+    ]
+    results = {}
+    for version in (LEGACY_VERSION, 1, MERKLE_VERSION):
+        block = make_block(rng, transactions, version)
+
+        def hash_block(nonce):
+            block["nonce"] = nonce
+            cryptographic_hash(block)
+
+        hashes = rate(params["repeat"], params["seconds"], hash_block)
+        results[f"version_{version}"] = {"hashes_per_second": hashes}
+    return results
+
+
+def bench_validation(rng, params):
+    """Checking a large block's signatures and inputs, with and without cache."""
+    node = make_node()
+    key, address = generate_keypair(seed=rng.randbytes(32))
+    transactions = []
+    for _ in range(params["transactions"]):
+        coin = (random_id(rng), 10, address)
+        node.unspent_transactions.add(coin)
+        transaction = {
+            "inputs": (coin[0],),
+            "outputs": [(random_id(rng), 9, address)],
+            "from": address,
+        }
+        transactions.append(sign_transaction(transaction, key))
+
+    def validate(_):
+        assert node.validate_transactions(transactions)
+
+    results = {}
+    cold = best_of(params["repeat"], validate, setup=signature_cache.clear)
+    warm = best_of(params["repeat"], validate)
+    for name, seconds in (("cold", cold), ("warm", warm)):
+        results[name] = {
+            "seconds": seconds,
+            "transactions_per_second": len(transactions) / seconds,
+        }
+    return results
+
+
+def bench_replay(rng, params):
+    """Replaying a chain into a fresh UTXO set, block by block."""
+    chain = make_chain(rng, params["blocks"], params["block_transactions"])
+    transactions = sum(len(block["transactions"]) for block in chain)
+
+    def setup():
+        node = make_node()
+        node.blocks = chain
+        return node
+
+    def replay(node):
+        for block in node.blocks:
+            node.update_unspent_transactions_with_block(block)
+
+    seconds = best_of(params["repeat"], replay, setup)
+    return {
+        "seconds": seconds,
+        "blocks_per_second": len(chain) / seconds,
+        "transactions_per_second": transactions / seconds,
+    }
+
+
+def bench_forks(rng, params):
+    """
+    Competing forks off the end of a chain, each branching from whichever
+    was longest when it was made, handed to resolve_block_conflict with
+    their blocks shuffled.
+    """
+    main = list(miner.add_hashes_to(make_chain(rng, params["blocks"], 0)))
+    longest = [block["id"] for block in main]
+    fork_blocks = []
+    for _ in range(params["forks"]):
+        height = len(longest)
+        fork_height = height - rng.randrange(1, min(20, height))
+        length = max(height - fork_height + rng.randrange(-2, 3), 1)
+        branch = []
+        previous_block = longest[fork_height - 1]
+        for _ in range(length):
+            block = make_block(rng, (), MERKLE_VERSION, previous_block)
+            branch.append(block["id"])
+            fork_blocks.append(block)
+            previous_block = block["id"]
+        if fork_height + length > height:
+            longest = longest[:fork_height] + branch
+    rng.shuffle(fork_blocks)
+
+    def setup():
+        node = make_node()
+        node.blocks = main
+        node.rebuild_unspent_transactions()
+        return node
+
+    def resolve(node):
+        with quiet():
+            for block in fork_blocks:
+                node.resolve_block_conflict(block)
+
+    reorgs_before = miner.reorgs.value()
+    seconds = best_of(params["repeat"], resolve, setup)
+    return {
+        "seconds": seconds,
+        "blocks_per_second": len(fork_blocks) / seconds,
+        "reorgs_per_run": (miner.reorgs.value() - reorgs_before) / params["repeat"],
+    }
+
+
+def bench_encoding(rng, params):
+    """PyON and the binary wire format, on a full-chain reply."""
+    chain = make_chain(rng, params["blocks"], params["block_transactions"])
+    # Plain dicts, as a reply arrives off the wire, rather than records.
+    blocks = codec.decode(codec.encode(list(miner.add_hashes_to(chain))))
+    return bench_wire.compare({"blocks": blocks})
+
+
+def allocated(build):
+    """Bytes still allocated once a value has been built, while it's alive."""
+    gc.collect()
+    tracemalloc.start()
+    value = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size
+
+
+def bench_memory(rng, params):
+    """Memory held per block of a chain, as plain dicts and as records."""
+    chain = make_chain(rng, params["blocks"], params["block_transactions"])
+    data = codec.encode(list(miner.add_hashes_to(chain)))
+    dicts = allocated(lambda: codec.decode(data))
+    frozen = allocated(lambda: [freeze_block(b) for b in codec.decode(data)])
+    return {
+        "dicts": {"bytes_per_block": dicts / len(chain)},
+        "records": {"bytes_per_block": frozen / len(chain)},
+    }
+
+
+BENCHMARKS = {
+    "hashing": bench_hashing,
+    "validation": bench_validation,
+    "utxo_replay": bench_replay,
+    "fork_resolution": bench_forks,
+    "encoding": bench_encoding,
+    "memory": bench_memory,
+}
+
+
+def git_commit():
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.strip()
+
+
+def run(params):
+    """Run every benchmark, each with its own seeded random numbers."""
+    results = {}
+    for name, bench in BENCHMARKS.items():
+        rng = random.Random(f"{params['seed']}:{name}")
+        results[name] = bench(rng, params)
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "params": params,
+        "results": results,
+    }
+
+
+def flatten(results, prefix=""):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        else:
+            yield f"{prefix}{key}", value
+
+
+def compare(old, new):
+    """Print each result next to an older run's, and how much faster it got."""
+    old_results = dict(flatten(old["results"]))
+    for name, value in flatten(new["results"]):
+        before = old_results.get(name)
+        if not before or not value:
+            continue
+        if name.endswith("per_second"):
+            speedup = value / before
+        elif name.endswith("seconds") or name.endswith("bytes_per_block"):
+            speedup = before / value
+        else:
+            continue
+        print(f"{name}: {before:.4g} -> {value:.4g} ({speedup:.2f}x)")
+
+
+def parse_params():
+    params = dict(DEFAULTS)
+    for name, default in DEFAULTS.items():
+        value = argument("--" + name.replace("_", "-"))
+        if value is not None:
+            params[name] = type(default)(value)
+    return params
+
+
+if __name__ == "__main__":
+    report = run(parse_params())
+    output = argument("--output")
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    baseline = argument("--compare")
+    if baseline:
+        with open(baseline) as f:
+            compare(json.load(f), report)
@@ -0,0 +1,240 @@
+"""
+An append-only block log on disk, with a separate fixed-width index.
+
+blocks.dat holds each block's codec encoding, one after another. index.dat
+holds one record per block in the current chain, in height order: where
+its encoding sits in the log, its ID and its hash. Reopening a store only
+reads the index; blocks are decoded from an mmap of the log when asked for.
+A StoredBlock stands in for a block that's only decoded when some field
+besides its ID, parent or hash is needed.
+
+The snapshots directory holds copies of the unspent outputs as they stood
+at a given height, so a restart only has to replay the blocks since then.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import codec
+
+# offset, length, block ID (utf-8, NUL padded) and the 512-bit block hash.
+INDEX = struct.Struct(">QI64s64s")
+
+# How many UTXO snapshots to keep around.
+KEEP_SNAPSHOTS = 3
+
+# How many lazily read blocks to keep decoded.
+RECENT_BLOCKS = 64
+
+
+class StoredBlock(Mapping):
+    """
+    A block in the log, which knows its ID, parent and hash from the index
+    and reads anything else from disk. It points at the block's bytes in
+    the log, which are never overwritten, so it stays valid after the
+    store's chain is truncated.
+    """
+
+    __slots__ = ("store", "offset", "length", "id", "previous_block", "hash")
+
+    INDEXED = ("id", "previous_block", "hash")
+
+    def __init__(self, store, offset, length, block_id, previous_block, block_hash):
+        self.store = store
+        self.offset = offset
+        self.length = length
+        self.id = block_id
+        self.previous_block = previous_block
+        self.hash = block_hash
+
+    def block(self):
+        return self.store.read(self.offset, self.length)
+
+    def __getitem__(self, key):
+        if key in self.INDEXED:
+            return getattr(self, key)
+        return self.block()[key]
+
+    def __iter__(self):
+        return iter(self.block())
+
+    def __len__(self):
+        return len(self.block())
+
+    def __repr__(self):
+        return repr(self.block())
+
+
+class BlockStore:
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._log = open(os.path.join(directory, "blocks.dat"), "a+b")
+        self._index = open(os.path.join(directory, "index.dat"), "a+b")
+        self._map = None
+        self._entries = []
+        self._heights = {}
+        self._recent = OrderedDict()
+        self._load_index()
+
+    def _load_index(self):
+        self._index.seek(0)
+        data = self._index.read()
+        log_size = os.fstat(self._log.fileno()).st_size
+
+        for start in range(0, len(data) - INDEX.size + 1, INDEX.size):
+            offset, length, block_id, block_hash = INDEX.unpack_from(data, start)
+            if offset + length > log_size:
+                # The block itself never made it to disk.
+                break
+            self._add_entry(offset, length, block_id, block_hash)
+
+        # Drop any torn or dangling index records.
+        self._truncate_index(len(self._entries))
+
+    def _add_entry(self, offset, length, block_id, block_hash):
+        block_id = block_id.rstrip(b"\0").decode("utf-8")
+        self._heights[block_id] = len(self._entries)
+        self._entries.append((offset, length, block_id, block_hash))
+
+    def _truncate_index(self, length):
+        self._index.truncate(length * INDEX.size)
+        self._index.flush()
+
+    def _view(self, end):
+        """An mmap of the log which covers at least `end` bytes."""
+        if self._map is None or len(self._map) < end:
+            self._log.flush()
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._log.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, height):
+        offset, length, _, _ = self._entries[height]
+        view = self._view(offset + length)
+        return codec.decode(view[offset : offset + length])
+
+    def read(self, offset, length):
+        """Decode the block at a place in the log, remembering the last few."""
+        key = offset, length
+        block = self._recent.get(key)
+        if block is None:
+            view = self._view(offset + length)
+            block = self._recent[key] = codec.decode(view[offset : offset + length])
+            if len(self._recent) > RECENT_BLOCKS:
+                self._recent.popitem(last=False)
+        self._recent.move_to_end(key)
+        return block
+
+    def stored_block(self, height):
+        """The block at a height, decoded only when it's needed."""
+        offset, length, block_id, block_hash = self._entries[height]
+        previous_block = self._entries[height - 1][2] if height else 0
+        return StoredBlock(
+            self,
+            offset,
+            length,
+            block_id,
+            previous_block,
+            int.from_bytes(block_hash, "big"),
+        )
+
+    def __iter__(self):
+        for height in range(len(self)):
+            yield self[height]
+
+    def index_of(self, block_id):
+        """The position of a block in the stored chain, or None."""
+        return self._heights.get(str(block_id))
+
+    def block_hash(self, height):
+        return int.from_bytes(self._entries[height][3], "big")
+
+    def append(self, block):
+        """Write a block, which must already have its "hash", to the chain tip."""
+        data = codec.encode(block)
+        block_id = str(block["id"]).encode("utf-8")
+        if len(block_id) > 64:
+            raise ValueError(f"Block ID too long to index: {block['id']!r}")
+
+        self._log.seek(0, os.SEEK_END)
+        offset = self._log.tell()
+        self._log.write(data)
+        self._log.flush()
+
+        block_hash = block["hash"].to_bytes(64, "big")
+        self._index.write(INDEX.pack(offset, len(data), block_id, block_hash))
+        self._index.flush()
+        self._add_entry(offset, len(data), block_id, block_hash)
+
+    def truncate(self, length):
+        """
+        Cut the chain back to its first `length` blocks. The abandoned blocks
+        stay in the log; only the index forgets them.
+        """
+        for _, _, block_id, _ in self._entries[length:]:
+            del self._heights[block_id]
+        del self._entries[length:]
+        self._truncate_index(length)
+
+    @property
+    def snapshot_directory(self):
+        return os.path.join(self.directory, "snapshots")
+
+    def snapshot_paths(self):
+        """Snapshot files, newest first."""
+        try:
+            names = os.listdir(self.snapshot_directory)
+        except FileNotFoundError:
+            return []
+        names = sorted((n for n in names if n.startswith("utxo-")), reverse=True)
+        return [os.path.join(self.snapshot_directory, name) for name in names]
+
+    def save_snapshot(self, snapshot):
+        """
+        Save a snapshot dict of "height", "block_hash" and "outputs", then
+        delete all but the newest few.
+        """
+        os.makedirs(self.snapshot_directory, exist_ok=True)
+        data = codec.encode(snapshot)
+        name = f"utxo-{snapshot['height']:012d}.dat"
+        path = os.path.join(self.snapshot_directory, name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(hashlib.sha256(data).digest())
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+        for old_path in self.snapshot_paths()[KEEP_SNAPSHOTS:]:
+            os.remove(old_path)
+
+    def load_snapshot(self):
+        """
+        Return the newest snapshot which is intact and belongs to the
+        stored chain, or None if there isn't one.
+        """
+        for path in self.snapshot_paths():
+            with open(path, "rb") as f:
+                checksum, data = f.read(32), f.read()
+            if hashlib.sha256(data).digest() != checksum:
+                continue
+            snapshot = codec.decode(data)
+            height = snapshot["height"]
+            if 0 < height <= len(self) and (
+                self.block_hash(height - 1) == snapshot["block_hash"]
+            ):
+                return snapshot
+        return None
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._log.close()
+        self._index.close()
@@ -0,0 +1,171 @@
+"""
+An index of every block we know about: the main chain, any side branches
+off it, and orphan blocks whose parents haven't arrived yet.
+
+Every block has the same difficulty, so a node's height is also the
+cumulative work of the branch ending at it.
+"""
+
+from collections import OrderedDict
+
+# Side branches whose tips are this far behind the main chain are dropped,
+# so no reorganisation can ever be deeper than this.
+PRUNE_DEPTH = 100
+
+# Keep at most this many blocks whose parents we haven't seen yet.
+MAX_ORPHANS = 1000
+
+
+class TreeNode:
+    __slots__ = ("block", "parent", "height")
+
+    def __init__(self, block, parent, height):
+        self.block = block
+        self.parent = parent
+        self.height = height
+
+    @property
+    def id(self):
+        return self.block["id"]
+
+
+class BlockTree:
+    def __init__(self):
+        self.reset([])
+
+    def reset(self, main):
+        """Index a main chain from scratch, forgetting everything else."""
+        self.main = main
+        self.nodes = {}
+        self.children = {}
+        self.side = set()
+        self.orphans = OrderedDict()
+        self.waiting = {}
+        for block in main:
+            self._add_node(block, len(self.nodes) + 1)
+
+    def _add_node(self, block, height):
+        node = TreeNode(block, block["previous_block"], height)
+        self.nodes[node.id] = node
+        self.children.setdefault(node.parent, set()).add(node.id)
+        return node
+
+    def _remove_node(self, block_id):
+        node = self.nodes.pop(block_id)
+        self.side.discard(block_id)
+        siblings = self.children.get(node.parent)
+        if siblings is not None:
+            siblings.discard(block_id)
+            if not siblings:
+                del self.children[node.parent]
+
+    def on_main(self, node):
+        main = self.main
+        return node.height <= len(main) and main[node.height - 1]["id"] == node.id
+
+    def height_of(self, block_id):
+        """The main-chain height of a block, or None if it's not on it."""
+        node = self.nodes.get(block_id)
+        if node is None or not self.on_main(node):
+            return None
+        return node.height
+
+    def extend_main(self, block):
+        """Record a block which has just been added to the main chain's tip."""
+        self.side.discard(block["id"])
+        self._add_node(block, len(self.main))
+        if len(self.main) % PRUNE_DEPTH == 0:
+            self.prune()
+
+    def add(self, block):
+        """
+        Add a block off the main chain. Return the tip of the best branch it
+        completed if that branch is now longer than the main chain.
+        """
+        block_id = block["id"]
+        if block_id in self.nodes or block_id in self.orphans:
+            return None
+        if block["previous_block"] not in self.nodes:
+            self._add_orphan(block)
+            return None
+
+        best = max(self._attach(block), key=lambda node: node.height)
+        if best.height > len(self.main):
+            return best
+        return None
+
+    def _add_orphan(self, block):
+        self.orphans[block["id"]] = block
+        self.waiting.setdefault(block["previous_block"], []).append(block["id"])
+        while len(self.orphans) > MAX_ORPHANS:
+            _, oldest = self.orphans.popitem(last=False)
+            self.waiting[oldest["previous_block"]].remove(oldest["id"])
+            if not self.waiting[oldest["previous_block"]]:
+                del self.waiting[oldest["previous_block"]]
+
+    def _attach(self, block):
+        """Attach a block and then any orphans which were waiting on it."""
+        attached = []
+        pending = [block]
+        while pending:
+            block = pending.pop()
+            parent = self.nodes[block["previous_block"]]
+            node = self._add_node(block, parent.height + 1)
+            self.side.add(node.id)
+            attached.append(node)
+            for orphan_id in self.waiting.pop(node.id, ()):
+                pending.append(self.orphans.pop(orphan_id))
+        return attached
+
+    def discard(self, block_id):
+        """Forget a side-branch block, and every block built on top of it."""
+        pending = [block_id]
+        while pending:
+            block_id = pending.pop()
+            pending.extend(self.children.pop(block_id, ()))
+            if block_id in self.nodes:
+                self._remove_node(block_id)
+
+    def branch(self, tip):
+        """
+        Walk back from a side-branch tip to the main chain. Return the height
+        of the block it forks from and the branch's blocks in order, or None
+        if the fork is deeper than we're prepared to go.
+        """
+        path = []
+        node = tip
+        while not self.on_main(node):
+            if len(path) > PRUNE_DEPTH:
+                return None
+            path.append(node.block)
+            node = self.nodes.get(node.parent)
+            if node is None:
+                return None
+        path.reverse()
+        return node.height, path
+
+    def switched(self, abandoned, adopted):
+        """
+        Record that the main chain swapped the abandoned blocks for the
+        adopted ones, then prune any branches that can no longer win.
+        """
+        for block in abandoned:
+            self.side.add(block["id"])
+        for block in adopted:
+            self.side.discard(block["id"])
+            self.nodes[block["id"]].block = block
+        self.prune()
+
+    def prune(self):
+        """Drop side branches whose tips are too far behind to matter."""
+        cutoff = len(self.main) - PRUNE_DEPTH
+        nodes = sorted(
+            (self.nodes[i] for i in self.side),
+            key=lambda node: node.height,
+            reverse=True,
+        )
+        for node in nodes:
+            if node.height >= cutoff:
+                continue
+            if not self.children.get(node.id):
+                self._remove_node(node.id)
@@ -0,0 +1,168 @@
+"""
+A small canonical binary encoding for the Python values we pass around:
+None, bools, ints of any size, str, bytes, tuples, lists and dicts.
+
+Every value is a one-byte tag followed by its payload. Dict entries are
+sorted by their encoded key, so equal values always encode to equal bytes.
+"""
+
+import struct
+from collections.abc import Mapping
+
+LENGTH = struct.Struct(">I")
+
+NONE = b"N"
+TRUE = b"T"
+FALSE = b"F"
+INT = b"i"
+STR = b"s"
+BYTES = b"b"
+TUPLE = b"t"
+LIST = b"l"
+DICT = b"d"
+
+
+def _encode_sized(tag, data, out):
+    out += tag
+    out += LENGTH.pack(len(data))
+    out += data
+
+
+def _encode_int(value, out):
+    length = (value.bit_length() + 8) // 8
+    _encode_sized(INT, value.to_bytes(length, "big", signed=True), out)
+
+
+def _encode_items(tag, items, out):
+    out += tag
+    out += LENGTH.pack(len(items))
+    for item in items:
+        _encode_into(item, out)
+
+
+def _str_key_order(item):
+    # Same order as sorting encoded str keys: by byte length, then bytes.
+    key = item[0].encode("utf-8")
+    return len(key), key
+
+
+def _encode_dict(value, out):
+    out += DICT
+    out += LENGTH.pack(len(value))
+    if all(type(key) is str for key in value):
+        for key, item in sorted(value.items(), key=_str_key_order):
+            _encode_into(key, out)
+            _encode_into(item, out)
+        return
+    for key, item in sorted((encode(k), encode(v)) for k, v in value.items()):
+        out += key
+        out += item
+
+
+def _encode_constant(value, out):
+    out += NONE if value is None else TRUE if value else FALSE
+
+
+def _encode_str(value, out):
+    _encode_sized(STR, value.encode("utf-8"), out)
+
+
+def _encode_bytes(value, out):
+    _encode_sized(BYTES, bytes(value), out)
+
+
+def _encode_tuple(value, out):
+    _encode_items(TUPLE, value, out)
+
+
+def _encode_list(value, out):
+    _encode_items(LIST, value, out)
+
+
+ENCODERS = {
+    type(None): _encode_constant,
+    bool: _encode_constant,
+    int: _encode_int,
+    str: _encode_str,
+    bytes: _encode_bytes,
+    bytearray: _encode_bytes,
+    tuple: _encode_tuple,
+    list: _encode_list,
+    dict: _encode_dict,
+}
+
+
+def _encode_into(value, out):
+    encoder = ENCODERS.get(type(value))
+    if encoder is None:
+        encoder = ENCODERS[type(value)] = _encoder_for(value)
+    encoder(value, out)
+
+
+def _encoder_for(value):
+    """
+    Subclasses, like namedtuples, encode as their base type, and other
+    mappings, like records, encode as dicts. Bools are checked before
+    ints, since bool is a subclass of int.
+    """
+    for base in (bool, int, str, bytes, tuple, list, dict):
+        if isinstance(value, base):
+            return ENCODERS[base]
+    if isinstance(value, Mapping):
+        return _encode_dict
+    raise TypeError(f"Can't encode {type(value).__name__}: {value!r}")
+
+
+def encode(value):
+    """Encode a value to its canonical bytes."""
+    out = bytearray()
+    _encode_into(value, out)
+    return bytes(out)
+
+
+def _decode_from(data, offset):
+    """Decode one value starting at offset; return it with the next offset."""
+    tag = data[offset : offset + 1]
+    offset += 1
+    if tag == NONE:
+        return None, offset
+    if tag == TRUE:
+        return True, offset
+    if tag == FALSE:
+        return False, offset
+
+    (length,) = LENGTH.unpack_from(data, offset)
+    offset += LENGTH.size
+
+    if tag in (INT, STR, BYTES):
+        payload = bytes(data[offset : offset + length])
+        offset += length
+        if tag == INT:
+            return int.from_bytes(payload, "big", signed=True), offset
+        if tag == STR:
+            return payload.decode("utf-8"), offset
+        return payload, offset
+
+    if tag == DICT:
+        result = {}
+        for _ in range(length):
+            key, offset = _decode_from(data, offset)
+            result[key], offset = _decode_from(data, offset)
+        return result, offset
+
+    if tag in (TUPLE, LIST):
+        items = []
+        for _ in range(length):
+            item, offset = _decode_from(data, offset)
+            items.append(item)
+        return (tuple(items) if tag == TUPLE else items), offset
+
+    raise ValueError(f"Unknown tag {tag!r} at offset {offset - 1}")
+
+
+def decode(data):
+    """Decode bytes produced by `encode` back into a value."""
+    value, offset = _decode_from(memoryview(data), 0)
+    if offset != len(data):
+        raise ValueError("Trailing bytes after encoded value")
+    return value
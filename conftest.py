@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+import miner
+from mining import SerialBackend
+
+
+async def send_nowhere(data, fallback=None):
+    pass
+
+
+@pytest.fixture
+def event_loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def make_miner(event_loop):
+    """Make quick-mining nodes, each syncing from a peer if given one."""
+
+    def make_miner(peer=None):
+        async def request_from_peer(request, callback):
+            callback(peer.consume_message(request))
+
+        node = miner.Miner(send_nowhere, request_from_peer)
+        node._difficulty = 4
+        node.mining_backend = SerialBackend(batch_size=64)
+        return node
+
+    return make_miner
+
+
+@pytest.fixture
+def mine_chain():
+    def mine_chain(node, length):
+        for _ in range(length):
+            node.mine_one_block()
+
+    return mine_chain
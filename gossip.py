@@ -1,17 +1,45 @@
 import ast
 import asyncio
+import hashlib
 import random
 import sys
 import time
+from collections import OrderedDict
 
 import websockets
+from websockets.exceptions import ConnectionClosed, InvalidHandshake
 
+import codec
+import metrics
+import wire
 from private_api import Api
 
 HOST = "0.0.0.0"
 PORT = 1234 if "--gen" in sys.argv else random.randint(1026, 9999)
 
 
+def argument(name, default=None):
+    """Return the value given after a command-line flag, e.g. `--data DIR`."""
+    try:
+        return sys.argv[sys.argv.index(name) + 1]
+    except (ValueError, IndexError):
+        return default
+
+
+def dumps(data, wire_version=wire.PYON_VERSION):
+    """Serialise a message for a peer which speaks the given wire version."""
+    if wire_version >= wire.WIRE_VERSION:
+        return wire.encode(data)
+    return repr(data)
+
+
+def loads(raw_data):
+    """Parse a message in either the binary wire format or PyON."""
+    if isinstance(raw_data, bytes):
+        return wire.decode(raw_data)
+    return ast.literal_eval(raw_data)
+
+
 def log(*args, **kwargs):
     """Print out logs prepended with the port number."""
     return print(f"[{PORT}]", *args, **kwargs)
@@ -23,73 +51,501 @@ class Peer:
     implement to connect to other nodes.
     """
 
-    def __init__(self, send_to_all, request_from_random):
+    def __init__(self, send_to_all, request_from_random, request_from=None):
         self.send_to_all = send_to_all
         self.request_from_random = request_from_random
+        # Optional: ask one particular peer, given its URL.
+        self.request_from = request_from
 
-    def consume_message(self, msg):
+    def consume_message(self, msg, source=None):
+        """Handle a message, from the peer at `source` if we know which."""
         raise NotImplementedError("Peer.consume_message")
 
 
+# Reconnection backoff, in seconds, doubling after each failure.
+BASE_BACKOFF = 0.5
+MAX_BACKOFF = 30
+
+# Peers which fail this many times in a row are forgotten.
+MAX_FAILURES = 5
+
+# How long one send to one peer may take, and how long we'll wait for a
+# peer to answer a request, in seconds.
+SEND_TIMEOUT = 5
+REQUEST_TIMEOUT = 10
+
+# How many messages may wait to go out to one peer before we start
+# dropping the oldest.
+OUTBOUND_QUEUE_SIZE = 256
+
+CONNECTION_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    ConnectionClosed,
+    InvalidHandshake,
+)
+
+
+request_seconds = metrics.histogram(
+    "peer_request_seconds",
+    "Round trip time of requests to each peer.",
+    labels=("peer",),
+)
+bytes_sent = metrics.counter(
+    "peer_bytes_sent_total", "Bytes sent to each peer.", labels=("peer",)
+)
+bytes_received = metrics.counter(
+    "peer_bytes_received_total",
+    "Bytes received from each peer, or the host of connections they opened.",
+    labels=("peer",),
+)
+dropped_messages = metrics.counter(
+    "peer_messages_dropped_total",
+    "Messages to each peer dropped from a full queue or after failing.",
+    labels=("peer",),
+)
+peer_timeouts = metrics.counter(
+    "peer_timeouts_total",
+    "Sends to, or requests of, each peer that took too long.",
+    labels=("peer",),
+)
+queue_depth = metrics.gauge(
+    "peer_queue_depth", "Messages waiting to go out to each peer.", labels=("peer",)
+)
+failures = metrics.gauge(
+    "peer_failures", "Each peer's failures since it last succeeded.", labels=("peer",)
+)
+
+
+# Messages we announce by hash, and let peers fetch only if they need them.
+INVENTORY_KINDS = ("transaction", "transactions", "block", "compact_block")
+
+# How many announced messages we keep for peers to fetch, and how many
+# message hashes we remember having seen.
+INVENTORY_SIZE = 10_000
+SEEN_SIZE = 100_000
+
+
+def message_hash(data):
+    """A short, canonical hash identifying a gossip message."""
+    return hashlib.sha256(codec.encode(data)).digest()[:16]
+
+
+def inventory_kind(data):
+    """Return the kind of message if it's announced by hash, else None."""
+    if len(data) == 1:
+        [kind] = data
+        if kind in INVENTORY_KINDS:
+            return kind
+    return None
+
+
+class SeenSet:
+    """A bounded set which forgets its oldest members first."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._members = OrderedDict()
+
+    def __contains__(self, item):
+        return item in self._members
+
+    def __len__(self):
+        return len(self._members)
+
+    def add(self, item):
+        """Add an item; return False if it was already there."""
+        if item in self._members:
+            return False
+        self._members[item] = True
+        if len(self._members) > self.maxsize:
+            self._members.popitem(last=False)
+        return True
+
+    def discard(self, item):
+        self._members.pop(item, None)
+
+
+class PeerUnavailable(Exception):
+    """Raised when a peer is backing off after failing, or has gone away."""
+
+
+class PeerConnection:
+    """A long-lived websocket to one peer, and how healthy it's been."""
+
+    def __init__(self, url):
+        self.url = url
+        self.websocket = None
+        self.lock = None
+        self.failures = 0
+        self.retry_at = 0
+        self.wire_version = wire.PYON_VERSION
+        self.queue = None
+        self.writer = None
+        self.messages_sent = 0
+        self.messages_dropped = 0
+        self.timeouts = 0
+        self.max_queue_depth = 0
+        self.last_success = None
+
+    @property
+    def healthy(self):
+        return self.failures == 0
+
+    def succeeded(self):
+        self.failures = 0
+        self.retry_at = 0
+        self.last_success = time.time()
+
+    def dropped(self):
+        self.messages_dropped += 1
+        dropped_messages.inc(peer=self.url)
+
+    def timed_out(self):
+        self.timeouts += 1
+        peer_timeouts.inc(peer=self.url)
+
+    def failed(self):
+        self.websocket = None
+        self.failures += 1
+        backoff = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** (self.failures - 1))
+        self.retry_at = time.monotonic() + backoff
+
+
+class ConnectionPool:
+    """
+    Keeps one websocket open to each peer and sends every message to that
+    peer down it, rather than opening a new connection each time.
+    """
+
+    def __init__(self, connect=websockets.connect, on_failure=None):
+        self.connect = connect
+        self.on_failure = on_failure
+        self.connections = {}
+
+    def get(self, url):
+        if url not in self.connections:
+            connection = self.connections[url] = PeerConnection(url)
+            queue_depth.track(
+                connection, lambda c: c.queue.qsize() if c.queue else 0, peer=url
+            )
+            failures.track(connection, lambda c: c.failures, peer=url)
+        return self.connections[url]
+
+    async def _open(self, connection):
+        if connection.websocket is None:
+            if time.monotonic() < connection.retry_at:
+                raise PeerUnavailable(connection.url)
+            connection.websocket = await self.connect(connection.url)
+        return connection.websocket
+
+    async def _exchange(self, url, msg, reply):
+        """
+        Send a message and optionally wait for the reply. A pooled socket may
+        have been closed by the peer since we last used it, so retry once on
+        a fresh connection before giving up. Messages carry no request IDs,
+        so if we're cut off part way, a reply may still be on its way, and
+        the socket is closed rather than handing it to the next caller.
+        """
+        connection = self.get(url)
+        if connection.lock is None:
+            connection.lock = asyncio.Lock()
+
+        async with connection.lock:
+            for attempt in range(2):
+                reused = connection.websocket is not None
+                try:
+                    websocket = await self._open(connection)
+                    start = time.perf_counter()
+                    await websocket.send(msg)
+                    response = await websocket.recv() if reply else None
+                except CONNECTION_ERRORS:
+                    connection.failed()
+                    if reused and attempt == 0:
+                        connection.retry_at = 0
+                        continue
+                    raise
+                except asyncio.CancelledError:
+                    self._discard(connection)
+                    raise
+                connection.messages_sent += 1
+                connection.succeeded()
+                bytes_sent.inc(len(msg), peer=url)
+                if reply:
+                    request_seconds.observe(time.perf_counter() - start, peer=url)
+                    bytes_received.inc(len(response), peer=url)
+                return response
+
+    async def send(self, url, msg):
+        await self._exchange(url, msg, reply=False)
+
+    async def request(self, url, msg):
+        """Send a message and return the reply, giving up on a silent peer."""
+        try:
+            return await asyncio.wait_for(
+                self._exchange(url, msg, reply=True), REQUEST_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            connection = self.get(url)
+            connection.timed_out()
+            connection.failed()
+            raise
+
+    def enqueue(self, url, msg):
+        """
+        Queue a message for a peer's writer task without waiting for it to
+        be sent. If the peer has fallen too far behind, drop its oldest
+        queued message to make room.
+        """
+        connection = self.get(url)
+        if connection.queue is None:
+            connection.queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+            connection.writer = asyncio.ensure_future(self._write(connection))
+        if connection.queue.full():
+            connection.queue.get_nowait()
+            connection.dropped()
+        connection.queue.put_nowait(msg)
+        depth = connection.queue.qsize()
+        connection.max_queue_depth = max(connection.max_queue_depth, depth)
+
+    async def _write(self, connection):
+        """Send one peer's queued messages, one at a time."""
+        while True:
+            msg = await connection.queue.get()
+            try:
+                await asyncio.wait_for(self.send(connection.url, msg), SEND_TIMEOUT)
+            except PeerUnavailable:
+                connection.dropped()
+            except asyncio.TimeoutError:
+                connection.timed_out()
+                connection.dropped()
+                connection.failed()
+                if self.on_failure is not None:
+                    self.on_failure(connection.url)
+            except CONNECTION_ERRORS:
+                connection.dropped()
+                if self.on_failure is not None:
+                    self.on_failure(connection.url)
+
+    def _discard(self, connection):
+        """Stop using a connection's socket, and close it in the background."""
+        websocket, connection.websocket = connection.websocket, None
+        if websocket is not None:
+            asyncio.ensure_future(self._close_quietly(websocket))
+
+    @staticmethod
+    async def _close_quietly(websocket):
+        try:
+            await asyncio.wait_for(websocket.close(), SEND_TIMEOUT)
+        except CONNECTION_ERRORS:
+            pass
+
+    async def close(self, url):
+        connection = self.connections.pop(url, None)
+        if connection is None:
+            return
+        if connection.writer is not None:
+            connection.writer.cancel()
+        if connection.websocket is not None:
+            await connection.websocket.close()
+
+    def health(self):
+        return {
+            url: {
+                "healthy": c.healthy,
+                "failures": c.failures,
+                "messages_sent": c.messages_sent,
+                "messages_dropped": c.messages_dropped,
+                "timeouts": c.timeouts,
+                "queue_depth": c.queue.qsize() if c.queue else 0,
+                "max_queue_depth": c.max_queue_depth,
+                "last_success": c.last_success,
+            }
+            for url, c in self.connections.items()
+        }
+
+
 class Server:
-    def __init__(self, create_worker):
-        self.previously_sent_data = set()
+    def __init__(self, create_worker, url=None, connect=websockets.connect):
+        """
+        A gossip node. By default it listens on our HOST and PORT and finds
+        peers from known_good.txt; give it a URL and a connect function to
+        run it over some other transport, with no initial peers.
+        """
+        self.url = url or f"ws://{HOST}:{PORT}"
+        self.seen = SeenSet(SEEN_SIZE)
+        self.inventory = OrderedDict()
         self.worker = None
-        self.worker = create_worker(self.send_to_all, self.request_from_random)
-        self.urls = set(self.load_initial_urls()) - {f"ws://{HOST}:{PORT}"}
+        self.worker = create_worker(
+            self.send_to_all, self.request_from_random, self.request_from
+        )
+        initial_urls = self.load_initial_urls() if url is None else ()
+        self.urls = set(initial_urls) - {self.url}
+        self.pool = ConnectionPool(connect, on_failure=self.peer_failed)
+        self.loop = None
 
     async def server(self, websocket, path):
-        """Respond to incoming websocket connections."""
-        raw_data = await websocket.recv()
-        data = ast.literal_eval(raw_data)
+        """Respond to each message on an incoming websocket connection."""
+        # Peers connect from an ephemeral port, not the URL they listen on,
+        # so count by host: a label per connection would never stop growing.
+        host, *_ = websocket.remote_address or ("unknown",)
+        peer = f"inbound:{host}"
+        try:
+            async for raw_data in websocket:
+                bytes_received.inc(len(raw_data), peer=peer)
+                await self.respond(websocket, raw_data)
+        except ConnectionClosed:
+            pass
+
+    async def respond(self, websocket, raw_data):
+        data = loads(raw_data)
+        # Reply in whichever format the message came in.
+        if isinstance(raw_data, bytes):
+            version = wire.WIRE_VERSION
+        else:
+            version = wire.PYON_VERSION
+
         if "peer" in data:
-            already_had = (
-                data["peer"] == f"ws://{HOST}:{PORT}" or data["peer"] in self.urls
-            )
+            already_had = data["peer"] == self.url or data["peer"] in self.urls
             await self.add_peer(data["peer"])
-            msg = repr({"peers": list(self.urls)})
+            msg = dumps({"peers": list(self.urls)}, version)
             if not already_had:
                 await self.propagate_peer(data["peer"])
             if "list_peers" in data:
                 await websocket.send(msg)
         elif "ping" in data:
-            await websocket.send(repr({"pong": True}))
+            await websocket.send(
+                dumps({"pong": True, "wire": wire.WIRE_VERSION}, version)
+            )
+        elif "inv" in data:
+            self.handle_inventory(data["inv"], data["from"])
+        elif "getdata" in data:
+            await websocket.send(dumps(self.get_inventory(data["getdata"]), version))
         else:
+            if inventory_kind(data) and not self.seen.add(message_hash(data)):
+                # We've already had this one from somewhere else.
+                return
             reply = self.worker.consume_message(data)
             if reply:
-                await websocket.send(repr(reply))
+                await websocket.send(dumps(reply, version))
+
+    async def on_server_loop(self, coro):
+        """
+        Await a coroutine on the server's own event loop, which owns the
+        pooled connections, even when called from another thread's loop.
+        """
+        if self.loop is None or asyncio.get_event_loop() is self.loop:
+            return await coro
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return await asyncio.wrap_future(future)
+
+    def peer_failed(self, url):
+        """Forget a peer once it's failed too many times in a row."""
+        if self.pool.get(url).failures >= MAX_FAILURES and url in self.urls:
+            log("Removing peer:", url)
+            self.urls.remove(url)
+            asyncio.ensure_future(self.pool.close(url))
+
+    async def send(self, url, data):
+        """Send data to one peer, returning whether it got there."""
+        try:
+            msg = dumps(data, self.pool.get(url).wire_version)
+            await self.pool.send(url, msg)
+            return True
+        except PeerUnavailable:
+            return False
+        except CONNECTION_ERRORS:
+            self.peer_failed(url)
+            return False
+
+    def broadcast(self, data, urls):
+        """
+        Queue data for each of the given peers, serialising it only once for
+        each wire version they speak.
+        """
+        encoded = {}
+        for url in urls:
+            version = self.pool.get(url).wire_version
+            if version not in encoded:
+                encoded[version] = dumps(data, version)
+            self.pool.enqueue(url, encoded[version])
 
     async def propagate_peer(self, peer):
         """Send this new peer to our other peers."""
-        for url in list(self.urls):
-            if peer != url:
-                async with websockets.connect(url) as connection:
-                    await connection.send(repr({"peer": peer}))
-
-    async def send_to_all(self, data):
-        """Send arbitrary data to all connected peers."""
-        for url in list(self.urls):
-            try:
-                async with websockets.connect(url) as connection:
-                    await connection.send(repr(data))
-            except ConnectionRefusedError:
-                log("Removing peer:", url)
-                self.urls.remove(url)
-            except websockets.exceptions.InvalidMessage:
-                log("Removing peer:", url)
-                self.urls.remove(url)
+        self.broadcast({"peer": peer}, [url for url in self.urls if url != peer])
+
+    async def _send_to_all(self, data, fallback=None):
+        if not inventory_kind(data):
+            self.broadcast(data, list(self.urls))
+            return
+
+        # Peers which speak the wire format get just the message's hash,
+        # and fetch the body if they haven't seen it yet.
+        digest = message_hash(data)
+        self.seen.add(digest)
+        self.inventory[digest] = data
+        while len(self.inventory) > INVENTORY_SIZE:
+            self.inventory.popitem(last=False)
+
+        announce, push = [], []
+        for url in self.urls:
+            if self.pool.get(url).wire_version >= wire.WIRE_VERSION:
+                announce.append(url)
+            else:
+                push.append(url)
+        self.broadcast({"inv": (digest,), "from": self.url}, announce)
+        if push and fallback is None and "transactions" in data:
+            # Batches are new too, so older peers get one message for each.
+            for transaction in data["transactions"]:
+                self.broadcast({"transaction": transaction}, push)
+        else:
+            self.broadcast(fallback or data, push)
+
+    def handle_inventory(self, digests, url):
+        """Fetch any announced messages we haven't seen from the announcer."""
+        wanted = tuple(digest for digest in digests if self.seen.add(digest))
+        if wanted:
+            asyncio.ensure_future(self.fetch_inventory(wanted, url))
+
+    async def fetch_inventory(self, digests, url):
+        msg = dumps({"getdata": digests}, self.pool.get(url).wire_version)
+        try:
+            reply = loads(await self.pool.request(url, msg))
+        except (PeerUnavailable, *CONNECTION_ERRORS):
+            # Let another peer's announcement fetch these instead.
+            for digest in digests:
+                self.seen.discard(digest)
+            return
+        for data in reply["data"]:
+            self.worker.consume_message(data, url)
+
+    def get_inventory(self, digests):
+        """Reply to a getdata request with whichever messages we still have."""
+        return {"data": [self.inventory[d] for d in digests if d in self.inventory]}
+
+    async def send_to_all(self, data, fallback=None):
+        """
+        Send arbitrary data to all connected peers. Each peer has its own
+        writer, so this returns once the data is queued, and a slow peer
+        doesn't hold up the others. Peers which only speak PyON get the
+        fallback message instead, if there is one, and batches of
+        transactions one at a time.
+        """
+        await self.on_server_loop(self._send_to_all(data, fallback))
 
     async def add_peer(self, url):
         """Add a peer, provided it's online."""
-        if HOST in url and str(PORT) in url:
+        if url == self.url:
             # Don't bother connecting to ourselves!
             return
         try:
-            async with websockets.connect(url) as connection:
-                await connection.send(repr({"ping": True}))
-                data = ast.literal_eval(await connection.recv())
-                if "pong" in data:
-                    self.urls.add(url)
+            # Tell the peer our wire version; old peers will just ignore it.
+            ping = repr({"ping": True, "wire": wire.WIRE_VERSION})
+            data = loads(await self.pool.request(url, ping))
+            if "pong" in data:
+                self.urls.add(url)
+                version = min(data.get("wire", wire.PYON_VERSION), wire.WIRE_VERSION)
+                self.pool.get(url).wire_version = version
         except Exception as e:
             log(e)
 
@@ -99,10 +555,9 @@ class Server:
             if url not in list(self.urls):
                 await self.add_peer(url)
 
-    @staticmethod
-    def new_client_msg():
+    def new_client_msg(self):
         """Format the message to be sent when connecting afresh."""
-        return repr({"peer": f"ws://{HOST}:{PORT}", "list_peers": True})
+        return repr({"peer": self.url, "list_peers": True})
 
     def get_random_peer(self):
         try:
@@ -122,12 +577,11 @@ class Server:
                 return
 
             try:
-                async with websockets.connect(peer) as connection:
-                    await connection.send(self.new_client_msg())
-                    data = ast.literal_eval(await connection.recv())
-                    await self.add_peers(data["peers"])
+                reply = await self.pool.request(peer, self.new_client_msg())
+                data = loads(reply)
+                await self.add_peers(data["peers"])
                 updated = True
-            except ConnectionRefusedError:
+            except (PeerUnavailable, *CONNECTION_ERRORS):
                 log(f"Couldn't update from {peer}; removing.")
                 self.urls.remove(peer)
 
@@ -136,12 +590,10 @@ class Server:
         with open("known_good.txt") as f:
             return [line.strip() for line in f.readlines()]
 
-    @staticmethod
-    async def send_hello(url):
-        """Connect to a peer and send a "hello" message."""
-        async with websockets.connect(url) as connection:
-            msg = repr({"msg": f"Hello from port {PORT}!"})
-            await connection.send(msg)
+    async def send_hello(self, url):
+        """Send a "hello" message to a peer."""
+        msg = {"msg": f"Hello from port {PORT}!"}
+        await self.on_server_loop(self.send(url, msg))
 
     def send_hello_to_peers(self):
         """Send a "hello" message to each connected peer."""
@@ -153,24 +605,23 @@ class Server:
             urls = list(self.urls)  # Prevent set changing size.
             log("Sending hello to urls:", urls)
             for url in urls:
-                try:
-                    asyncio.get_event_loop().run_until_complete(self.send_hello(url))
-                except ConnectionRefusedError as e:
-                    # Remove any peers which don't respond.
-                    log("Connection refused; couldn't send hello to peer.", url, e)
-                    self.urls.remove(url)
+                asyncio.get_event_loop().run_until_complete(self.send_hello(url))
             time.sleep(5)
 
+    async def _request_from(self, url, request):
+        msg = dumps(request, self.pool.get(url).wire_version)
+        return await self.pool.request(url, msg)
+
+    async def request_from(self, url, request, callback):
+        reply = await self.on_server_loop(self._request_from(url, request))
+        callback(loads(reply))
+
     async def request_from_random(self, request, callback):
-        url = self.get_random_peer()
-        async with websockets.connect(url) as connection:
-            msg = repr(request)
-            await connection.send(msg)
-            reply = ast.literal_eval(await connection.recv())
-            callback(reply)
+        await self.request_from(self.get_random_peer(), request, callback)
 
     def start(self):
         # Start up the websocket server and request peer updates.
+        self.loop = asyncio.get_event_loop()
         start_server = websockets.serve(self.server, HOST, PORT)
         asyncio.get_event_loop().run_until_complete(start_server)
         asyncio.get_event_loop().run_until_complete(self.update_peers())
@@ -178,7 +629,7 @@ class Server:
         # Start worker thread here for mining etc.
         self.worker.start_worker()
 
-        # Start Flask server for private API
+        # Start the private API on our own event loop.
         Api(PORT + 1, self.worker).run()
 
         # Start websocket server here to respond to questions.
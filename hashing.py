@@ -1,10 +1,77 @@
 import hashlib
+import struct
 
+import codec
 
-def cryptographic_hash(block):
+# Blocks with no "version" key are hashed the old way, via repr(). From
+# MERKLE_VERSION on, a block's "merkle_root" stands in for its transactions
+# in the hash, so the hash input stays the same size however full it is.
+LEGACY_VERSION = 0
+MERKLE_VERSION = 2
+BLOCK_VERSION = MERKLE_VERSION
+
+NONCE = struct.Struct(">Q")
+
+
+def legacy_hash(block):
     hash_input = repr(list(sorted(block.items())))
     hash_input = hash_input.encode("utf-8")
-    # Todo: can I just get the integer instead of a string?
     hash_value = hashlib.sha512(hash_input).hexdigest()
     hash_num = int(f"0x{hash_value}", 16)
     return hash_num
+
+
+def is_legacy(block):
+    return block.get("version", LEGACY_VERSION) == LEGACY_VERSION
+
+
+def has_merkle_root(block):
+    return block.get("version", LEGACY_VERSION) >= MERKLE_VERSION
+
+
+def header_fields(block):
+    """
+    Everything a block's hash covers except its nonce. The hash itself
+    isn't part of the block's hash input, so it's left out too.
+    """
+    excluded = ("nonce", "hash")
+    if has_merkle_root(block):
+        excluded += ("transactions",)
+    return {k: v for k, v in block.items() if k not in excluded}
+
+
+def block_prefix(block):
+    """Encode everything about a block which its hash covers, bar the nonce."""
+    return bytes([block["version"]]) + codec.encode(header_fields(block))
+
+
+def encode_block(block):
+    """Canonical bytes for a block, with the nonce fixed at the very end."""
+    return block_prefix(block) + NONCE.pack(block["nonce"])
+
+
+def prefix_hasher(block):
+    """A SHA512 state that's already consumed everything but the nonce."""
+    return hashlib.sha512(block_prefix(block))
+
+
+def nonce_digest(hasher, nonce):
+    """Finish a copy of a prefix hasher with the given nonce."""
+    hasher = hasher.copy()
+    hasher.update(NONCE.pack(nonce))
+    return hasher.digest()
+
+
+def target_digest(target):
+    """
+    The target as a digest-sized byte string, so digests can be
+    compared to it directly.
+    """
+    return target.to_bytes(64, "big")
+
+
+def cryptographic_hash(block):
+    if is_legacy(block):
+        return legacy_hash(block)
+    digest = hashlib.sha512(encode_block(block)).digest()
+    return int.from_bytes(digest, "big")
@@ -0,0 +1,46 @@
+"""
+Checking a payment without downloading blocks or the unspent outputs.
+
+A full node sends a Merkle proof for the transaction along with the
+headers from its block onwards. The transaction is in that block if the
+proof leads from its ID to the first header's Merkle root, and each
+header after it is properly mined and links on from the one before.
+"""
+
+from hashing import cryptographic_hash, has_merkle_root
+from merkle import verify_proof
+from signing import transaction_digest
+
+
+def header_mined(header, target):
+    """Check a header's hash is right and below the target."""
+    if not has_merkle_root(header):
+        return False
+    hash_input = {k: v for k, v in header.items() if k != "hash"}
+    return header["hash"] == cryptographic_hash(hash_input) < target
+
+
+def headers_linked(headers):
+    return all(
+        child["previous_block"] == parent["id"]
+        and child["previous_block_hash"] == parent["hash"]
+        for parent, child in zip(headers, headers[1:])
+    )
+
+
+def confirmations(transaction, proof, target):
+    """
+    How many mined headers confirm a transaction, from the one holding it
+    onwards, or 0 if the proof doesn't hold up.
+    """
+    headers = proof["headers"]
+    if not headers or not headers_linked(headers):
+        return 0
+    if not all(header_mined(header, target) for header in headers):
+        return 0
+    leaf = transaction_digest(transaction)
+    if not verify_proof(
+        leaf, proof["index"], proof["branch"], headers[0]["merkle_root"]
+    ):
+        return 0
+    return len(headers)
@@ -0,0 +1,180 @@
+"""
+Transactions waiting to go into a block, indexed by ID and by the outputs
+they spend, and kept in fee rate order as they come and go. When the pool
+is full, the transactions paying the least per byte are evicted first.
+"""
+
+from bisect import bisect_left
+from itertools import count
+
+import codec
+from merkle import MerkleTree
+from signing import transaction_digest
+
+MAX_TRANSACTIONS = 50_000
+MAX_BYTES = 50_000_000
+
+# The most transactions we'll put into one block.
+MAX_BLOCK_TRANSACTIONS = 1000
+
+# Compact blocks refer to transactions by this many bytes of their IDs.
+SHORT_ID_BYTES = 8
+
+
+class MempoolEntry:
+    __slots__ = ("transaction", "txid", "fee", "size", "fee_rate", "sequence")
+
+    def __init__(self, transaction, txid, fee, size, sequence):
+        self.transaction = transaction
+        self.txid = txid
+        self.fee = fee
+        self.size = size
+        self.fee_rate = fee / size
+        self.sequence = sequence
+
+    @property
+    def order_key(self):
+        """Sorts best fee rate first, then first come, first served."""
+        return (-self.fee_rate, self.sequence, self.txid)
+
+
+class Mempool:
+    def __init__(self, max_count=MAX_TRANSACTIONS, max_bytes=MAX_BYTES):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.entries = {}
+        self.spent = {}
+        self.short_ids = {}
+        self.bytes = 0
+        self.evicted = 0
+        # Bumped whenever the pool changes, so templates can be reused.
+        self.version = 0
+        # (-fee rate, sequence, txid) for each entry, best first.
+        self._order = []
+        self._sequence = count()
+        self._template = ((), 0)
+        # Set when a change reaches the block's worth at the front of the pool.
+        self._template_stale = False
+        # The Merkle tree of the current template's transaction IDs.
+        self.merkle = MerkleTree()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, txid):
+        return txid in self.entries
+
+    def transactions(self):
+        return [entry.transaction for entry in self.entries.values()]
+
+    def by_short_id(self, short_ids):
+        """The transactions here with any of the given short IDs, by short ID."""
+        found = {}
+        for short_id in short_ids:
+            txid = self.short_ids.get(short_id)
+            if txid is not None:
+                found[short_id] = self.entries[txid].transaction
+        return found
+
+    def conflicts(self, transaction):
+        """Whether a transaction spends an output something here already spends."""
+        return any(i in self.spent for i in transaction["inputs"])
+
+    def add(self, transaction, fee):
+        """
+        Add a transaction paying the given fee. Return False if it's already
+        here, double-spends one that is, or pays too little to fit.
+        """
+        txid = transaction_digest(transaction)
+        if txid in self.entries or self.conflicts(transaction):
+            return False
+
+        size = len(codec.encode(transaction))
+        entry = MempoolEntry(transaction, txid, fee, size, next(self._sequence))
+        would_overflow = self._over_capacity(len(self) + 1, self.bytes + size)
+        if would_overflow and entry.fee_rate <= self._lowest_fee_rate():
+            return False
+
+        self.entries[txid] = entry
+        self.short_ids[txid[:SHORT_ID_BYTES]] = txid
+        for transaction_input in transaction["inputs"]:
+            self.spent[transaction_input] = txid
+        self.bytes += size
+        self._reorder(entry.order_key, insert=True)
+
+        while self._over_capacity(len(self), self.bytes):
+            self._evict()
+        return txid in self.entries
+
+    def _over_capacity(self, transactions, size):
+        return transactions > self.max_count or size > self.max_bytes
+
+    def _lowest_fee_rate(self):
+        return -self._order[-1][0] if self._order else 0
+
+    def _evict(self):
+        _, _, txid = self._order[-1]
+        self.remove(txid)
+        self.evicted += 1
+
+    def remove(self, txid):
+        entry = self.entries.pop(txid, None)
+        if entry is None:
+            return
+        for transaction_input in entry.transaction["inputs"]:
+            if self.spent.get(transaction_input) == txid:
+                del self.spent[transaction_input]
+        if self.short_ids.get(txid[:SHORT_ID_BYTES]) == txid:
+            del self.short_ids[txid[:SHORT_ID_BYTES]]
+        self._reorder(entry.order_key, insert=False)
+        self.bytes -= entry.size
+
+    def _reorder(self, key, insert):
+        """
+        Put an entry into, or take it out of, fee order. Only changes among
+        the transactions our next block would hold mean a new template.
+        """
+        position = bisect_left(self._order, key)
+        if insert:
+            self._order.insert(position, key)
+        else:
+            del self._order[position]
+        if position < MAX_BLOCK_TRANSACTIONS:
+            self._template_stale = True
+        self.version += 1
+
+    def remove_block(self, block):
+        """
+        Drop the transactions a block included, and any which spend the
+        same outputs, since they can never be valid now.
+        """
+        for transaction in block["transactions"]:
+            self.remove(transaction_digest(transaction))
+            for transaction_input in transaction["inputs"]:
+                if transaction_input in self.spent:
+                    self.remove(self.spent[transaction_input])
+
+    def remove_unspendable(self, unspent):
+        """
+        Drop the transactions spending any output not in `unspent`, like
+        those a reorganisation took away.
+        """
+        for entry in list(self.entries.values()):
+            if not all(i in unspent for i in entry.transaction["inputs"]):
+                self.remove(entry.txid)
+
+    def template(self):
+        """
+        The transactions for our next block, best fee rate first, along with
+        the fees they pay. The pool is already in that order, so only the
+        block's worth at its front is read, only when that has changed, and
+        the Merkle tree is only rebuilt from the first transaction to move.
+        """
+        if self._template_stale:
+            best = self._order[:MAX_BLOCK_TRANSACTIONS]
+            entries = [self.entries[txid] for _, _, txid in best]
+            transactions = tuple(entry.transaction for entry in entries)
+            self._template = transactions, sum(entry.fee for entry in entries)
+            self.merkle.update([entry.txid for entry in entries])
+            self._template_stale = False
+        return self._template
@@ -0,0 +1,118 @@
+"""
+Merkle trees over transaction IDs, so a block's header can commit to its
+transactions with one fixed-size root.
+
+A level with an odd number of nodes pairs its last node with itself. The
+tree keeps every level, so appending a leaf or dropping leaves from the
+end only recomputes the nodes on the path from the last leaf to the root.
+"""
+
+import hashlib
+
+from signing import transaction_digest
+
+# The root of a tree with no leaves.
+EMPTY_ROOT = bytes(32)
+
+
+def combine(left, right):
+    return hashlib.sha256(left + right).digest()
+
+
+class MerkleTree:
+    def __init__(self, leaves=()):
+        self.levels = [[]]
+        for leaf in leaves:
+            self.append(leaf)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    @property
+    def leaves(self):
+        return self.levels[0]
+
+    @property
+    def root(self):
+        if not self.leaves:
+            return EMPTY_ROOT
+        return self.levels[-1][0]
+
+    def append(self, leaf):
+        self.levels[0].append(leaf)
+        self._update_path(len(self) - 1)
+
+    def truncate(self, length):
+        """Keep only the first `length` leaves."""
+        if length >= len(self):
+            return
+        if not length:
+            self.levels = [[]]
+            return
+        size = length
+        for nodes in self.levels:
+            del nodes[size:]
+            size = (size + 1) // 2
+        self._update_path(length - 1)
+
+    def update(self, leaves):
+        """
+        Change the tree's leaves to the given list, keeping the nodes built
+        from any leaves it starts with that haven't changed.
+        """
+        common = 0
+        for old, new in zip(self.leaves, leaves):
+            if old != new:
+                break
+            common += 1
+        self.truncate(common)
+        for leaf in leaves[common:]:
+            self.append(leaf)
+
+    def _update_path(self, index):
+        """Recompute the nodes above a leaf, up to the root."""
+        level = 0
+        while len(self.levels[level]) > 1:
+            nodes = self.levels[level]
+            parent = index // 2
+            left = nodes[2 * parent]
+            right = nodes[2 * parent + 1] if 2 * parent + 1 < len(nodes) else left
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+            above = self.levels[level + 1]
+            if parent < len(above):
+                above[parent] = combine(left, right)
+            else:
+                above.append(combine(left, right))
+            index, level = parent, level + 1
+        del self.levels[level + 1 :]
+
+    def proof(self, index):
+        """
+        The sibling of each node on the path from a leaf to the root, which
+        with the leaf's index is enough to recompute the root.
+        """
+        branch = []
+        for nodes in self.levels[:-1]:
+            sibling = index ^ 1
+            branch.append(nodes[sibling] if sibling < len(nodes) else nodes[index])
+            index //= 2
+        return tuple(branch)
+
+
+def verify_proof(leaf, index, branch, root):
+    """Check a branch from MerkleTree.proof leads from a leaf to the root."""
+    node = leaf
+    for sibling in branch:
+        node = combine(sibling, node) if index % 2 else combine(node, sibling)
+        index //= 2
+    return index == 0 and node == root
+
+
+def merkle_root(leaves):
+    return MerkleTree(leaves).root
+
+
+def transactions_root(transactions):
+    """The Merkle root a block's header should hold for its transactions."""
+    return merkle_root(transaction_digest(t) for t in transactions)
@@ -0,0 +1,241 @@
+"""
+Counters, gauges and histograms for watching a node, rendered in the
+Prometheus text format, plus an opt-in sampling profiler for hot paths.
+
+Metrics are registered by name on the module's `registry` when they're
+created, so re-creating one (say, for a new Miner) replaces the old one.
+"""
+
+import os
+import sys
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from collections import Counter as Tally
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, for timing histograms.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+# How often the profiler samples the stacks of threads it's watching.
+PROFILE_INTERVAL = 0.005
+
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    inner = ",".join(f'{name}="{value}"' for name, value in pairs)
+    return "{" + inner + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        """(suffix, label values, extra labels, value) for each sample."""
+        raise NotImplementedError("Metric.samples")
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for suffix, values, extra, value in self.samples():
+            labels = format_labels(self.labels, values, extra)
+            lines.append(f"{self.name}{suffix}{labels} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        with self.lock:
+            return [("", key, (), value) for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """
+    Values which go up and down, read from functions when rendered. Each
+    label set can be read from a different owner, say one per node, and
+    stops being rendered once its owner is gone.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, function=None, labels=()):
+        super().__init__(name, help_text, labels)
+        self.function = function
+        self.owners = {}
+
+    def track(self, owner, read, **labels):
+        """Render read(owner) for these labels, for as long as owner lives."""
+        with self.lock:
+            self.owners[self.key(labels)] = (weakref.ref(owner), read)
+
+    def samples(self):
+        samples = [] if self.function is None else [("", (), (), self.function())]
+        with self.lock:
+            for key, (owner, read) in list(self.owners.items()):
+                target = owner()
+                if target is None:
+                    del self.owners[key]
+                else:
+                    samples.append(("", key, (), read(target)))
+        return samples
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        # Per label set: a count for each bucket and one for +Inf, and a sum.
+        self.counts = {}
+        self.sums = {}
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.sums[key] = self.sums.get(key, 0) + value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        return sum(self.counts.get(self.key(labels), ()))
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, counts in self.counts.items():
+                total = 0
+                bounds = [*map(str, self.buckets), "+Inf"]
+                for bound, count in zip(bounds, counts):
+                    total += count
+                    samples.append(("_bucket", key, (("le", bound),), total))
+                samples.append(("_sum", key, (), self.sums[key]))
+                samples.append(("_count", key, (), total))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """Every metric, in the Prometheus text exposition format."""
+        return "\n".join(m.render() for m in self.metrics.values()) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name, help_text, labels=()):
+    return registry.register(Counter(name, help_text, labels))
+
+
+def gauge(name, help_text, function=None, labels=()):
+    return registry.register(Gauge(name, help_text, function, labels))
+
+
+def histogram(name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, help_text, labels, buckets))
+
+
+class SamplingProfiler:
+    """
+    While enabled, samples the stack of every thread that's inside a
+    profiled section, and tallies the stacks in collapsed form, ready for
+    a flame graph. Disabled sections cost one attribute check.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.enabled = False
+        self.active = {}
+        self.samples = Tally()
+        self._thread = None
+
+    def enable(self):
+        self.enabled = True
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+
+    def disable(self):
+        self.enabled = False
+
+    @contextmanager
+    def section(self, name):
+        if not self.enabled:
+            yield
+            return
+        ident = threading.get_ident()
+        outer = self.active.get(ident)
+        self.active[ident] = name
+        try:
+            yield
+        finally:
+            if outer is None:
+                self.active.pop(ident, None)
+            else:
+                self.active[ident] = outer
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            if not self.active:
+                continue
+            frames = sys._current_frames()
+            for ident, name in list(self.active.items()):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    filename = os.path.basename(code.co_filename)
+                    stack.append(f"{filename}:{code.co_name}")
+                    frame = frame.f_back
+                self.samples[";".join([name, *reversed(stack)])] += 1
+
+    def collapsed(self):
+        """One line per distinct stack, with how many times it was sampled."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.items())
+
+
+profiler = SamplingProfiler()
@@ -1,24 +1,100 @@
 import asyncio
 import hashlib
+import queue
 import sys
 import time
-from collections import namedtuple, defaultdict, deque
-from itertools import count, product, combinations, permutations
+from collections import OrderedDict, deque
+from itertools import product, combinations
 from threading import Thread
 from uuid import uuid4 as uuid
 
 import gossip
-from hashing import cryptographic_hash
-from signing import sign_transaction, generate_keypair, verify_transaction
+import metrics
+from blockstore import BlockStore
+from blocktree import BlockTree, PRUNE_DEPTH
+from hashing import cryptographic_hash, has_merkle_root, BLOCK_VERSION
+from mempool import Mempool, SHORT_ID_BYTES
+from merkle import MerkleTree, transactions_root
+from mining import default_backend
+from records import freeze_block
+from signing import (
+    sign_transaction,
+    generate_keypair,
+    verify_transaction,
+    verify_transactions,
+    transaction_digest,
+)
+from utxo import UtxoSet, UtxoView
 
 # Make logs appear with a prepended port number.
 log = gossip.log
 
-UnspentTransaction = namedtuple("UnspentTransaction", "id amount address")
+# Save a snapshot of our unspent outputs every this many blocks.
+SNAPSHOT_INTERVAL = 1000
+
+# Chain sync: the most headers sent in one reply, the most blocks in one
+# page, and how many pages we download from peers at once.
+MAX_HEADERS = 2000
+PAGE_SIZE = 100
+SYNC_PARALLEL = 4
+
+# How many headers a transaction proof comes with, unless asked for more.
+PROOF_CONFIRMATIONS = 6
+
+block_validation_seconds = metrics.histogram(
+    "block_validation_seconds",
+    "Time taken to check a block's proof of work and transactions.",
+)
+reorgs = metrics.counter("reorgs_total", "Times we switched to a longer fork.")
+reorg_depth = metrics.histogram(
+    "reorg_depth_blocks",
+    "How many blocks each switch to a longer fork abandoned.",
+    buckets=(1, 2, 3, 5, 10, 20, 50, PRUNE_DEPTH),
+)
+
+# Gauges read from each node, labelled with the start of its address.
+NODE_GAUGES = (
+    (
+        metrics.gauge("chain_height", "Blocks in our main chain.", labels=("node",)),
+        lambda node: node.height,
+    ),
+    (
+        metrics.gauge(
+            "utxo_set_size", "Unspent outputs we know about.", labels=("node",)
+        ),
+        lambda node: len(node.unspent_transactions),
+    ),
+    (
+        metrics.gauge(
+            "mempool_transactions",
+            "Transactions waiting to go into a block.",
+            labels=("node",),
+        ),
+        lambda node: len(node.mempool),
+    ),
+    (
+        metrics.gauge(
+            "mempool_bytes", "Encoded size of the mempool.", labels=("node",)
+        ),
+        lambda node: node.mempool.bytes,
+    ),
+    (
+        metrics.gauge(
+            "mining_hash_rate",
+            "Hashes per second over every nonce search so far.",
+            labels=("node",),
+        ),
+        lambda node: node.mining_backend.hash_rate,
+    ),
+)
+
+
+def without_hash(block):
+    return {k: v for k, v in block.items() if k != "hash"}
 
 
 def add_hashes_to(blocks):
-    yield from map(lambda b: {**b, "hash": cryptographic_hash(b)}, blocks)
+    yield from map(lambda b: freeze_block(without_hash(b)), blocks)
 
 
 def asyncio_run(fn):
@@ -43,172 +119,639 @@ def print_blockchain(blocks):
     log(f"Chain(length={length}, {dots}{printable_chain})")
 
 
-def get_blockchain():
-    """
-    Format the message to request a blockchain from
-    another node.
-    """
-    return {"request_blockchain": True}
+def short_id(transaction):
+    """A short ID for a transaction, used to refer to it in compact blocks."""
+    return transaction_digest(transaction)[:SHORT_ID_BYTES]
 
 
-def is_parent_of(block_one, block_two):
-    """Returns True if block_one is parent of block_two, False otherwise."""
-    return block_one["id"] == block_two["previous_block"]
+def compact_block(block):
+    """A block with its transactions replaced by their short IDs."""
+    compact = {k: v for k, v in block.items() if k != "transactions"}
+    compact["short_ids"] = tuple(short_id(t) for t in block["transactions"])
+    return compact
+
+
+def header(block):
+    """
+    A block without its transactions: enough to check it links into a chain
+    and, for blocks with a Merkle root, that it was really mined.
+    """
+    return {k: v for k, v in block.items() if k != "transactions"}
 
 
 class Miner(gossip.Peer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.unspent_transactions = {}
-        self.current_transactions = []
-        self.current_transaction_fees = 0
+        self.unspent_transactions = UtxoSet()
+        self.undo_data = OrderedDict()
+        self.mempool = Mempool()
+        self.transaction_blocks = None
+        self.tree = BlockTree()
         self.blocks = []
-        self.loser_blockchains = []
         self._difficulty = 15
         self.mining_reward = 1000
-        self.got_new_block = False
+        # Chain state belongs to the event loop; the mining thread only sees
+        # block templates, and hands back solved blocks.
+        self.loop = None
+        self.mining = False
+        self.templates = queue.Queue(maxsize=1)
+        self.template_pending = False
+        self.mining_backend = default_backend()
+        self.store = None
+        self.trusted_snapshot = None
+        # Blocks downloaded while we trust a snapshot, by ID, in chain order,
+        # and the hashes their headers came with.
+        self.snapshot_buffer = {}
+        self.snapshot_headers = {}
         self.private_key, self.public_key = generate_keypair()
         printable_address = self.public_key[:10].decode("utf-8")
         log(f"Address: <{printable_address}...>")
 
-    def update_blockchain(self, response):
+        for gauge, read in NODE_GAUGES:
+            gauge.track(self, read, node=printable_address)
+        if "--profile" in sys.argv:
+            metrics.profiler.enable()
+
+        data_directory = gossip.argument("--data")
+        if data_directory:
+            self.open_store(data_directory)
+
+    def open_store(self, directory):
         """
-        Given a response from a peer containing a full blockchain C,
-        set our own blockchain to C.
+        Reopen the chain we saved on disk, and keep saving to it. Our unspent
+        outputs come from the newest snapshot, so only the blocks after it
+        need decoding and replaying; older ones are read when they're asked
+        for.
         """
-        blocks = response["blocks"]
-        for block in blocks:
+        self.store = BlockStore(directory)
+        snapshot = self.store.load_snapshot()
+        replay_from = 0
+        if snapshot is not None:
+            self.unspent_transactions = UtxoSet(snapshot["outputs"])
+            replay_from = snapshot["height"]
+
+        stored = map(self.store.stored_block, range(replay_from))
+        replayed = map(self.store.__getitem__, range(replay_from, len(self.store)))
+        self.blocks = [*stored, *replayed]
+        for block in self.blocks[replay_from:]:
             self.update_unspent_transactions_with_block(block)
-            self.new_block(block)
-        log("Updated blockchain.")
+        log(
+            f"Loaded {len(self.blocks)} blocks from {directory}, "
+            f"replayed {len(self.blocks) - replay_from}."
+        )
+
+    def snapshot(self):
+        """Our unspent outputs, and the chain tip they belong to."""
+        return {
+            "height": self.height,
+            "block_hash": self.previous_block_hash,
+            "outputs": self.unspent_transactions.snapshot(),
+        }
+
+    def use_snapshot(self, snapshot):
+        """
+        Trust a peer's snapshot, so that when we download the chain we can
+        skip replaying the blocks it covers.
+        """
+        if snapshot.get("height"):
+            self.trusted_snapshot = snapshot
+
+    def apply_trusted_snapshot(self, blocks):
+        """
+        If the start of a downloaded chain matches our trusted snapshot,
+        adopt those blocks without replaying them and return the rest.
+        """
+        snapshot = self.trusted_snapshot
+        if snapshot is None or self.blocks or len(blocks) < snapshot["height"]:
+            return blocks
+
+        checkpoint = list(add_hashes_to(blocks[: snapshot["height"]]))
+        valid = self.checkpoint_valid(checkpoint)
+        if not valid or checkpoint[-1]["hash"] != snapshot["block_hash"]:
+            log("Peer snapshot doesn't match its chain; replaying everything.")
+            self.trusted_snapshot = None
+            self.snapshot_headers = {}
+            return blocks
+
+        for block in checkpoint:
+            self.append_block(block)
+        self.unspent_transactions = UtxoSet(snapshot["outputs"])
+        if self.store is not None:
+            self.store.save_snapshot(snapshot)
+        self.trusted_snapshot = None
+        self.snapshot_buffer = {}
+        self.snapshot_headers = {}
+        return blocks[snapshot["height"] :]
+
+    def checkpoint_valid(self, checkpoint):
+        """
+        Check the blocks a snapshot covers were really mined, each on the one
+        before, starting from nothing, and are the ones the headers we were
+        sent describe. We don't replay them, so this is all we check.
+        """
+        parent_id = parent_hash = 0
+        for block in checkpoint:
+            if block["previous_block"] != parent_id:
+                return False
+            if block["previous_block_hash"] != parent_hash:
+                return False
+            if block["hash"] >= self.target:
+                return False
+            if self.snapshot_headers.get(block["id"]) != block["hash"]:
+                return False
+            parent_id, parent_hash = block["id"], block["hash"]
+        return True
+
+    def block_locator(self):
+        """
+        IDs of blocks on our chain, most recent first: the last ten, then
+        exponentially further apart back to the first block. Blocks we're
+        holding back for a snapshot aren't on our chain yet, but we needn't
+        download them again, so the newest of them comes first of all.
+        """
+        locator = []
+        if self.snapshot_buffer:
+            locator.append(next(reversed(self.snapshot_buffer)))
+        height, step = self.height, 1
+        while height > 0:
+            locator.append(self.blocks[height - 1]["id"])
+            if len(locator) >= 10:
+                step *= 2
+            height -= step
+        if self.blocks and locator[-1] != self.blocks[0]["id"]:
+            locator.append(self.blocks[0]["id"])
+        return locator
+
+    def headers_after(self, locator):
+        """Headers of our blocks after the first locator block we have."""
+        start = 0
+        for block_id in locator:
+            height = self.tree.height_of(block_id)
+            if height is not None:
+                start = height
+                break
+        blocks = self.blocks[start : start + MAX_HEADERS]
+        return {"headers": [header(block) for block in blocks]}
+
+    def get_blocks(self, block_ids):
+        """Reply to a request for one page of our blocks."""
+        blocks = []
+        for block_id in block_ids[:PAGE_SIZE]:
+            height = self.tree.height_of(block_id)
+            if height is not None:
+                blocks.append(without_hash(self.blocks[height - 1]))
+        return {"blocks": blocks}
+
+    def headers_link(self, headers):
+        """
+        Check a run of headers follows on from our chain, or the blocks we're
+        holding back for a snapshot, and from each other.
+        """
+        parent = headers[0]["previous_block"]
+        known = (
+            self.tree.height_of(parent) is not None or parent in self.snapshot_buffer
+        )
+        if parent != 0 and not known:
+            return False
+        for previous, current in zip(headers, headers[1:]):
+            if current["previous_block"] != previous["id"]:
+                return False
+            if current["previous_block_hash"] != previous["hash"]:
+                return False
+        return all(h["hash"] < self.target for h in headers)
+
+    async def ask(self, request, url=None):
+        """
+        Send a request to a peer and return its reply: to the one at `url`
+        if given and it's reachable, otherwise to a random one.
+        """
+        replies = []
+        if url is not None and self.request_from is not None:
+            try:
+                await self.request_from(url, request, replies.append)
+                return replies[0]
+            except (gossip.PeerUnavailable, *gossip.CONNECTION_ERRORS):
+                log(f"Couldn't ask {url}; asking another peer.")
+        await self.request_from_random(request, replies.append)
+        return replies[0]
+
+    async def sync(self):
+        """
+        Catch up with the network headers-first. Ask a peer for the headers
+        after our chain, then download their blocks in pages, several at a
+        time from random peers, validating each page as soon as it's our
+        turn to apply it.
+        """
+        limit = asyncio.Semaphore(SYNC_PARALLEL)
+
+        async def download(page):
+            async with limit:
+                return await self.ask({"get_blocks": page})
+
+        while True:
+            headers = (await self.ask({"get_headers": self.block_locator()}))["headers"]
+            if not headers:
+                break
+            if not self.headers_link(headers):
+                log("Peer sent headers which don't link up; stopping sync.")
+                return
+            if self.trusted_snapshot is not None:
+                self.snapshot_headers.update((h["id"], h["hash"]) for h in headers)
+
+            ids = [h["id"] for h in headers]
+            pages = [ids[i : i + PAGE_SIZE] for i in range(0, len(ids), PAGE_SIZE)]
+            downloads = [asyncio.ensure_future(download(page)) for page in pages]
+            try:
+                for page, pending in zip(pages, downloads):
+                    blocks = (await pending)["blocks"]
+                    if [b["id"] for b in blocks] != page:
+                        log("Peer sent the wrong page of blocks; stopping sync.")
+                        return
+                    if not self.accept_synced_blocks(blocks):
+                        log("Peer sent an invalid block; stopping sync.")
+                        return
+            finally:
+                for pending in downloads:
+                    pending.cancel()
+
+            if len(headers) < MAX_HEADERS:
+                break
+        log("Synced blockchain.")
         self.print_chain()
 
-    def update_unspent_transactions_with_block(self, block):
-        """Update our unspent transactions pool."""
-        trxid, amount, address = block["mine"]
-        self.unspent_transactions[trxid] = UnspentTransaction(trxid, amount, address)
+    def accept_synced_blocks(self, blocks):
+        """
+        Apply a page of downloaded blocks in order. While we trust a peer's
+        snapshot, hold blocks back until we have all the ones it covers.
+        """
+        if self.trusted_snapshot is not None:
+            for block in blocks:
+                self.snapshot_buffer.setdefault(block["id"], block)
+            if len(self.snapshot_buffer) < self.trusted_snapshot["height"]:
+                return True
+            blocks = self.apply_trusted_snapshot(list(self.snapshot_buffer.values()))
+            self.snapshot_buffer = {}
+        return all(self.accept_block(block) for block in blocks)
+
+    def blocks_since(self, block_id):
+        """Reply to a chain request, sending only blocks the peer is missing."""
+        parent = self.find_block_by_id(block_id) if block_id else None
+        if parent is None:
+            return {"blocks": self.blocks}
+        return {"blocks": self.blocks[parent + 1 :], "since": block_id}
 
-        for transaction in block["transactions"]:
-            for transaction_input in transaction["inputs"]:
-                # Todo: think carefully about the cases here.
-                if transaction_input in self.unspent_transactions:
-                    del self.unspent_transactions[transaction_input]
+    def update_unspent_transactions_with_block(self, block):
+        """
+        Update our unspent transactions pool, keeping enough undo data to
+        roll the block back if a fork replaces it.
+        """
+        undo = self.unspent_transactions.apply_block(block)
+        self.undo_data[block["id"]] = undo
+        # We never reorganise deeper than the block tree keeps side branches.
+        while len(self.undo_data) > PRUNE_DEPTH + 1:
+            self.undo_data.popitem(last=False)
+
+    def rebuild_unspent_transactions(self):
+        """Replay our whole chain into a fresh unspent transactions pool."""
+        self.unspent_transactions = UtxoSet()
+        self.undo_data.clear()
+        for block in self.blocks:
+            self.update_unspent_transactions_with_block(block)
 
-            for output in transaction["outputs"]:
-                output_id, _, _ = output
-                transaction = UnspentTransaction(*output)
-                self.unspent_transactions[output_id] = transaction
+    def accept_transaction(self, transaction):
+        """Check a transaction and add it to our next block, if it's valid."""
+        # Turn away double spends before bothering to check the signature.
+        if self.mempool.conflicts(transaction):
+            return False
+        if not (
+            self.validate_transaction(transaction)
+            and self.mempool.add(transaction, self.transaction_fee(transaction))
+        ):
+            return False
+        self.template_changed()
+        return True
 
     def handle_transaction_msg(self, transaction):
         """When sent a transaction, check it and add it to our next block."""
-        if self.validate_transaction(transaction):
+        if self.accept_transaction(transaction):
             log("Received valid transaction:", transaction)
-            self.current_transactions.append(transaction)
             # Propagate it to our network
-            asyncio_background(self.send_to_all(transaction))
+            asyncio_background(self.send_to_all({"transaction": transaction}))
+
+    def handle_transactions_msg(self, transactions):
+        """Accept a batch of transactions, and pass on the valid ones together."""
+        accepted = [t for t in transactions if self.accept_transaction(t)]
+        if accepted:
+            log(f"Received {len(accepted)} valid transactions.")
+            asyncio_background(self.send_to_all({"transactions": accepted}))
 
     def validate_block(self, block):
+        extends_tip = block["previous_block_hash"] == self.previous_block_hash
         return (
-            self.hash_complete(block)
-            and block["previous_block_hash"] == self.previous_block_hash
-            and self.validate_transactions(block["transactions"])
+            extends_tip
+            and self.block_valid(block)
+            and self.spends_valid(block["transactions"])
         )
 
-    def coalesce_loser_blockchains(self):
-        """
-        Coalesce any pairs of chains into single chains, leaving the originals put.
-        """
-        for chain1, chain2 in permutations(self.loser_blockchains, r=2):
-            if is_parent_of(chain1[-1], chain2[0]):
-                self.loser_blockchains.append(chain1 + chain2)
-
-    def add_to_losers(self, block):
+    def block_valid(self, block):
         """
-        Add a block to the loser blockchains.
+        Check a block's proof of work and signatures: everything which is
+        the same wherever it goes. What it spends is checked against the
+        chain it joins, when it joins it.
         """
-        for blockchain in list(self.loser_blockchains):
-            start = blockchain[0]
-            end = blockchain[-1]
-            if is_parent_of(block, start):
-                self.loser_blockchains.append(deque([block]) + blockchain)
-            elif is_parent_of(end, block):
-                self.loser_blockchains.append(blockchain + deque([block]))
-        self.loser_blockchains.append(deque([block]))
+        with metrics.profiler.section("validate_block"):
+            with block_validation_seconds.time():
+                return (
+                    self.hash_complete(block)
+                    and self.transactions_distinct(block)
+                    and self.root_matches_transactions(block)
+                    and verify_transactions(block["transactions"])
+                )
 
     def resolve_block_conflict(self, block):
         """
-        When we receive a block with a surprising parent ID, attempt to
-        resolve the conflict and choose the longest blockchain fork.
+        When we receive a block with a surprising parent ID, add it to our
+        block tree and switch to its branch if that's now the longest.
+        Return False if that branch turned out to be invalid.
         """
-        # Form all possible new blockchains with the new block.
-        self.add_to_losers(block)
         log(
             f"Conflicting block: {short_hash(block)}, "
-            f"parent={str(block['previous_block_hash'])[:5]}"
+            f"parent={str(block.get('previous_block_hash'))[:5]}"
         )
-        self.coalesce_loser_blockchains()
+        tip = self.tree.add(block)
+        if tip is None:
+            return True
 
-        longest_loser_length = max(len(x) for x in self.loser_blockchains)
-        if longest_loser_length > 2:
-            pass
-
-        # Given our new consolidated chains, try adding them to the blockchain.
-        for blockchain in (b for b in self.loser_blockchains if len(b) > 1):
-            fork_parent_id = blockchain[0]["previous_block"]
-            fork_parent_index = self.find_block_by_id(fork_parent_id)
-            if fork_parent_index is not None:
-                self.swap_if_longer(blockchain, fork_parent_index)
+        branch = self.tree.branch(tip)
+        if branch is None:
+            log("Ignoring a fork too deep to switch to.")
+            return True
+        return self.switch_to_fork(*branch)
 
     def find_block_by_id(self, block_id):
         """
         Return the index of the block with the given ID in our current blockchain,
         or None if we can't find that block ID.
         """
-        for index, block in enumerate(self.blocks):
-            if block["id"] == block_id:
-                return index
-        return None
+        height = self.tree.height_of(block_id)
+        if height is None:
+            return None
+        return height - 1
+
+    def switch_to_fork(self, fork_height, fork_blocks):
+        """
+        Replace everything in our chain after fork_height with the
+        given (longer) branch of blocks, if every block in it spends only
+        outputs the branch has by then. Otherwise keep our chain, forget
+        the first bad block and everything built on it, and return False.
+        """
+        abandoned = self.blocks[fork_height:]
+        adopted = list(add_hashes_to(fork_blocks))
+        can_undo = all(block["id"] in self.undo_data for block in abandoned)
+
+        # Roll our unspent pool back to the fork point, block by block.
+        replaced = None
+        if can_undo:
+            for block in reversed(abandoned):
+                self.unspent_transactions.undo(self.undo_data.pop(block["id"]))
+        else:
+            log("Missing undo data for this fork; replaying the chain up to it.")
+            replaced = self.unspent_transactions
+            self.unspent_transactions = UtxoSet()
+            for block in self.blocks[:fork_height]:
+                self.unspent_transactions.apply_block(block)
+
+        # Then play the branch forward, checking each block as it goes on.
+        for applied, block in enumerate(adopted):
+            if not self.spends_valid(block["transactions"]):
+                log(f"Fork block {short_hash(block)} spends outputs it can't.")
+                self.tree.discard(block["id"])
+                self.abandon_fork(adopted[:applied], abandoned, replaced)
+                return False
+            self.update_unspent_transactions_with_block(block)
+        for block in abandoned:
+            self.undo_data.pop(block["id"], None)
+
+        del self.blocks[fork_height:]
+        self.blocks.extend(adopted)
+        for block in adopted:
+            self.index_transactions(block)
+        self.tree.switched(abandoned, adopted)
+        self.template_changed()
+        self.restore_abandoned_transactions(abandoned, adopted)
+
+        if self.store is not None:
+            self.store.truncate(fork_height)
+            for block in adopted:
+                self.store.append(block)
+        reorgs.inc()
+        reorg_depth.observe(len(abandoned))
+        log(f"Switched fork: dropped {len(abandoned)}, adopted {len(adopted)}.")
+        return True
 
-    def swap_if_longer(self, blockchain, parent):
+    def abandon_fork(self, applied, abandoned, replaced):
         """
-        Given a candidate blockchain fork and the index of its parent,
-        determine whether switching to that fork would yield a longer
-        chain; then swap it out if so.
+        Undo the fork blocks we'd applied, and put our unspent pool back how
+        it was: either re-apply the blocks we rolled back, or just restore
+        the pool they replaced.
         """
-        blocks_up_to_parent = self.blocks[: parent + 1]
-        blocks_past_parent = self.blocks[parent + 1 :]
-        if len(blockchain) > len(blocks_past_parent):
-            self.blocks = blocks_up_to_parent + list(add_hashes_to(blockchain))
-            self.loser_blockchains.append(deque(blocks_past_parent))
-            self.loser_blockchains.remove(blockchain)
+        for block in reversed(applied):
+            self.unspent_transactions.undo(self.undo_data.pop(block["id"]))
+        if replaced is not None:
+            self.unspent_transactions = replaced
+            return
+        for block in abandoned:
+            self.update_unspent_transactions_with_block(block)
+
+    def restore_abandoned_transactions(self, abandoned, adopted):
+        """
+        Put transactions from abandoned blocks back into our next block,
+        unless the new fork already includes them, and drop any which spend
+        outputs the new fork doesn't have.
+        """
+        for block in adopted:
+            self.mempool.remove_block(block)
+        self.mempool.remove_unspendable(self.unspent_transactions)
+        included = {
+            transaction["signature"]
+            for block in adopted
+            for transaction in block["transactions"]
+        }
+        for block in abandoned:
+            for transaction in block["transactions"]:
+                if transaction["signature"] in included:
+                    continue
+                if self.validate_transaction(transaction):
+                    self.mempool.add(transaction, self.transaction_fee(transaction))
+
+    @property
+    def blocks(self):
+        return self._blocks
+
+    @blocks.setter
+    def blocks(self, blocks):
+        self._blocks = [freeze_block(block) for block in blocks]
+        self.tree.reset(self._blocks)
+        self.transaction_blocks = None
+
+    def index_transactions(self, block):
+        """
+        Remember which block each of a block's transactions went into. Entries
+        for blocks a fork abandons are left behind, and ignored on lookup.
+        The index is only built once someone first asks for a proof.
+        """
+        if self.transaction_blocks is None:
+            return
+        for transaction in block["transactions"]:
+            self.transaction_blocks[transaction_digest(transaction)] = block["id"]
+
+    def transaction_proof(self, txid, confirmations=PROOF_CONFIRMATIONS):
+        """
+        A Merkle proof that a transaction is in our chain, along with the
+        headers from its block onwards, so a light client can check it without
+        the blocks. Return None if it's not in a block with a Merkle root.
+        """
+        if self.transaction_blocks is None:
+            self.transaction_blocks = {}
+            for block in self.blocks:
+                self.index_transactions(block)
+
+        height = self.tree.height_of(self.transaction_blocks.get(txid))
+        if height is None:
+            return None
+        block = self.blocks[height - 1]
+        txids = [transaction_digest(t) for t in block["transactions"]]
+        if not has_merkle_root(block) or txid not in txids:
+            return None
+
+        index = txids.index(txid)
+        headers = self.blocks[height - 1 : height - 1 + min(confirmations, MAX_HEADERS)]
+        return {
+            "index": index,
+            "branch": MerkleTree(txids).proof(index),
+            "headers": [header(block) for block in headers],
+        }
 
     @property
     def height(self):
         return len(self.blocks)
 
+    def accept_block(self, block):
+        """
+        Validate a block, checking its transactions only once, and add it to
+        our chain or our block tree. Return whether it was valid.
+        """
+        if not self.block_valid(block):
+            return False
+
+        if block["previous_block_hash"] != self.previous_block_hash:
+            # It's hashed correctly and signed, but belongs somewhere else.
+            return self.resolve_block_conflict(block)
+        if not self.spends_valid(block["transactions"]):
+            return False
+        self.update_unspent_transactions_with_block(block)
+        self.new_block(block)
+        self.mempool.remove_block(block)
+        self.template_changed()
+        return True
+
+    @staticmethod
+    def transactions_distinct(block):
+        """
+        Check no transaction appears twice. The Merkle tree pairs an odd
+        node with itself, so repeating the last transactions can leave the
+        root unchanged, and a block which is valid could look invalid.
+        """
+        txids = {transaction_digest(t) for t in block["transactions"]}
+        return len(txids) == len(block["transactions"])
+
+    @staticmethod
+    def root_matches_transactions(block):
+        """Check a block's header commits to the transactions it came with."""
+        if not has_merkle_root(block):
+            return True
+        return block.get("merkle_root") == transactions_root(block["transactions"])
+
     def handle_block_msg(self, block):
         # Validate an incoming block message.
-        if self.validate_block(block):
-            self.update_unspent_transactions_with_block(block)
-            self.new_block(block)
-            self.got_new_block = True
-            # asyncio_background(self.send_to_all(block))
+        if self.accept_block(block) and self.previous_block_id == block["id"]:
+            # Pass it on, so it reaches peers the miner isn't connected to.
+            asyncio_background(self.broadcast_block(block))
             log("Updated with new block.")
             self.print_chain()
 
-        elif self.hash_complete(block) and self.validate_transactions(
-            block["transactions"]
-        ):
-            # Note: this means only the previous block hash wasn't right;
-            # it's still hashed correctly and each transaction is valid and signed.
-            self.resolve_block_conflict(block)
+    def handle_compact_block(self, compact, source=None):
+        """
+        Rebuild a compact block from the transactions we've already received,
+        fetching only the ones we're missing, from the peer which sent it if
+        we know which.
+        """
+        if compact["id"] in self.tree.nodes:
+            return
+        known = self.mempool.by_short_id(compact["short_ids"])
+        missing = tuple(s for s in compact["short_ids"] if s not in known)
+        if missing:
+            asyncio_background(
+                self.complete_compact_block(compact, known, missing, source)
+            )
+        else:
+            self.handle_block_msg(self.rebuild_block(compact, known))
 
-    def consume_message(self, msg):
+    @staticmethod
+    def rebuild_block(compact, known):
+        block = {k: v for k, v in compact.items() if k != "short_ids"}
+        block["transactions"] = tuple(known[s] for s in compact["short_ids"])
+        return block
+
+    async def complete_compact_block(self, compact, known, missing, source=None):
+        """
+        Fetch a compact block's missing transactions, or failing that, the
+        block. The peer which sent it has both, so ask it before any other.
+        """
+        request = {"block": compact["id"], "short_ids": missing}
+        reply = await self.ask({"get_block_transactions": request}, source)
+        known.update((short_id(t), t) for t in reply["transactions"])
+        if all(s in known for s in compact["short_ids"]):
+            self.handle_block_msg(self.rebuild_block(compact, known))
+            return
+
+        reply = await self.ask({"get_blocks": [compact["id"]]}, source)
+        for block in reply["blocks"]:
+            self.handle_block_msg(block)
+
+    def block_transactions(self, request):
+        """Reply with the transactions a peer couldn't find for a compact block."""
+        wanted = set(request["short_ids"])
+        found = self.mempool.by_short_id(wanted)
+        node = self.tree.nodes.get(request["block"])
+        if node is not None and len(found) < len(wanted):
+            for transaction in node.block["transactions"]:
+                if short_id(transaction) in wanted:
+                    found.setdefault(short_id(transaction), transaction)
+        return {"transactions": list(found.values())}
+
+    def consume_message(self, msg, source=None):
         """Be a good Peer and respond to messages."""
         if "transaction" in msg:
             self.handle_transaction_msg(msg["transaction"])
+        elif "transactions" in msg:
+            self.handle_transactions_msg(msg["transactions"])
         elif "request_blockchain" in msg:
-            return {"blocks": self.blocks}
+            return self.blocks_since(msg.get("since"))
+        elif "request_snapshot" in msg:
+            return {"snapshot": self.snapshot()}
+        elif "get_headers" in msg:
+            return self.headers_after(msg["get_headers"])
+        elif "get_blocks" in msg:
+            return self.get_blocks(msg["get_blocks"])
+        elif "compact_block" in msg:
+            self.handle_compact_block(msg["compact_block"], source)
+        elif "get_block_transactions" in msg:
+            return self.block_transactions(msg["get_block_transactions"])
+        elif "get_proof" in msg:
+            request = msg["get_proof"]
+            confirmations = request.get("confirmations", PROOF_CONFIRMATIONS)
+            return {"proof": self.transaction_proof(request["txid"], confirmations)}
         elif "block" in msg:
             self.handle_block_msg(msg["block"])
         else:
@@ -219,115 +762,166 @@ class Miner(gossip.Peer):
         """Print out a minified chain of block hashes."""
         return print_blockchain(self.blocks)
 
-    def unspent(self):
-        return repr(self.unspent_transactions)
+    def unspent(self, address=None):
+        """Our unspent outputs, or just those belonging to one address."""
+        if address is None:
+            return list(self.unspent_transactions.values())
+        return list(self.unspent_transactions.outputs(address))
 
     def balances(self):
-        balances = defaultdict(int)
-        for _, amount, to in self.unspent_transactions.values():
-            balances[to.decode("utf-8")] += amount
-        return balances
+        balances = self.unspent_transactions.balances()
+        return {to.decode("utf-8"): amount for to, amount in balances.items()}
 
     def print_unspent(self):
         log("Unspent:", list(self.unspent_transactions.values()))
 
+    def append_block(self, block):
+        """Add a block which already has its hash to the tip of our chain."""
+        self.blocks.append(block)
+        self.tree.extend_main(block)
+        self.index_transactions(block)
+        if self.store is not None:
+            self.store.append(block)
+
     def new_block(self, block):
         # Todo: this method assumes block is valid.
-        self.blocks.append({**block, "hash": cryptographic_hash(block)})
+        self.append_block(freeze_block(without_hash(block)))
+        if self.store is not None and self.height % SNAPSHOT_INTERVAL == 0:
+            self.store.save_snapshot(self.snapshot())
 
     def mined_new_block(self, block):
+        # Add the mining transaction, and any transactions we received,
+        # to our unspent outputs.
+        self.update_unspent_transactions_with_block(block)
+
         # Add the block to our blockchain.
         self.new_block(block)
-
-        # Add the mining transaction to our unspent outputs.
-        mine_id, amount, addr = block["mine"]
-        mine_trx = UnspentTransaction(mine_id, amount, addr)
-        self.unspent_transactions[mine_id] = mine_trx
-        self.current_transaction_fees = 0
-        # Note: current transactions should already have been added to our unspent transactions.
-        self.current_transactions = []
+        self.mempool.remove_block(block)
+        self.template_changed()
         self.print_chain()
 
-    def get_required_transactions(self, required):
-        total = 0
-        keys = set()
-        for unspent in self.unspent_transactions.values():
-            key, amount, address = unspent
-            if address != self.address:
-                continue
-            total += amount
-            keys.add(key)
-            if total >= required:
-                break
-        else:
-            raise ValueError("Insufficient Funds!")
-        return total, keys
-
     def add_outbound_transaction(self, data):
         """Add an outgoing transaction to the next block."""
+        [result], signed_transactions = self.sign_outbound_transactions([data])
 
-        # Calculate the correct amounts for the transaction.
-        amount = sum(int(o["amount"]) for o in data["outputs"])
-        fee = int(data.get("fee", 0))
-        required = amount + fee
-        try:
-            total, keys = self.get_required_transactions(required)
-        except ValueError as e:
-            return {"error": "Insufficient funds!"}
-        change = total - required
+        # Propagate this transaction to all nodes.
+        for signed_transaction in signed_transactions:
+            asyncio_run(self.send_to_all({"transaction": signed_transaction}))
 
-        # Generate the transaction outputs, including change.
-        formatted_outputs = [
-            (str(uuid()), int(output["amount"]), str(output["address"]).encode("utf-8"))
-            for output in data["outputs"]
-        ]
-        formatted_outputs.append((str(uuid()), change, self.address))
-        transaction = {
-            "inputs": tuple(keys),
-            "outputs": formatted_outputs,
-            "from": self.address,
-        }
+        # Return a success message to our client, or why we couldn't pay.
+        return result
 
-        # Sign our transaction using our private key.
-        signed_transaction = sign_transaction(transaction, self.private_key)
+    async def submit_transactions(self, payments):
+        """
+        Add a batch of outgoing transactions to the next block from inside
+        the event loop, and broadcast them in one message. Return a result
+        for each.
+        """
+        results, signed_transactions = self.sign_outbound_transactions(payments)
+        if signed_transactions:
+            await self.send_to_all({"transactions": signed_transactions})
+        return results
 
-        # Now we add this to the next block.
-        self.current_transactions.append(signed_transaction)
+    def sign_outbound_transactions(self, payments):
+        """
+        Pay a batch of payments with one transaction, signed once: it has
+        every payment's outputs, and a single output for our change, and
+        goes into the next block. Coins are chosen in one pass over our
+        confirmed outputs, skipping any our pending payments already spend.
+        Change isn't spent until it's confirmed: peers only accept
+        transactions whose inputs are already in a block. Return a result
+        for each payment, and the transactions we signed.
+
+        Our unspent outputs stay exactly those of our chain, so the undo
+        data and snapshots made from them do too.
+        """
+        coins = deque(
+            coin
+            for coin in self.unspent_transactions.outputs(self.address)
+            if coin.id not in self.mempool.spent
+        )
+        balance = self.unspent_transactions.balance(self.address)
+        results, paid = [None] * len(payments), []
+        inputs, outputs, total, required, fee = [], [], 0, 0, 0
+        for n, data in enumerate(payments):
+            try:
+                payment_outputs, payment_fee = self.payment_outputs(data)
+            except (AttributeError, KeyError, TypeError, ValueError):
+                results[n] = {"error": "Malformed payment"}
+                continue
 
-        # Delete inputs from our unspent transactions pool.
-        for input_ in keys:
-            del self.unspent_transactions[input_]
+            # Take coins until they cover this payment too.
+            needed = required + sum(o[1] for o in payment_outputs) + payment_fee
+            while coins and (total < needed or not inputs):
+                coin = coins.popleft()
+                inputs.append(coin)
+                total += coin.amount
+            if total < needed or not inputs:
+                results[n] = self.unfunded_error(needed, balance)
+                continue
 
-        # Also keep track of how big our transaction fees are.
-        self.current_transaction_fees += fee
+            outputs.extend(payment_outputs)
+            required, fee = needed, fee + payment_fee
+            paid.append(n)
+        if not paid:
+            return results, []
 
-        # Add this transaction to our unspent transactions.
-        for output in transaction["outputs"]:
-            output_id, _, _ = output
-            self.unspent_transactions[output_id] = output
+        # Pay ourselves any change; outputs of nothing aren't valid.
+        change = total - required
+        if change:
+            outputs.append((str(uuid()), change, self.address))
+        transaction = {
+            "inputs": tuple(coin.id for coin in inputs),
+            "outputs": outputs,
+            "from": self.address,
+        }
 
-        # Propagate this transaction to all nodes.
-        asyncio_run(self.send_to_all({"transaction": signed_transaction}))
+        # Sign our transaction using our private key, and add it to the next
+        # block, keeping track of its fee.
+        signed_transaction = sign_transaction(transaction, self.private_key)
+        if not self.mempool.add(signed_transaction, fee):
+            for n in paid:
+                results[n] = {"error": "Rejected by mempool"}
+            return results, []
+        for n in paid:
+            results[n] = {"msg": "OK"}
+        self.template_changed()
+        return results, [signed_transaction]
+
+    @staticmethod
+    def payment_outputs(data):
+        """The outputs a payment asks for, and the fee it offers."""
+        outputs = [
+            (str(uuid()), int(output["amount"]), str(output["address"]).encode("utf-8"))
+            for output in data["outputs"]
+        ]
+        return outputs, int(data.get("fee", 0))
 
-        # Return a success message to our client.
-        return {"msg": "OK"}
+    @staticmethod
+    def unfunded_error(needed, balance):
+        """Why we can't pay: we're short, or our coins await pending payments."""
+        if needed > balance:
+            return {"error": "Insufficient funds!"}
+        return {"error": "No unreserved coins: wait for pending payments to confirm"}
 
     def validate_transaction(self, transaction):
-        # Note: we don't have to worry about transactions inside
-        # one block interacting with each other. Later, we'll
-        # require a certain number of confirmations for inputs
-        # before transactions are accepted.
-
         # First, check the cryptographic signature is correct.
         if not verify_transaction(transaction):
             return
+        return self.check_transaction_inputs(transaction)
 
-        # Next check all outputs actually belong to the right address.
+    def check_transaction_inputs(self, transaction, unspent=None):
+        # Inputs must be unspent in our chain, or in `unspent` if given:
+        # a view of it partway through a block.
+        if unspent is None:
+            unspent = self.unspent_transactions
+
+        # Check all outputs actually belong to the right address.
         input_transactions = []
         for input_id in transaction["inputs"]:
 
             # Check we have a record of every unspent transaction used.
-            input_transaction = self.unspent_transactions.get(input_id, None)
+            input_transaction = unspent.get(input_id, None)
             if input_transaction is None:
                 return False
 
@@ -355,8 +949,42 @@ class Miner(gossip.Peer):
 
         return True
 
+    def transaction_fee(self, transaction):
+        """What's left over from a transaction's inputs after its outputs."""
+        inputs = (self.unspent_transactions[i] for i in transaction["inputs"])
+        input_total = sum(t.amount for t in inputs)
+        return input_total - sum(t[1] for t in transaction["outputs"])
+
     def validate_transactions(self, transactions):
-        return all(self.validate_transaction(t) for t in transactions)
+        # Check every signature in one batch before touching our unspent pool.
+        return verify_transactions(transactions) and self.spends_valid(transactions)
+
+    def spends_valid(self, transactions):
+        """
+        Check a block's transactions against our unspent outputs, in order,
+        so each may spend outputs made before it in the block, but no
+        output can be spent twice.
+        """
+        view = UtxoView(self.unspent_transactions)
+        for transaction in transactions:
+            if not self.check_transaction_inputs(transaction, view):
+                return False
+            view.apply_transaction(transaction)
+        return True
+
+    def invalid_spends(self, transactions):
+        """
+        Like spends_valid, but return every transaction which can't go in,
+        skipping each as if it weren't there.
+        """
+        view = UtxoView(self.unspent_transactions)
+        invalid = []
+        for transaction in transactions:
+            if self.check_transaction_inputs(transaction, view):
+                view.apply_transaction(transaction)
+            else:
+                invalid.append(transaction)
+        return invalid
 
     @property
     def previous_block_id(self):
@@ -364,12 +992,15 @@ class Miner(gossip.Peer):
             return self.blocks[-1]["id"]
         return 0
 
-    def mine_one_block(self):
+    def block_template(self):
+        """A block on our tip holding our best pending transactions."""
+        transactions, fees = self.mempool.template()
         # Note: each sub-key needs to be hashable.
-        fees = self.current_transaction_fees
-        block = {
+        return {
+            "version": BLOCK_VERSION,
             "id": str(uuid()),
-            "transactions": (),
+            "transactions": transactions,
+            "merkle_root": self.mempool.merkle.root,
             "mine": (str(uuid()), self.mining_reward + fees, self.address),
             "timestamp": int(time.time()),
             "previous_block": self.previous_block_id,
@@ -377,29 +1008,79 @@ class Miner(gossip.Peer):
             "nonce": 0,
         }
 
-        # Try to mine a block by incrementing the nonce.
-        for block["nonce"] in count():
-            # Exit early if we've got a new previous-block.
-            if self.got_new_block:
-                self.got_new_block = False
-                return
+    def template_changed(self):
+        """
+        Our tip or our pending transactions changed, so once this turn of the
+        event loop is over, hand the mining thread a fresh template.
+        """
+        if self.mining and not self.template_pending:
+            self.template_pending = True
+            self.loop.call_soon(self.publish_template)
 
-            # Update our list of transactions.
-            transactions = tuple(self.current_transactions)
-            block["transactions"] = transactions
-
-            # Update the reward with any new fees.
-            uid, _, addr = block["mine"]
-            fees = self.current_transaction_fees
-            block["mine"] = (uid, self.mining_reward + fees, addr)
-
-            # Check if we've successfully mined a block.
-            if self.hash_complete(block):
-                log("Mined new block.")
-                self.mined_new_block(block)
-                # Send our new block to every connected client.
-                asyncio_run(self.send_to_all({"block": block}))
-                break
+    def publish_template(self):
+        """Replace whatever template the mining thread hasn't picked up yet."""
+        self.template_pending = False
+        if self.mining:
+            self.publish(self.block_template())
+
+    def publish(self, block):
+        try:
+            self.templates.get_nowait()
+        except queue.Empty:
+            pass
+        self.templates.put(block)
+
+    def found_block(self, block):
+        """
+        Add a block we mined to our chain, unless our tip has moved on since
+        we started on it, or it spends outputs we don't have, just as we'd
+        check a peer's block. Then its bad transactions leave the mempool,
+        and the next template goes without them. Return whether it was added.
+        """
+        if block["previous_block_hash"] != self.previous_block_hash:
+            log("Mined a block on an old tip; discarding it.")
+            return False
+        invalid = self.invalid_spends(block["transactions"])
+        if invalid:
+            log(
+                f"Mined a block with {len(invalid)} invalid transactions; discarding it."
+            )
+            for transaction in invalid:
+                self.mempool.remove(transaction_digest(transaction))
+            self.template_changed()
+            return False
+        log("Mined new block.")
+        self.mined_new_block(block)
+        return True
+
+    def broadcast_block(self, block):
+        """
+        Send our new block to every connected client. Peers have most of its
+        transactions already, so send short IDs in place of them.
+        """
+        return self.send_to_all(
+            {"compact_block": compact_block(block)}, fallback={"block": block}
+        )
+
+    def on_block_found(self, block):
+        """Called on the event loop when the mining thread solves a block."""
+        if self.found_block(block):
+            asyncio_background(self.broadcast_block(block))
+
+    def mine_one_block(self):
+        """
+        Mine one block on our tip right here, without the mining thread. If
+        it can't go on our chain, it's mined again without the transactions
+        which stopped it.
+        """
+        while True:
+            block = self.block_template()
+            with metrics.profiler.section("mine_one_block"):
+                nonce = self.mining_backend.search(block, self.target, lambda: False)
+            block["nonce"] = nonce
+            if self.found_block(block):
+                asyncio_run(self.broadcast_block(block))
+                return
 
     @property
     def address(self):
@@ -413,30 +1094,58 @@ class Miner(gossip.Peer):
             return 0
         return self.blocks[-1]["hash"]
 
+    @property
+    def target(self):
+        """A block is mined once its hash is below this number."""
+        return 1 << (512 - self._difficulty)
+
     def hash_complete(self, block):
-        block_hash = cryptographic_hash(block)
-        return block_hash < 1 << (512 - self._difficulty)
+        return cryptographic_hash(block) < self.target
 
     @property
     def difficulty(self):
         return 2 << self._difficulty
 
     def mine(self):
-        # Inside a thread, we need a new asyncio event loop.
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-
+        """
+        The mining thread. Search each template we're handed until it's solved
+        or a newer one arrives, and pass solutions back to the event loop,
+        which owns our chain.
+        """
+        while True:
+            block = self.templates.get()
+            if block is None:
+                return
+            with metrics.profiler.section("mine_one_block"):
+                nonce = self.mining_backend.search(
+                    block, self.target, lambda: not self.templates.empty()
+                )
+            if nonce is not None:
+                block["nonce"] = nonce
+                self.loop.call_soon_threadsafe(self.on_block_found, block)
+
+    async def start_mining(self):
+        """Catch up with the network, then start the mining thread."""
         if "--gen" not in sys.argv:
-            asyncio_run(
-                self.request_from_random(get_blockchain(), self.update_blockchain)
-            )
+            if "--snapshot" in sys.argv and not self.blocks:
+                await self.request_from_random(
+                    {"request_snapshot": True},
+                    lambda reply: self.use_snapshot(reply["snapshot"]),
+                )
+            await self.sync()
+
+        self.loop = asyncio.get_event_loop()
+        self.mining = True
+        Thread(target=self.mine, daemon=True).start()
+        self.publish_template()
 
-        while True:
-            self.mine_one_block()
-            # time.sleep(5)
+    def stop_mining(self):
+        """Have the mining thread finish, in place of its next template."""
+        self.mining = False
+        self.publish(None)
 
     def start_worker(self):
-        Thread(target=self.mine, daemon=True).start()
+        asyncio.ensure_future(self.start_mining())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,176 @@
+"""
+Nonce search backends for the miner.
+
+A backend takes a block template and a target, and tries nonces until the
+block's hash falls below the target or the caller asks it to stop.
+"""
+
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from itertools import count
+
+from hashing import (
+    cryptographic_hash,
+    block_prefix,
+    is_legacy,
+    nonce_digest,
+    target_digest,
+)
+
+# How many nonces a worker tries before reporting back to the parent.
+BATCH_SIZE = 5000
+
+
+def search_nonces(prefix, start, stop, target):
+    """
+    Try every nonce in range(start, stop) after an encoded block prefix.
+    Return a tuple of the winning nonce (or None) and the number of
+    hashes tried.
+    """
+    hasher = hashlib.sha512(prefix)
+    target = target_digest(target)
+    for nonce in range(start, stop):
+        if nonce_digest(hasher, nonce) < target:
+            return nonce, nonce - start + 1
+    return None, stop - start
+
+
+def search_legacy_nonces(block, start, stop, target):
+    """Like search_nonces, but re-hashing a whole unversioned block each time."""
+    block = dict(block)
+    for nonce in range(start, stop):
+        block["nonce"] = nonce
+        if cryptographic_hash(block) < target:
+            return nonce, nonce - start + 1
+    return None, stop - start
+
+
+def search_args(block):
+    """Pick the search function for a block, and the template to pass it."""
+    if is_legacy(block):
+        return search_legacy_nonces, dict(block)
+    return search_nonces, block_prefix(block)
+
+
+class MiningBackend:
+    """
+    Abstract base class for nonce search strategies. Keeps track of
+    how many hashes were tried so the hash rate can be reported.
+    """
+
+    def __init__(self):
+        self.hashes = 0
+        self.elapsed = 0.0
+
+    @property
+    def hash_rate(self):
+        """Hashes per second over every search run so far."""
+        if not self.elapsed:
+            return 0.0
+        return self.hashes / self.elapsed
+
+    def search(self, block, target, interrupted):
+        """
+        Search for a nonce which makes the block's hash less than target.
+        Return the nonce, or None if `interrupted()` became true first.
+        """
+        start = time.perf_counter()
+        try:
+            return self._search(block, target, interrupted)
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def _search(self, block, target, interrupted):
+        raise NotImplementedError("MiningBackend._search")
+
+    def shutdown(self):
+        pass
+
+
+class SerialBackend(MiningBackend):
+    """Try nonces in batches on the calling thread."""
+
+    def __init__(self, batch_size=BATCH_SIZE):
+        super().__init__()
+        self.batch_size = batch_size
+
+    def _search(self, block, target, interrupted):
+        search, template = search_args(block)
+        for batch in count():
+            if interrupted():
+                return None
+            start = batch * self.batch_size
+            nonce, tried = search(template, start, start + self.batch_size, target)
+            self.hashes += tried
+            if nonce is not None:
+                return nonce
+
+
+class ProcessPoolBackend(MiningBackend):
+    """
+    Split the nonce space across a pool of worker processes, one per core.
+    Each batch handed out covers a disjoint nonce range, and the parent
+    checks `interrupted()` whenever a batch comes back.
+    """
+
+    def __init__(self, workers=None, batch_size=BATCH_SIZE):
+        super().__init__()
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self._executor = None
+
+    @property
+    def executor(self):
+        # Start the pool lazily, so nodes which never mine don't fork.
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def _search(self, block, target, interrupted):
+        search, template = search_args(block)
+        next_start = count(0, self.batch_size)
+        pending = set()
+
+        def submit():
+            start = next(next_start)
+            stop = start + self.batch_size
+            pending.add(self.executor.submit(search, template, start, stop, target))
+
+        # Keep one batch queued behind each running batch so workers never idle.
+        for _ in range(self.workers * 2):
+            submit()
+
+        try:
+            while True:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    nonce, tried = future.result()
+                    self.hashes += tried
+                    if nonce is not None:
+                        return nonce
+                if interrupted():
+                    return None
+                for _ in done:
+                    submit()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def shutdown(self):
+        if self._executor is not None:
+            try:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            except TypeError:
+                # Before Python 3.9, queued batches run to completion.
+                self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+def default_backend():
+    """Use every core unless there's only one to use."""
+    if (os.cpu_count() or 1) > 1:
+        return ProcessPoolBackend()
+    return SerialBackend()
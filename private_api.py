@@ -1,41 +1,235 @@
-import logging
+"""
+A small HTTP/1.1 server for the node's private API, running on the node's
+own event loop. Each connection carries one request, and GET responses are
+cached until the chain tip or the mempool changes.
+"""
+
 import asyncio
-from flask import Flask, jsonify, request
-from threading import Thread
+import json
+from collections import OrderedDict
+from collections.abc import Mapping
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import codec
+import metrics
+from signing import signature_cache
+
+HOST = "127.0.0.1"
+
+# The most outputs one page of /unspent may hold, and the default.
+MAX_PAGE_SIZE = 1000
+DEFAULT_PAGE_SIZE = 100
+
+# How many cached responses we keep for the current chain tip.
+CACHE_SIZE = 256
+
+# Requests bigger than this are turned away.
+MAX_BODY_SIZE = 10_000_000
+
+METRICS_TYPE = "text/plain; version=0.0.4"
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or REASONS[status])
+        self.status = status
+
+
+def jsonable(value):
+    """Hex-encode any bytes in a value, so it can be sent as JSON."""
+    if isinstance(value, bytes):
+        return value.hex()
+    if isinstance(value, Mapping):
+        return {key: jsonable(item) for key, item in value.items()}
+    if isinstance(value, (tuple, list)):
+        return [jsonable(item) for item in value]
+    return value
+
+
+def json_response(value):
+    return "application/json", json.dumps(jsonable(value)).encode("utf-8")
+
+
+class ResponseCache:
+    """Response bodies for one chain tip, dropped as soon as the tip moves."""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.tip = None
+        self.responses = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tip, key, respond):
+        if tip != self.tip:
+            self.tip = tip
+            self.responses.clear()
+        if key in self.responses:
+            self.hits += 1
+            self.responses.move_to_end(key)
+            return self.responses[key]
+        self.misses += 1
+        response = self.responses[key] = respond()
+        if len(self.responses) > self.size:
+            self.responses.popitem(last=False)
+        return response
 
 
 class Api:
     def __init__(self, port, miner):
         self.port = port
         self.miner = miner
+        self.cache = ResponseCache()
+        self.get_routes = {
+            "/unspent": self.get_unspent,
+            "/balances": self.get_balances,
+            "/headers": self.get_headers,
+            "/proof": self.get_proof,
+        }
+        self.post_routes = {
+            "/transaction": self.add_transaction,
+            "/transactions": self.add_transactions,
+        }
+
+    def tip(self):
+        """What cached responses depend on: our chain, and our pending payments."""
+        return self.miner.previous_block_hash, self.miner.mempool.version
+
+    def get_unspent(self, query, argument=None):
+        address = query.get("address")
+        try:
+            offset = int(query.get("offset", 0))
+            limit = min(int(query.get("limit", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        except ValueError:
+            raise HttpError(400)
+        if offset < 0 or limit < 0:
+            raise HttpError(400)
+        outputs = self.miner.unspent(address and address.encode("utf-8"))
+        page = [
+            {"id": i, "amount": amount, "address": to.decode("utf-8")}
+            for i, amount, to in outputs[offset : offset + limit]
+        ]
+        return json_response({"unspent": page, "total": len(outputs)})
+
+    def get_balances(self, query, argument=None):
+        return json_response({"balances": self.miner.balances()})
+
+    def get_headers(self, query, argument=None):
+        since = query.get("since")
+        return json_response(self.miner.headers_after([since] if since else []))
+
+    def get_proof(self, query, txid=None):
+        """
+        A Merkle proof for a transaction. Light clients can ask for the codec
+        encoding, to re-hash headers exactly as the node did.
+        """
+        try:
+            txid = bytes.fromhex(txid or "")
+            args = (int(query["confirmations"]),) if "confirmations" in query else ()
+        except ValueError:
+            raise HttpError(400)
+        proof = self.miner.transaction_proof(txid, *args)
+        if proof is None:
+            raise HttpError(404)
+        if query.get("format") == "codec":
+            return "application/octet-stream", codec.encode(proof)
+        return json_response({"proof": proof})
+
+    async def add_transaction(self, data):
+        [result] = await self.miner.submit_transactions([data])
+        return json_response(result)
+
+    async def add_transactions(self, data):
+        """Sign and broadcast a batch of payments, with a result for each."""
+        payments = data.get("payments") if isinstance(data, dict) else None
+        if not isinstance(payments, list):
+            raise HttpError(400, 'Expected {"payments": [...]}')
+        results = await self.miner.submit_transactions(payments)
+        return json_response({"results": results})
 
-    def setup_routes(self, app):
-        @app.route("/transaction", methods=["POST"])
-        def add_transaction():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            data = request.get_json()
-            return jsonify(self.miner.add_outbound_transaction(data))
+    async def respond(self, method, target, body):
+        """Route a request, returning its content type and body."""
+        url = urlsplit(target)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        route, _, argument = url.path.rstrip("/").partition("/")[2].partition("/")
+        route = "/" + route
 
-        @app.route("/unspent")
-        def get_unspent():
-            return jsonify(unspent=self.miner.unspent())
+        if method == "GET" and route == "/signature_cache":
+            return json_response({"signature_cache": signature_cache.stats()})
+        if method == "GET" and route == "/metrics":
+            return METRICS_TYPE, metrics.registry.render().encode("utf-8")
+        if method == "GET" and route == "/profile":
+            return "text/plain", metrics.profiler.collapsed().encode("utf-8")
+        if method == "GET" and route in self.get_routes:
+            handler = self.get_routes[route]
+            return self.cache.get(
+                self.tip(), target, lambda: handler(query, unquote(argument))
+            )
+        if method == "POST" and route in self.post_routes:
+            try:
+                data = json.loads(body)
+            except ValueError:
+                raise HttpError(400, "Expected a JSON body")
+            return await self.post_routes[route](data)
+        if route in self.get_routes or route in self.post_routes:
+            raise HttpError(405)
+        raise HttpError(404)
 
-        @app.route("/balances")
-        def get_balances():
-            return jsonify(balances=self.miner.balances())
+    async def handle_connection(self, reader, writer):
+        try:
+            status = 200
+            try:
+                method, target, body = await self.read_request(reader)
+                content_type, content = await self.respond(method, target, body)
+            except HttpError as e:
+                status = e.status
+                content_type, content = json_response({"error": str(e)})
+            writer.write(
+                (
+                    f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(content)}\r\n"
+                    "Connection: close\r\n\r\n"
+                ).encode("latin-1")
+                + content
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
 
-    def setup_logging(self):
-        logger = logging.getLogger("werkzeug")
-        logger.disabled = True
+    @staticmethod
+    async def read_request(reader):
+        try:
+            request_line = await reader.readuntil(b"\r\n")
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = (await reader.readuntil(b"\r\n")).decode("latin-1")
+                if line == "\r\n":
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+        except (ValueError, asyncio.LimitOverrunError):
+            raise HttpError(400)
+        if length > MAX_BODY_SIZE:
+            raise HttpError(413)
+        body = await reader.readexactly(length) if length > 0 else b""
+        return method, target, body
 
-    def run_app(self):
-        app = Flask(__name__)
-        self.setup_routes(app)
-        self.setup_logging()
-        app.run(port=self.port, use_reloader=False)
+    async def start(self):
+        return await asyncio.start_server(self.handle_connection, HOST, self.port)
 
     def run(self):
-        thread = Thread(target=self.run_app, daemon=True)
-        thread.start()
-        print(f"Flask server listening on port {self.port}")
+        asyncio.get_event_loop().run_until_complete(self.start())
+        print(f"API server listening on port {self.port}")
@@ -0,0 +1,185 @@
+"""
+Compact, immutable records for the blocks and transactions in our chain.
+
+A record reads like the dict it was made from, so code which indexes
+blocks by key doesn't care which it has, and it encodes to exactly the
+same canonical bytes. Each field is kept in a slot rather than a
+per-object dict, and blocks work out their hash, and transactions their
+digest, once. Transactions also share the strings and addresses they
+repeat: output IDs come back as the inputs which spend them, and a
+handful of addresses turn up in most outputs.
+
+Unspent outputs are already namedtuples (see utxo.py), which carry no
+per-object dict either.
+"""
+
+import sys
+from collections.abc import Mapping
+
+import codec
+from hashing import cryptographic_hash, encode_block, is_legacy
+from signing import transaction_digest
+
+# Stands in for a key a record was made without.
+MISSING = object()
+
+# Addresses we've seen, so each is only kept once however often it's paid.
+# bytes can't be interned like str, and this stops growing once it's full.
+MAX_ADDRESSES = 100_000
+_addresses = {}
+
+
+def share(value):
+    """The shared copy of an ID or address, if it is one."""
+    if type(value) is str:
+        return sys.intern(value)
+    if type(value) is bytes:
+        shared = _addresses.get(value)
+        if shared is not None:
+            return shared
+        if len(_addresses) < MAX_ADDRESSES:
+            _addresses[value] = value
+    return value
+
+
+def share_items(items):
+    """A tuple or list like `items`, sharing each of its IDs and addresses."""
+    if type(items) in (tuple, list):
+        return type(items)(map(share, items))
+    return items
+
+
+class Record(Mapping):
+    """A read-only mapping with a fixed set of keys, each kept in a slot."""
+
+    __slots__ = ()
+
+    # Each key a record may have, and the slot its value is kept in.
+    FIELDS = {}
+
+    def __init__(self, fields):
+        for key, slot in self.FIELDS.items():
+            object.__setattr__(self, slot, fields.get(key, MISSING))
+
+    @classmethod
+    def fits(cls, fields):
+        """Whether a record can hold every key of a dict."""
+        return all(key in cls.FIELDS for key in fields)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __getitem__(self, key):
+        slot = self.FIELDS.get(key)
+        value = MISSING if slot is None else getattr(self, slot)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        for key, slot in self.FIELDS.items():
+            if getattr(self, slot) is not MISSING:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        # PyON sends values as their repr, so look just like a dict.
+        return repr(self.to_dict())
+
+    def __reduce__(self):
+        return type(self), (self.to_dict(),)
+
+    def _set(self, slot, value):
+        object.__setattr__(self, slot, value)
+
+    def to_dict(self):
+        return dict(self)
+
+
+class Transaction(Record):
+    FIELDS = {
+        "inputs": "inputs",
+        "outputs": "outputs",
+        "from": "sender",
+        "signature": "signature",
+    }
+    __slots__ = (*FIELDS.values(), "digest")
+
+    def __init__(self, fields):
+        super().__init__(fields)
+        self._set("inputs", share_items(self.inputs))
+        if type(self.outputs) in (tuple, list):
+            outputs = map(share_items, self.outputs)
+            self._set("outputs", type(self.outputs)(outputs))
+        self._set("sender", share(self.sender))
+        self._set("digest", transaction_digest(fields))
+
+    @property
+    def encoded(self):
+        """Canonical bytes for the transaction; its digest is their SHA256."""
+        return codec.encode(self)
+
+
+class Block(Record):
+    FIELDS = {
+        "version": "version",
+        "id": "id",
+        "transactions": "transactions",
+        "merkle_root": "merkle_root",
+        "mine": "mine",
+        "timestamp": "timestamp",
+        "previous_block": "previous_block",
+        "previous_block_hash": "previous_block_hash",
+        "nonce": "nonce",
+        "hash": "hash",
+    }
+    __slots__ = tuple(FIELDS.values())
+
+    def __init__(self, fields):
+        super().__init__(fields)
+        if type(self.transactions) in (tuple, list):
+            # Keep the container type: it's part of some blocks' hash input.
+            transactions = map(freeze_transaction, self.transactions)
+            self._set("transactions", type(self.transactions)(transactions))
+        self._set("mine", share_items(self.mine))
+        if self.hash is MISSING:
+            self._set("hash", cryptographic_hash(self))
+
+    @property
+    def encoded(self):
+        """Canonical bytes for everything the block's hash covers."""
+        return encode_block(self)
+
+    def to_dict(self):
+        block = dict(self)
+        if type(self.transactions) in (tuple, list):
+            block["transactions"] = type(self.transactions)(
+                t.to_dict() if isinstance(t, Record) else t for t in self.transactions
+            )
+        return block
+
+
+def freeze_transaction(transaction):
+    if isinstance(transaction, dict) and Transaction.fits(transaction):
+        return Transaction(transaction)
+    return transaction
+
+
+def freeze_block(block):
+    """
+    A block, with its hash, as a Block record. Legacy blocks are hashed
+    through the repr() of their dicts, so they stay dicts. Anything which
+    isn't a dict, like a record or a block read lazily from disk, is kept.
+    """
+    if not isinstance(block, dict):
+        return block
+    if is_legacy(block) or not Block.fits(block):
+        if "hash" in block:
+            return block
+        return {**block, "hash": cryptographic_hash(block)}
+    return Block(block)
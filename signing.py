@@ -1,55 +1,175 @@
+import hashlib
+import os
 import secrets
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from threading import Lock
 
 from nacl import encoding, signing
 from nacl.exceptions import BadSignatureError, ValueError as CryptoValueError
 
+import codec
+import metrics
 
-def generate_keypair():
-    seed = secrets.token_bytes(32)
+
+def generate_keypair(seed=None):
+    """A new signing key, and its verify key in hex. Pass a seed to repeat it."""
+    if seed is None:
+        seed = secrets.token_bytes(32)
     signing_key = signing.SigningKey(seed)
     verify_key = signing_key.verify_key
     verify_key_hex = verify_key.encode(encoding.HexEncoder)
     return signing_key, verify_key_hex
 
 
+# Signatures cover the repr() of a transaction, which depends on the order
+# of its keys. The binary wire sorts them, so always sign and verify with
+# the keys in the order transactions are built in, then any others sorted.
+SIGNED_KEY_ORDER = ("inputs", "outputs", "from")
+
+
 def encode(transaction):
-    return repr(transaction).encode("utf-8")
+    """The bytes a transaction's signature covers, whatever its key order."""
+    keys = [key for key in SIGNED_KEY_ORDER if key in transaction]
+    keys += sorted((key for key in transaction if key not in keys), key=repr)
+    return repr({key: transaction[key] for key in keys}).encode("utf-8")
+
+
+def transaction_digest(transaction):
+    """A digest of the canonical encoding of a whole (signed) transaction."""
+    # Transaction records work theirs out once, up front.
+    digest = getattr(transaction, "digest", None)
+    if digest is not None:
+        return digest
+    return hashlib.sha256(codec.encode(transaction)).digest()
+
+
+class SignatureCache:
+    """
+    A bounded LRU set of digests of transactions whose signatures we've
+    already checked, so a transaction seen first on its own and then again
+    inside a block is only verified once.
+    """
+
+    def __init__(self, maxsize=100_000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._digests = OrderedDict()
+        self._lock = Lock()
+
+    def __contains__(self, digest):
+        with self._lock:
+            if digest in self._digests:
+                self._digests.move_to_end(digest)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def __len__(self):
+        return len(self._digests)
+
+    def add(self, digest):
+        with self._lock:
+            self._digests[digest] = True
+            self._digests.move_to_end(digest)
+            while len(self._digests) > self.maxsize:
+                self._digests.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._digests.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+signature_cache = SignatureCache()
+
+verifications = metrics.counter(
+    "signature_verifications_total",
+    "Ed25519 signatures checked, not counting signature cache hits.",
+)
 
 
 def sign_transaction(transaction, signing_key):
     trx_bytes = encode(transaction)
     signed = signing_key.sign(trx_bytes)
     signature = signed.signature
-    return {**transaction, "signature": signature}
+    signed_transaction = {**transaction, "signature": signature}
+    # We just made this signature, so there's no need to check it later.
+    signature_cache.add(transaction_digest(signed_transaction))
+    return signed_transaction
 
 
 def strip_key(d, key):
     return {k: v for k, v in d.items() if k != key}
 
 
+# Blocks with fewer transactions than this aren't worth a trip to the pool.
+PARALLEL_THRESHOLD = 16
+
+_executor = None
+
+
+@lru_cache(maxsize=4096)
+def verify_key(verify_key_hex):
+    """Decode a hex public key once, rather than for every transaction it signs."""
+    return signing.VerifyKey(verify_key_hex, encoder=encoding.HexEncoder)
+
+
 def verify_transaction(transaction):
     try:
-        key = signing.VerifyKey(transaction["from"], encoder=encoding.HexEncoder)
-    except CryptoValueError:
+        digest = transaction_digest(transaction)
+    except (TypeError, ValueError):
+        # Nothing the codec can't encode was ever signed.
+        return False
+    if digest in signature_cache:
+        return True
+
+    try:
+        key = verify_key(transaction["from"])
+    except (KeyError, TypeError, CryptoValueError):
         return False
-    except TypeError:
-        breakpoint()
 
-    signature = transaction["signature"]
+    signature = transaction.get("signature")
     unsigned_transaction = strip_key(transaction, "signature")
-    encoded_transaction = encode(unsigned_transaction)
 
+    verifications.inc()
     try:
-        return key.verify(encoded_transaction, signature)
-    except BadSignatureError:
+        key.verify(encode(unsigned_transaction), signature)
+    except (BadSignatureError, CryptoValueError, TypeError):
         return False
+    signature_cache.add(digest)
+    return True
+
+
+def executor():
+    """
+    A shared thread pool for checking signatures. libsodium releases the
+    GIL while it verifies, so threads really do run in parallel here.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+    return _executor
 
 
-if __name__ == "__main__":
-    key, verify_key_hex = generate_keypair()
-    transaction = {"amount": 1000, "to": "Bob", "from": verify_key_hex}
-    signed_transaction = sign_transaction(transaction, key)
-    assert verify_transaction(signed_transaction)
-    signed_transaction["amount"] += 100
-    assert not verify_transaction(signed_transaction)
-    print("• Passed tests •")
+def verify_transactions(transactions):
+    """Verify a whole block's worth of transactions at once."""
+    transactions = list(transactions)
+    if len(transactions) < PARALLEL_THRESHOLD:
+        return all(map(verify_transaction, transactions))
+    return all(executor().map(verify_transaction, transactions))
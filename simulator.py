@@ -0,0 +1,354 @@
+"""
+Run a whole network of nodes in one process, over a fake transport with
+configurable latency, bandwidth and partitions, and report how quickly
+blocks propagate, how many end up orphaned, and how much each node sends.
+
+Usage: python simulator.py [--nodes N] [--peers N] [--blocks N]
+    [--interval SECONDS] [--latency SECONDS] [--bandwidth BYTES_PER_SECOND]
+    [--payments N] [--partition 1] [--trials N] [--processes N] [--seed N]
+
+Independent trials, each with its own seed, can be spread over a small
+process pool with --processes.
+"""
+
+import asyncio
+import contextlib
+import json
+import math
+import os
+import random
+import statistics
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import miner
+import wire
+from gossip import Server, argument
+from mining import SerialBackend
+
+DEFAULTS = {
+    "nodes": 30,
+    # Each node opens connections to this many others, and accepts theirs.
+    "peers": 4,
+    "blocks": 20,
+    # Seconds between blocks, one-way latency, and each node's upload speed.
+    "interval": 0.2,
+    "latency": 0.02,
+    "bandwidth": 1_000_000,
+    # Nodes which make a payment before each block.
+    "payments": 5,
+    # Whether to split the network in two for the middle third of the blocks.
+    "partition": 0,
+    "difficulty": 4,
+    "seed": 0,
+    "trials": 1,
+    "processes": 1,
+}
+
+# After a partition heals, nodes not on the best tip re-sync up to this
+# many times, each time from a random peer.
+SYNC_ROUNDS = 5
+
+
+class FakeNetwork:
+    """Carries messages between in-process Servers, after a simulated delay."""
+
+    def __init__(self, latency, bandwidth):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.servers = {}
+        self.groups = None
+        self.bytes_sent = Counter()
+        self.bytes_received = Counter()
+        self._uplink_free = {}
+
+    def reachable(self, source, target):
+        return self.groups is None or self.groups[source] == self.groups[target]
+
+    def partition(self, *groups):
+        """Only let nodes talk to others in the same group."""
+        self.groups = {url: n for n, group in enumerate(groups) for url in group}
+
+    def heal(self):
+        self.groups = None
+
+    async def carry(self, source, target, msg):
+        """
+        Wait as long as a message takes to get from source to target. Each
+        node's uplink sends one message at a time at the network bandwidth.
+        """
+        if not self.reachable(source, target):
+            raise ConnectionResetError(f"{source} can't reach {target}")
+        size = len(msg)
+        self.bytes_sent[source] += size
+        self.bytes_received[target] += size
+
+        now = asyncio.get_event_loop().time()
+        sent_at = max(now, self._uplink_free.get(source, now)) + size / self.bandwidth
+        self._uplink_free[source] = sent_at
+        await asyncio.sleep(sent_at - now + self.latency)
+
+    def connector(self, source):
+        """A connect function for one node, to pass to its Server."""
+
+        async def connect(url):
+            if url not in self.servers or not self.reachable(source, url):
+                raise ConnectionRefusedError(url)
+            return FakeWebsocket(self, source, url)
+
+        return connect
+
+
+class FakeWebsocket:
+    """A simulated connection, opened by source to target."""
+
+    def __init__(self, network, source, target):
+        self.network = network
+        self.source = source
+        self.target = target
+        self.replies = asyncio.Queue()
+
+    async def send(self, msg):
+        await self.network.carry(self.source, self.target, msg)
+        await self.network.servers[self.target].respond(FakeReplies(self), msg)
+
+    async def recv(self):
+        return await self.replies.get()
+
+    async def close(self):
+        pass
+
+
+class FakeReplies:
+    """The far end of a FakeWebsocket, which sends replies back along it."""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+
+    async def send(self, msg):
+        websocket = self.websocket
+        await websocket.network.carry(websocket.target, websocket.source, msg)
+        await websocket.replies.put(msg)
+
+
+class SimulatedMiner(miner.Miner):
+    """A Miner which notes when each block first reaches it."""
+
+    url = None
+    arrivals = None
+
+    def accept_block(self, block):
+        times = self.arrivals.setdefault(block["id"], {})
+        times.setdefault(self.url, asyncio.get_event_loop().time())
+        return super().accept_block(block)
+
+
+class Simulation:
+    def __init__(self, params):
+        self.params = params
+        self.rng = random.Random(params["seed"])
+        self.network = FakeNetwork(params["latency"], params["bandwidth"])
+        self.arrivals = {}
+        self.mined = {}
+        self.servers = []
+        self.links = set()
+        self.failures = Counter()
+        for n in range(params["nodes"]):
+            url = f"sim://node-{n}"
+            server = Server(SimulatedMiner, url, self.network.connector(url))
+            node = server.worker
+            node.url = url
+            node.arrivals = self.arrivals
+            node._difficulty = params["difficulty"]
+            node.mining_backend = SerialBackend(batch_size=64)
+            self.network.servers[url] = server
+            self.servers.append(server)
+        self.connect_peers()
+
+    def connect_peers(self):
+        """Join each node to a few random others, both ways round."""
+        urls = list(self.network.servers)
+        for server in self.servers:
+            others = [url for url in urls if url != server.url]
+            for url in self.rng.sample(others, min(self.params["peers"], len(others))):
+                self.links.add((server.url, url))
+                self.links.add((url, server.url))
+        for source, target in self.links:
+            self.link(source, target)
+
+    def link(self, source, target):
+        server = self.network.servers[source]
+        server.urls.add(target)
+        server.pool.get(target).wire_version = wire.WIRE_VERSION
+
+    @property
+    def nodes(self):
+        return [server.worker for server in self.servers]
+
+    def mine(self, node):
+        """Have one node mine a block on its tip, as if it had just found it."""
+        block = node.block_template()
+        block["nonce"] = node.mining_backend.search(block, node.target, lambda: False)
+        now = asyncio.get_event_loop().time()
+        self.mined[block["id"]] = now
+        self.arrivals.setdefault(block["id"], {})[node.url] = now
+        node.on_block_found(block)
+
+    @staticmethod
+    def can_pay(node):
+        """Whether a node has coins, none of them waiting on its own payments."""
+        pending = any(t["from"] == node.address for t in node.mempool.transactions())
+        return not pending and node.unspent_transactions.balance(node.address) > 1
+
+    async def pay(self):
+        payers = [node for node in self.nodes if self.can_pay(node)]
+        count = min(len(payers), self.params["payments"])
+        for node in self.rng.sample(payers, count):
+            payee = self.rng.choice(self.nodes).address.decode("utf-8")
+            payment = {"outputs": [{"amount": 1, "address": payee}]}
+            await node.submit_transactions([payment])
+
+    def split(self):
+        urls = [server.url for server in self.servers]
+        half = len(urls) // 2
+        self.network.partition(urls[:half], urls[half:])
+
+    def best_node(self):
+        """A node on the longest chain, preferring the tip most nodes are on."""
+        tips = Counter(node.previous_block_id for node in self.nodes)
+        return max(
+            self.nodes, key=lambda node: (node.height, tips[node.previous_block_id])
+        )
+
+    async def heal(self):
+        """Reconnect the network, and re-sync nodes until they agree."""
+        self.network.heal()
+        # Nodes gave up on peers they couldn't reach, so find them again.
+        for source, target in self.links:
+            await self.network.servers[source].pool.close(target)
+            self.link(source, target)
+        for _ in range(SYNC_ROUNDS):
+            # Let any blocks still in flight land before we look.
+            await asyncio.sleep(self.params["latency"] * 10)
+            best = self.best_node().previous_block_id
+            behind = [node for node in self.nodes if node.previous_block_id != best]
+            if not behind:
+                return
+            syncs = (node.sync() for node in behind)
+            await asyncio.gather(*syncs, return_exceptions=True)
+
+    def background_failed(self, loop, context):
+        """Count requests that failed in the background, rather than print them."""
+        error = context.get("exception")
+        self.failures[type(error).__name__ if error else context["message"]] += 1
+
+    async def run(self):
+        asyncio.get_event_loop().set_exception_handler(self.background_failed)
+        blocks = self.params["blocks"]
+        interval = self.params["interval"]
+        for n in range(blocks):
+            if self.params["partition"] and n == blocks // 3:
+                self.split()
+            if self.params["partition"] and n == 2 * blocks // 3:
+                await self.heal()
+            await self.pay()
+            await asyncio.sleep(interval / 2)
+            self.mine(self.rng.choice(self.nodes))
+            await asyncio.sleep(interval / 2)
+        # Give the last block time to reach everyone.
+        await asyncio.sleep(interval + self.params["latency"] * 20)
+        return self.report()
+
+    def reach_times(self, fraction):
+        """For each block, how long it took to reach a fraction of the nodes."""
+        needed = math.ceil(fraction * len(self.servers))
+        times = []
+        for block_id, mined_at in self.mined.items():
+            arrivals = sorted(self.arrivals.get(block_id, {}).values())
+            if len(arrivals) >= needed:
+                times.append(arrivals[needed - 1] - mined_at)
+        return times
+
+    def report(self):
+        propagation = {}
+        for fraction in (0.5, 0.9, 1.0):
+            times = self.reach_times(fraction)
+            propagation[f"{fraction:.0%}_of_nodes"] = {
+                "blocks_reaching": len(times),
+                "median_seconds": statistics.median(times) if times else None,
+                "max_seconds": max(times) if times else None,
+            }
+
+        best_node = self.best_node()
+        best = best_node.previous_block_id
+        best_chain = {block["id"] for block in best_node.blocks}
+        orphaned = [block_id for block_id in self.mined if block_id not in best_chain]
+        agreeing = sum(node.previous_block_id == best for node in self.nodes)
+
+        sent = [self.network.bytes_sent[s.url] for s in self.servers]
+        received = [self.network.bytes_received[s.url] for s in self.servers]
+        return {
+            "params": self.params,
+            "blocks_mined": len(self.mined),
+            "chain_height": best_node.height,
+            "orphan_rate": len(orphaned) / max(len(self.mined), 1),
+            "nodes_on_best_tip": agreeing / len(self.nodes),
+            "propagation": propagation,
+            "background_failures": dict(self.failures),
+            "bytes_per_node": {
+                "sent_mean": statistics.mean(sent),
+                "sent_max": max(sent),
+                "received_mean": statistics.mean(received),
+                "received_max": max(received),
+            },
+        }
+
+
+def close_loop(loop):
+    """
+    Stop the peers' writer tasks before throwing the loop away. A task can
+    miss a cancellation inside wait_for, so keep at it until all stop.
+    """
+    tasks = asyncio.all_tasks(loop)
+    while tasks:
+        for task in tasks:
+            task.cancel()
+        _, tasks = loop.run_until_complete(asyncio.wait(tasks, timeout=0.1))
+    loop.close()
+
+
+def simulate(params):
+    """Run one simulation on a fresh event loop, with the nodes' logs hidden."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            return loop.run_until_complete(Simulation(params).run())
+    finally:
+        close_loop(loop)
+
+
+def run_trials(params):
+    """Run each trial with its own seed, over a process pool if asked to."""
+    trials = [
+        dict(params, seed=params["seed"] + n, trials=1) for n in range(params["trials"])
+    ]
+    if params["processes"] > 1:
+        with ProcessPoolExecutor(params["processes"]) as executor:
+            return list(executor.map(simulate, trials))
+    return [simulate(trial) for trial in trials]
+
+
+def parse_params():
+    params = dict(DEFAULTS)
+    for name, default in DEFAULTS.items():
+        value = argument("--" + name)
+        if value is not None:
+            params[name] = type(default)(value)
+    return params
+
+
+if __name__ == "__main__":
+    json.dump(run_trials(parse_params()), sys.stdout, indent=2)
+    print()
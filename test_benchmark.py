@@ -0,0 +1,21 @@
+import json
+
+import benchmark
+
+
+def test_benchmarks_run_and_report_json(capsys):
+    params = dict(
+        benchmark.DEFAULTS, blocks=30, transactions=20, forks=5, repeat=1, seconds=0.01
+    )
+    report = benchmark.run(params)
+    assert set(report["results"]) == set(benchmark.BENCHMARKS)
+    assert report["results"]["utxo_replay"]["blocks_per_second"] > 0
+    assert json.loads(json.dumps(report)) == report
+
+    benchmark.compare(report, report)
+    assert "(1.00x)" in capsys.readouterr().out
+
+
+def test_synthetic_chains_are_reproducible():
+    first = benchmark.make_chain(benchmark.random.Random(1), 20, 3)
+    assert benchmark.make_chain(benchmark.random.Random(1), 20, 3) == first
@@ -0,0 +1,118 @@
+import ast
+
+import miner
+from blockstore import BlockStore, INDEX, StoredBlock
+
+
+def make_block(n):
+    return {"id": f"block-{n}", "previous_block": f"block-{n - 1}", "hash": n}
+
+
+def test_reopen_keeps_chain(tmp_path):
+    store = BlockStore(tmp_path)
+    for n in range(5):
+        store.append(make_block(n))
+    store.close()
+
+    store = BlockStore(tmp_path)
+    assert len(store) == 5
+    assert list(store) == [make_block(n) for n in range(5)]
+    assert store.index_of("block-3") == 3
+    assert store.block_hash(4) == 4
+
+
+def test_truncate_forgets_abandoned_blocks(tmp_path):
+    store = BlockStore(tmp_path)
+    for n in range(5):
+        store.append(make_block(n))
+    store.truncate(2)
+    store.append(make_block(9))
+    store.close()
+
+    store = BlockStore(tmp_path)
+    assert [block["id"] for block in store] == ["block-0", "block-1", "block-9"]
+    assert store.index_of("block-3") is None
+
+
+def test_torn_index_record_is_dropped(tmp_path):
+    store = BlockStore(tmp_path)
+    for n in range(3):
+        store.append(make_block(n))
+    store.close()
+    with open(tmp_path / "index.dat", "ab") as index:
+        index.write(b"\0" * (INDEX.size // 2))
+
+    store = BlockStore(tmp_path)
+    assert len(store) == 3
+    store.append(make_block(3))
+    assert store[-1] == make_block(3)
+
+
+def test_stored_blocks_read_the_log_lazily(tmp_path):
+    store = BlockStore(tmp_path)
+    for n in range(5):
+        store.append(make_block(n))
+    stored = store.stored_block(3)
+    assert (stored.id, stored.previous_block, stored.hash) == ("block-3", "block-2", 3)
+
+    # Its bytes stay in the log after the chain moves on without it.
+    store.truncate(2)
+    store.append(make_block(9))
+    assert stored == make_block(3)
+    assert ast.literal_eval(repr(stored)) == make_block(3)
+    assert store.stored_block(0)["previous_block"] == 0
+
+
+def test_newest_matching_snapshot_is_loaded(tmp_path):
+    store = BlockStore(tmp_path)
+    for n in range(5):
+        store.append(make_block(n))
+    store.save_snapshot({"height": 2, "block_hash": 1, "outputs": (("a", 1, b"x"),)})
+    store.save_snapshot({"height": 4, "block_hash": 3, "outputs": (("b", 2, b"x"),)})
+    # This one doesn't belong to our chain, so it's skipped.
+    store.save_snapshot({"height": 5, "block_hash": 99, "outputs": ()})
+
+    snapshot = store.load_snapshot()
+    assert snapshot["height"] == 4
+    assert snapshot["outputs"] == (("b", 2, b"x"),)
+
+
+def test_corrupt_snapshot_is_skipped(tmp_path):
+    store = BlockStore(tmp_path)
+    for n in range(3):
+        store.append(make_block(n))
+    store.save_snapshot({"height": 1, "block_hash": 0, "outputs": ()})
+    store.save_snapshot({"height": 3, "block_hash": 2, "outputs": ()})
+    with open(store.snapshot_paths()[0], "r+b") as f:
+        f.seek(40)
+        f.write(b"\xff")
+
+    assert store.load_snapshot()["height"] == 1
+
+
+def test_restart_only_decodes_blocks_after_the_snapshot(
+    tmp_path, monkeypatch, make_miner, mine_chain
+):
+    monkeypatch.setattr(miner, "SNAPSHOT_INTERVAL", 4)
+    node = make_miner()
+    node.open_store(tmp_path)
+    mine_chain(node, 4)
+    node.add_outbound_transaction({"outputs": [{"amount": 10, "address": "bob"}]})
+    [payment] = node.mempool.transactions()
+    # Snapshots only hold outputs which are in blocks.
+    outputs = {output[0] for output in node.snapshot()["outputs"]}
+    assert outputs == set(node.unspent_transactions)
+    assert not outputs & {output[0] for output in payment["outputs"]}
+    mine_chain(node, 5)
+    node.store.close()
+
+    restarted = make_miner()
+    restarted.open_store(tmp_path)
+    assert restarted.store.load_snapshot()["height"] == 8
+    assert all(type(block) is StoredBlock for block in restarted.blocks[:8])
+    assert type(restarted.blocks[8]) is not StoredBlock
+    assert restarted.blocks[3] == node.blocks[3]
+    assert restarted.blocks[4]["transactions"] == (payment,)
+    assert restarted.previous_block_id == node.previous_block_id
+    assert dict(restarted.unspent_transactions) == dict(node.unspent_transactions)
+    assert restarted.block_locator() == node.block_locator()
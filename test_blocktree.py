@@ -0,0 +1,44 @@
+import blocktree
+from blocktree import BlockTree
+
+
+def make_block(id_, parent):
+    return {"id": str(id_), "previous_block": str(parent)}
+
+
+def make_tree(length):
+    tree = BlockTree()
+    tree.reset([make_block(x + 1, x) for x in range(length)])
+    return tree
+
+
+def test_orphans_attach_when_parent_arrives():
+    tree = make_tree(3)
+    assert tree.add(make_block("b5", "b4")) is None
+    assert "b5" in tree.orphans
+
+    tip = tree.add(make_block("b4", "2"))
+    assert tip.id == "b5" and tip.height == 4
+    assert not tree.orphans
+    assert tree.branch(tip) == (2, [make_block("b4", "2"), make_block("b5", "b4")])
+
+
+def test_orphans_are_bounded(monkeypatch):
+    monkeypatch.setattr(blocktree, "MAX_ORPHANS", 2)
+    tree = make_tree(1)
+    for n in range(3):
+        tree.add(make_block(f"o{n}", f"missing{n}"))
+    assert list(tree.orphans) == ["o1", "o2"]
+    assert "missing0" not in tree.waiting
+
+
+def test_stale_side_branches_are_pruned(monkeypatch):
+    monkeypatch.setattr(blocktree, "PRUNE_DEPTH", 3)
+    tree = make_tree(2)
+    tree.add(make_block("side", "1"))
+    for n in range(3, 7):
+        tree.main.append(make_block(n, n - 1))
+        tree.extend_main(tree.main[-1])
+    tree.prune()
+    assert "side" not in tree.nodes
+    assert tree.height_of("6") == 6
@@ -0,0 +1,351 @@
+import asyncio
+
+import pytest
+
+import gossip
+import metrics
+import wire
+from gossip import ConnectionPool, PeerUnavailable, Server
+
+
+class FakeWebsocket:
+    def __init__(self):
+        self.sent = []
+        self.broken = False
+        self.closed = False
+
+    async def send(self, msg):
+        if self.broken:
+            raise OSError("connection reset")
+        self.sent.append(msg)
+
+    async def recv(self):
+        return repr({"echo": self.sent[-1]})
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeConnect:
+    def __init__(self, refuse=False):
+        self.opened = []
+        self.refuse = refuse
+
+    async def __call__(self, url):
+        if self.refuse:
+            raise ConnectionRefusedError(url)
+        websocket = FakeWebsocket()
+        self.opened.append(websocket)
+        return websocket
+
+
+def test_messages_share_one_connection():
+    connect = FakeConnect()
+    pool = ConnectionPool(connect)
+
+    async def exchange():
+        await pool.send("ws://a", "one")
+        await pool.send("ws://a", "two")
+        return await pool.request("ws://a", "three")
+
+    assert asyncio.run(exchange()) == repr({"echo": "three"})
+    assert len(connect.opened) == 1
+    assert connect.opened[0].sent == ["one", "two", "three"]
+    assert pool.health()["ws://a"]["messages_sent"] == 3
+
+
+def test_dropped_connection_is_reopened():
+    connect = FakeConnect()
+    pool = ConnectionPool(connect)
+
+    async def exchange():
+        await pool.send("ws://a", "one")
+        connect.opened[0].broken = True
+        await pool.send("ws://a", "two")
+
+    asyncio.run(exchange())
+    assert len(connect.opened) == 2
+    assert connect.opened[1].sent == ["two"]
+    assert pool.get("ws://a").healthy
+
+
+def test_failed_peer_backs_off():
+    pool = ConnectionPool(FakeConnect(refuse=True))
+
+    async def exchange():
+        with pytest.raises(ConnectionRefusedError):
+            await pool.send("ws://a", "one")
+        with pytest.raises(PeerUnavailable):
+            await pool.send("ws://a", "two")
+
+    asyncio.run(exchange())
+    assert pool.get("ws://a").failures == 1
+
+
+class SlowConnect(FakeConnect):
+    def __init__(self, delays):
+        super().__init__()
+        self.delays = delays
+
+    async def __call__(self, url):
+        websocket = await super().__call__(url)
+        delay = self.delays[url]
+        send = websocket.send
+
+        async def slow_send(msg):
+            await asyncio.sleep(delay)
+            await send(msg)
+
+        websocket.send = slow_send
+        return websocket
+
+
+def test_enqueued_messages_go_out_concurrently(monkeypatch):
+    monkeypatch.setattr("gossip.SEND_TIMEOUT", 0.15)
+    delays = {"ws://a": 0.05, "ws://b": 0.05, "ws://slow": 1}
+    pool = ConnectionPool(SlowConnect(delays))
+
+    async def broadcast():
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        for url in delays:
+            pool.enqueue(url, "block")
+        while pool.get("ws://slow").timeouts == 0:
+            await asyncio.sleep(0.01)
+        return loop.time() - start
+
+    # The slow peer times out without holding up the other two.
+    assert asyncio.run(broadcast()) < 0.5
+    health = pool.health()
+    assert health["ws://a"]["messages_sent"] == 1
+    assert health["ws://b"]["messages_sent"] == 1
+    assert health["ws://slow"]["messages_dropped"] == 1
+
+
+def test_peer_health_is_exported_as_metrics(monkeypatch):
+    monkeypatch.setattr("gossip.SEND_TIMEOUT", 0.05)
+    monkeypatch.setattr("gossip.OUTBOUND_QUEUE_SIZE", 2)
+    url = "ws://exported"
+    pool = ConnectionPool(SlowConnect({url: 1}))
+    dropped = gossip.dropped_messages.value(peer=url)
+    timeouts = gossip.peer_timeouts.value(peer=url)
+
+    async def broadcast():
+        for n in range(4):
+            pool.enqueue(url, str(n))
+        lines = metrics.registry.render().splitlines()
+        while pool.get(url).timeouts == 0:
+            await asyncio.sleep(0.01)
+        return lines
+
+    lines = asyncio.run(broadcast())
+    assert f'peer_queue_depth{{peer="{url}"}} 2' in lines
+    # Two pushed out of the full queue, and at least the one which timed out.
+    exported = gossip.dropped_messages.value(peer=url) - dropped
+    assert exported == pool.get(url).messages_dropped >= 3
+    assert gossip.peer_timeouts.value(peer=url) == timeouts + 1
+    assert f'peer_failures{{peer="{url}"}} 1' in metrics.registry.render().splitlines()
+
+
+def test_timed_out_socket_is_closed_and_reported(monkeypatch):
+    monkeypatch.setattr("gossip.SEND_TIMEOUT", 0.05)
+    connect = SlowConnect({"ws://slow": 1})
+    failed = []
+    pool = ConnectionPool(connect, on_failure=failed.append)
+
+    async def broadcast():
+        pool.enqueue("ws://slow", "block")
+        while not failed:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0)
+
+    asyncio.run(broadcast())
+    assert failed == ["ws://slow"]
+    assert connect.opened[0].closed
+    assert pool.get("ws://slow").websocket is None
+    assert pool.get("ws://slow").failures == 1
+
+
+class LateReplyConnect(FakeConnect):
+    """Connections which answer each message after its own delay."""
+
+    def __init__(self, delays):
+        super().__init__()
+        self.delays = delays
+
+    async def __call__(self, url):
+        websocket = await super().__call__(url)
+        replies = asyncio.Queue()
+        send = websocket.send
+
+        async def send_later(msg):
+            await send(msg)
+            reply = f"reply-to-{msg}"
+            asyncio.get_event_loop().call_later(
+                self.delays.get(msg, 0), replies.put_nowait, reply
+            )
+
+        websocket.send = send_later
+        websocket.recv = replies.get
+        return websocket
+
+
+def test_timed_out_request_doesnt_leave_its_reply_behind(monkeypatch):
+    monkeypatch.setattr("gossip.REQUEST_TIMEOUT", 0.05)
+    connect = LateReplyConnect({"get_blocks": 0.08})
+    pool = ConnectionPool(connect)
+
+    async def exchange():
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.request("ws://a", "get_blocks")
+        # Let the late reply arrive before asking again.
+        await asyncio.sleep(0.05)
+        pool.get("ws://a").retry_at = 0
+        return await pool.request("ws://a", "get_headers")
+
+    assert asyncio.run(exchange()) == "reply-to-get_headers"
+    assert connect.opened[0].closed
+    assert pool.get("ws://a").timeouts == 1
+
+
+def test_full_queue_drops_oldest(monkeypatch):
+    monkeypatch.setattr("gossip.OUTBOUND_QUEUE_SIZE", 2)
+    pool = ConnectionPool(FakeConnect())
+
+    async def flood():
+        for n in range(3):
+            pool.enqueue("ws://a", str(n))
+        return list(pool.get("ws://a").queue._queue)
+
+    assert asyncio.run(flood()) == ["1", "2"]
+    assert pool.health()["ws://a"]["messages_dropped"] == 1
+
+
+class RecordingWorker:
+    def __init__(self, send_to_all, request_from_random, request_from):
+        self.consumed = []
+
+    def consume_message(self, msg, source=None):
+        self.consumed.append(msg)
+
+
+class LoopbackWebsocket:
+    """Delivers messages straight into another Server's respond()."""
+
+    def __init__(self, server):
+        self.server = server
+        self.replies = asyncio.Queue()
+
+    async def send(self, msg):
+        await self.server.respond(LoopbackReplies(self.replies), msg)
+
+    async def recv(self):
+        return await self.replies.get()
+
+    async def close(self):
+        pass
+
+
+class LoopbackReplies:
+    """The far end of a LoopbackWebsocket, where replies are sent."""
+
+    def __init__(self, replies):
+        self.replies = replies
+
+    async def send(self, msg):
+        await self.replies.put(msg)
+
+
+def make_network(*names):
+    servers = {}
+
+    async def connect(url):
+        return LoopbackWebsocket(servers[url])
+
+    for name in names:
+        server = Server(RecordingWorker)
+        server.url = f"ws://{name}"
+        server.pool = ConnectionPool(connect)
+        servers[server.url] = server
+    for server in servers.values():
+        server.urls = set(servers) - {server.url}
+        for url in server.urls:
+            server.pool.get(url).wire_version = wire.WIRE_VERSION
+    return servers
+
+
+def test_inventory_is_announced_and_fetched_once():
+    servers = make_network("a", "b", "c")
+    a, b, c = servers.values()
+    message = {"transaction": {"inputs": (), "outputs": [], "from": b"x"}}
+
+    async def gossip():
+        await a.send_to_all(message)
+        await asyncio.sleep(0.05)
+        # B relays what it received; nobody should fetch it a second time.
+        await b.send_to_all(message)
+        await asyncio.sleep(0.05)
+
+    asyncio.run(gossip())
+    assert b.worker.consumed == [message]
+    assert c.worker.consumed == [message]
+    assert a.worker.consumed == []
+
+
+def test_old_peers_get_batches_one_transaction_at_a_time():
+    servers = make_network("a", "b")
+    a, b = servers.values()
+    a.pool.get(b.url).wire_version = wire.PYON_VERSION
+    transactions = [
+        {"inputs": (str(n),), "outputs": [], "from": b"x"} for n in range(2)
+    ]
+
+    async def gossip():
+        await a.send_to_all({"transactions": transactions})
+        await asyncio.sleep(0.05)
+
+    asyncio.run(gossip())
+    assert b.worker.consumed == [{"transaction": t} for t in transactions]
+
+
+def test_duplicate_full_messages_are_dropped():
+    servers = make_network("a")
+    [a] = servers.values()
+    message = {"block": {"id": "1"}}
+
+    async def push_twice():
+        await a.respond(LoopbackReplies(asyncio.Queue()), repr(message))
+        await a.respond(LoopbackReplies(asyncio.Queue()), repr(message))
+
+    asyncio.run(push_twice())
+    assert a.worker.consumed == [message]
+
+
+class InboundWebsocket(LoopbackReplies):
+    """A connection a peer opened to us, carrying a few messages."""
+
+    def __init__(self, remote_address, messages):
+        super().__init__(asyncio.Queue())
+        self.remote_address = remote_address
+        self.messages = messages
+
+    async def __aiter__(self):
+        for msg in self.messages:
+            yield msg
+
+
+def test_inbound_bytes_are_counted_per_host():
+    [a] = make_network("a").values()
+    first = repr({"block": {"id": "1"}})
+    second = repr({"block": {"id": "2"}})
+    third = repr({"block": {"id": "3"}})
+
+    async def receive():
+        await a.server(InboundWebsocket(("10.0.0.1", 4001), [first]), "/")
+        await a.server(InboundWebsocket(("10.0.0.1", 4002), [second]), "/")
+        await a.server(InboundWebsocket(("10.0.0.2", 4003), [third]), "/")
+
+    asyncio.run(receive())
+    received = gossip.bytes_received.value
+    assert received(peer="inbound:10.0.0.1") == len(first) + len(second)
+    assert received(peer="inbound:10.0.0.2") == len(third)
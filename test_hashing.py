@@ -0,0 +1,68 @@
+import hashlib
+
+import codec
+from hashing import (
+    cryptographic_hash,
+    encode_block,
+    legacy_hash,
+    nonce_digest,
+    prefix_hasher,
+    BLOCK_VERSION,
+)
+
+
+def make_block(**fields):
+    return {
+        "version": BLOCK_VERSION,
+        "id": "abc",
+        "transactions": ({"inputs": ("x",), "outputs": [("y", 5, b"addr")]},),
+        "mine": ("reward", 1000, b"addr"),
+        "timestamp": 0,
+        "previous_block": 0,
+        "previous_block_hash": 1 << 511,
+        "nonce": 7,
+        **fields,
+    }
+
+
+def test_codec_round_trip():
+    value = make_block()
+    assert codec.decode(codec.encode(value)) == value
+
+
+def test_codec_is_canonical():
+    assert codec.encode({"a": 1, "b": 2}) == codec.encode({"b": 2, "a": 1})
+    assert codec.encode((1,)) != codec.encode([1])
+    assert codec.encode(1) != codec.encode(True)
+
+
+def test_nonce_is_encoded_last():
+    one, two = encode_block(make_block(nonce=1)), encode_block(make_block(nonce=2))
+    assert one[:-8] == two[:-8]
+
+
+def test_prefix_hasher_matches_full_hash():
+    block = make_block()
+    digest = nonce_digest(prefix_hasher(block), block["nonce"])
+    assert int.from_bytes(digest, "big") == cryptographic_hash(block)
+
+
+def test_hash_ignores_stored_hash():
+    block = make_block()
+    assert cryptographic_hash({**block, "hash": 1}) == cryptographic_hash(block)
+
+
+def test_unversioned_blocks_use_legacy_hash():
+    block = make_block()
+    del block["version"]
+    expected = hashlib.sha512(repr(sorted(block.items())).encode("utf-8"))
+    assert cryptographic_hash(block) == int(expected.hexdigest(), 16)
+    assert cryptographic_hash(block) == legacy_hash(block)
+
+
+def test_hash_covers_merkle_root_not_transactions():
+    block = make_block(merkle_root=bytes(32))
+    emptied = {**block, "transactions": ()}
+    assert cryptographic_hash(emptied) == cryptographic_hash(block)
+    rooted = {**block, "merkle_root": bytes([1]) * 32}
+    assert cryptographic_hash(rooted) != cryptographic_hash(block)
@@ -0,0 +1,42 @@
+import pytest
+
+from light_client import confirmations
+from signing import transaction_digest
+
+
+@pytest.fixture
+def paid_chain(make_miner, mine_chain):
+    node = make_miner()
+    mine_chain(node, 1)
+    node.add_outbound_transaction({"outputs": [{"amount": 10, "address": "bob"}]})
+    [transaction] = node.mempool.transactions()
+    mine_chain(node, 3)
+    return node, transaction
+
+
+def ask_for_proof(node, transaction, **request):
+    request["txid"] = transaction_digest(transaction)
+    return node.consume_message({"get_proof": request})["proof"]
+
+
+def test_proof_confirms_payment(paid_chain):
+    node, transaction = paid_chain
+    proof = ask_for_proof(node, transaction)
+    assert confirmations(transaction, proof, node.target) == 3
+    assert len(ask_for_proof(node, transaction, confirmations=1)["headers"]) == 1
+
+
+def test_bad_proofs_confirm_nothing(paid_chain):
+    node, transaction = paid_chain
+    proof = ask_for_proof(node, transaction)
+    other = {**transaction, "outputs": [("x", 1000, b"mallory")]}
+    assert confirmations(other, proof, node.target) == 0
+
+    forged = dict(proof["headers"][1], timestamp=0)
+    headers = [proof["headers"][0], forged, *proof["headers"][2:]]
+    assert confirmations(transaction, {**proof, "headers": headers}, node.target) == 0
+
+
+def test_no_proof_for_unmined_transactions(paid_chain):
+    node, transaction = paid_chain
+    assert ask_for_proof(node, {**transaction, "signature": b"other"}) is None
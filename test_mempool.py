@@ -0,0 +1,121 @@
+from mempool import Mempool
+from merkle import transactions_root
+from signing import transaction_digest
+
+
+def make_transaction(inputs, amount=1, padding=""):
+    return {
+        "inputs": tuple(inputs),
+        "outputs": (("out-" + "-".join(inputs), amount, b"bob" + padding.encode()),),
+        "signature": b"sig",
+    }
+
+
+def test_rejects_double_spends():
+    mempool = Mempool()
+    first = make_transaction(["a"])
+    assert mempool.add(first, 5)
+    assert mempool.conflicts(make_transaction(["a", "b"]))
+    assert not mempool.add(make_transaction(["a", "b"]), 50)
+    assert not mempool.add(first, 5)
+    assert len(mempool) == 1
+
+
+def test_template_orders_by_fee_rate():
+    mempool = Mempool()
+    cheap = make_transaction(["a"])
+    dear = make_transaction(["b"])
+    big = make_transaction(["c"], padding="x" * 1000)
+    mempool.add(cheap, 1)
+    mempool.add(dear, 10)
+    mempool.add(big, 12)
+    transactions, fees = mempool.template()
+    assert transactions == (dear, big, cheap)
+    assert fees == 23
+
+
+def test_template_is_reused_until_the_pool_changes():
+    mempool = Mempool()
+    mempool.add(make_transaction(["a"]), 1)
+    template = mempool.template()
+    assert mempool.template() is template
+    mempool.add(make_transaction(["b"]), 1)
+    assert mempool.template() is not template
+
+
+def test_template_ignores_changes_behind_the_next_block(monkeypatch):
+    monkeypatch.setattr("mempool.MAX_BLOCK_TRANSACTIONS", 2)
+    mempool = Mempool()
+    mempool.add(make_transaction(["a"]), 5)
+    mempool.add(make_transaction(["b"]), 4)
+    template = mempool.template()
+
+    cheap = make_transaction(["c"])
+    mempool.add(cheap, 1)
+    assert mempool.template() is template
+    mempool.remove(transaction_digest(cheap))
+    assert mempool.template() is template
+
+    dear = make_transaction(["d"])
+    mempool.add(dear, 9)
+    assert mempool.template()[0][0] == dear
+
+
+def test_evicts_lowest_fee_rate_when_full():
+    mempool = Mempool(max_count=2)
+    cheap = make_transaction(["a"])
+    mempool.add(cheap, 1)
+    mempool.add(make_transaction(["b"]), 5)
+    assert not mempool.add(make_transaction(["c"]), 1)
+    assert mempool.add(make_transaction(["d"]), 9)
+    assert transaction_digest(cheap) not in mempool
+    assert len(mempool) == 2
+    assert mempool.evicted == 1
+    # The evicted transaction's input can be spent again.
+    assert not mempool.conflicts(make_transaction(["a"]))
+
+
+def test_remove_block_drops_included_and_conflicting():
+    mempool = Mempool()
+    included = make_transaction(["a"])
+    conflicting = make_transaction(["b"])
+    unrelated = make_transaction(["c"])
+    for transaction in (included, conflicting, unrelated):
+        mempool.add(transaction, 1)
+    block = {"transactions": (included, make_transaction(["b", "z"]))}
+    mempool.remove_block(block)
+    assert mempool.transactions() == [unrelated]
+    assert mempool.bytes == mempool.entries[transaction_digest(unrelated)].size
+
+
+def test_template_merkle_root_follows_the_pool():
+    mempool = Mempool()
+    for fee, inputs in enumerate(["a", "b", "c"]):
+        mempool.add(make_transaction([inputs]), fee)
+        transactions, _ = mempool.template()
+        assert mempool.merkle.root == transactions_root(transactions)
+
+
+def test_fee_order_stays_bounded_as_blocks_are_mined():
+    mempool = Mempool()
+    waiting = make_transaction(["low"])
+    mempool.add(waiting, 0)
+    for height in range(100):
+        block = [make_transaction([f"{height}-{n}"]) for n in range(10)]
+        for transaction in block:
+            mempool.add(transaction, 5)
+        mempool.remove_block({"transactions": block})
+    assert len(mempool) == 1
+    assert len(mempool._order) == len(mempool)
+
+
+def test_transactions_are_found_by_short_id():
+    mempool = Mempool()
+    first, second = make_transaction(["a"]), make_transaction(["b"])
+    mempool.add(first, 1)
+    mempool.add(second, 1)
+    short_id = transaction_digest(first)[:8]
+
+    assert mempool.by_short_id([short_id, b"unknown!"]) == {short_id: first}
+    mempool.remove(transaction_digest(first))
+    assert mempool.by_short_id([short_id]) == {}
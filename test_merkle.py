@@ -0,0 +1,59 @@
+import hashlib
+
+from merkle import EMPTY_ROOT, MerkleTree, combine, merkle_root, verify_proof
+
+
+def leaves(count, tag=b""):
+    return [hashlib.sha256(tag + bytes([i])).digest() for i in range(count)]
+
+
+def rebuilt_root(leaves):
+    """Build the root level by level, the slow way."""
+    level = list(leaves)
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [combine(a, b) for a, b in zip(level[::2], level[1::2])]
+    return level[0]
+
+
+def test_roots_match_a_full_rebuild():
+    assert merkle_root([]) == EMPTY_ROOT
+    tree = MerkleTree()
+    for leaf in leaves(17):
+        tree.append(leaf)
+        assert tree.root == rebuilt_root(tree.leaves)
+
+
+def test_truncate_then_append():
+    tree = MerkleTree(leaves(13))
+    for length in (12, 9, 8, 5, 1):
+        tree.truncate(length)
+        assert tree.root == rebuilt_root(leaves(length))
+    tree.truncate(0)
+    assert tree.root == EMPTY_ROOT
+    tree.append(leaves(1)[0])
+    assert tree.root == leaves(1)[0]
+
+
+def test_update_keeps_the_common_prefix():
+    tree = MerkleTree(leaves(10))
+    changed = leaves(6) + leaves(7, tag=b"new")
+    tree.update(changed)
+    assert tree.leaves == changed
+    assert tree.root == rebuilt_root(changed)
+
+
+def test_proofs_verify_against_the_root():
+    for count in (1, 2, 7, 8):
+        tree = MerkleTree(leaves(count))
+        for index, leaf in enumerate(tree.leaves):
+            branch = tree.proof(index)
+            assert verify_proof(leaf, index, branch, tree.root)
+            assert not verify_proof(leaves(1, tag=b"x")[0], index, branch, tree.root)
+
+
+def test_proofs_are_tied_to_an_index():
+    tree = MerkleTree(leaves(8))
+    assert not verify_proof(tree.leaves[2], 3, tree.proof(2), tree.root)
+    assert not verify_proof(tree.leaves[2], 10, tree.proof(2), tree.root)
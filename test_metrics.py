@@ -0,0 +1,61 @@
+import time
+
+import metrics
+
+
+def test_counters_and_histograms_render():
+    registry = metrics.Registry()
+    sent = registry.register(metrics.Counter("sent_total", "Sent.", ("peer",)))
+    sent.inc(3, peer="a")
+    sent.inc(peer="a")
+    latency = registry.register(
+        metrics.Histogram("latency", "Latency.", buckets=(1, 2))
+    )
+    for value in (0.5, 1.5, 9):
+        latency.observe(value)
+    registry.register(metrics.Gauge("depth", "Depth.", lambda: 7))
+
+    lines = registry.render().splitlines()
+    assert "# TYPE sent_total counter" in lines
+    assert 'sent_total{peer="a"} 4' in lines
+    assert 'latency_bucket{le="1"} 1' in lines
+    assert 'latency_bucket{le="2"} 2' in lines
+    assert 'latency_bucket{le="+Inf"} 3' in lines
+    assert "latency_sum 11.0" in lines
+    assert "latency_count 3" in lines
+    assert "depth 7" in lines
+
+
+def test_gauges_read_each_owner_while_it_lives():
+    class Node:
+        def __init__(self, height):
+            self.height = height
+
+    height = metrics.Gauge("height", "Height.", labels=("node",))
+    first, second = Node(3), Node(5)
+    height.track(first, lambda node: node.height, node="first")
+    height.track(second, lambda node: node.height, node="second")
+    assert 'height{node="first"} 3' in height.render().splitlines()
+    assert 'height{node="second"} 5' in height.render().splitlines()
+
+    del first
+    assert [value for *_, value in height.samples()] == [5]
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_profiler_samples_only_inside_sections():
+    profiler = metrics.SamplingProfiler(interval=0.001)
+    with profiler.section("ignored"):
+        busy(0.02)
+    profiler.enable()
+    with profiler.section("hot"):
+        busy(0.1)
+    profiler.disable()
+    assert profiler.samples
+    assert all(stack.startswith("hot;") for stack in profiler.samples)
+    assert any("test_metrics.py:busy" in stack for stack in profiler.samples)
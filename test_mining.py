@@ -0,0 +1,65 @@
+from hashing import cryptographic_hash, BLOCK_VERSION
+from mining import ProcessPoolBackend, SerialBackend
+
+TARGET = 1 << (512 - 8)
+
+
+def make_template(**fields):
+    return {
+        "version": BLOCK_VERSION,
+        "id": "template",
+        "transactions": (),
+        "mine": ("reward", 1000, b"address"),
+        "timestamp": 0,
+        "previous_block": 0,
+        "previous_block_hash": 0,
+        "nonce": 0,
+        **fields,
+    }
+
+
+def check_backend(backend, block=None):
+    block = block or make_template()
+    nonce = backend.search(block, TARGET, lambda: False)
+    assert nonce is not None
+    assert cryptographic_hash({**block, "nonce": nonce}) < TARGET
+    assert backend.hashes > 0
+    assert backend.hash_rate > 0
+
+
+def test_serial_backend():
+    check_backend(SerialBackend(batch_size=64))
+
+
+def test_serial_backend_legacy_block():
+    check_backend(SerialBackend(batch_size=64), make_template(version=0))
+
+
+def test_process_pool_backend():
+    backend = ProcessPoolBackend(workers=2, batch_size=64)
+    try:
+        check_backend(backend)
+    finally:
+        backend.shutdown()
+
+
+def test_interrupted_search_stops():
+    backend = SerialBackend(batch_size=64)
+    assert backend.search(make_template(), 0, lambda: True) is None
+
+
+def test_interrupted_process_pool_search_stops():
+    backend = ProcessPoolBackend(workers=2, batch_size=64)
+    checks = []
+
+    def interrupted():
+        checks.append(True)
+        return len(checks) > 3
+
+    try:
+        assert backend.search(make_template(), 0, interrupted) is None
+        assert len(checks) == 4
+        assert backend.hashes >= 4 * 64
+    finally:
+        backend.shutdown()
+    assert backend._executor is None
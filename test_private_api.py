@@ -0,0 +1,100 @@
+import json
+
+import miner
+from private_api import Api
+
+
+async def fetch(port, method, path, body=None):
+    reader, writer = await miner.asyncio.open_connection("127.0.0.1", port)
+    content = json.dumps(body).encode() if body is not None else b""
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nContent-Length: {len(content)}\r\n\r\n".encode()
+        + content
+    )
+    response = await reader.read()
+    writer.close()
+    head, _, content = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(content)
+
+
+def serve(event_loop, node):
+    api = Api(0, node)
+    server = event_loop.run_until_complete(api.start())
+    port = server.sockets[0].getsockname()[1]
+    return api, lambda *args: event_loop.run_until_complete(fetch(port, *args))
+
+
+def test_unspent_is_paged_and_filtered(event_loop, make_miner, mine_chain):
+    node = make_miner()
+    mine_chain(node, 3)
+    _, request = serve(event_loop, node)
+
+    status, reply = request("GET", "/unspent?limit=2")
+    assert status == 200
+    assert len(reply["unspent"]) == 2 and reply["total"] == 3
+    _, reply = request("GET", "/unspent?offset=2&limit=2")
+    assert len(reply["unspent"]) == 1
+
+    _, reply = request("GET", "/unspent?address=nobody")
+    assert reply == {"unspent": [], "total": 0}
+    assert request("GET", "/unspent?limit=x")[0] == 400
+
+
+def test_responses_are_cached_until_a_new_block(event_loop, make_miner, mine_chain):
+    node = make_miner()
+    mine_chain(node, 1)
+    api, request = serve(event_loop, node)
+
+    _, first = request("GET", "/balances")
+    assert request("GET", "/balances")[1] == first
+    assert api.cache.hits == 1
+
+    mine_chain(node, 1)
+    _, second = request("GET", "/balances")
+    assert second != first
+    assert api.cache.misses == 2
+
+
+def test_bulk_submission(event_loop, make_miner, mine_chain):
+    node = make_miner()
+    mine_chain(node, 2)
+    _, request = serve(event_loop, node)
+
+    payment = {"outputs": [{"amount": 10, "address": "bob"}]}
+    expensive = {"outputs": [{"amount": 10**9, "address": "bob"}]}
+    status, reply = request(
+        "POST", "/transactions", {"payments": [payment, expensive, {}, payment]}
+    )
+    assert status == 200
+    assert reply["results"] == [
+        {"msg": "OK"},
+        {"error": "Insufficient funds!"},
+        {"error": "Malformed payment"},
+        {"msg": "OK"},
+    ]
+    [transaction] = node.mempool.transactions()
+    assert len(transaction["outputs"]) == 3
+    assert request("POST", "/transactions", [payment])[0] == 400
+    assert request("GET", "/transactions")[0] == 405
+    assert request("GET", "/nowhere")[0] == 404
+
+
+def test_metrics_endpoint(event_loop, make_miner, mine_chain):
+    node = make_miner()
+    mine_chain(node, 2)
+    api = Api(0, node)
+    server = event_loop.run_until_complete(api.start())
+    port = server.sockets[0].getsockname()[1]
+
+    async def fetch_text():
+        reader, writer = await miner.asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+        return response.partition(b"\r\n\r\n")[2].decode()
+
+    lines = event_loop.run_until_complete(fetch_text()).splitlines()
+    label = '{node="%s"}' % node.public_key[:10].decode()
+    assert f"chain_height{label} 2" in lines
+    assert f"utxo_set_size{label} 2" in lines
+    assert f"mempool_transactions{label} 0" in lines
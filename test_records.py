@@ -0,0 +1,74 @@
+import ast
+import pickle
+import random
+
+import pytest
+
+import benchmark
+import codec
+from hashing import cryptographic_hash, encode_block
+from records import Block, Transaction, freeze_block
+from signing import generate_keypair, sign_transaction, signature_cache
+from signing import transaction_digest, verify_transaction
+from test_hashing import make_block
+
+
+def test_block_reads_and_encodes_like_its_dict():
+    block = make_block()
+    record = freeze_block(block)
+    hashed = {**block, "hash": cryptographic_hash(block)}
+
+    assert isinstance(record, Block)
+    assert record == hashed and hashed == record
+    assert record["hash"] == hashed["hash"]
+    assert record.get("merkle_root") is None and "merkle_root" not in record
+    assert codec.encode(record) == codec.encode(hashed)
+    assert record.encoded == encode_block(block)
+    assert record.to_dict() == hashed
+    assert type(record.to_dict()["transactions"][0]) is dict
+
+
+def test_records_survive_pyon_codec_and_pickle():
+    record = freeze_block(make_block())
+    assert ast.literal_eval(repr(record)) == record
+    assert codec.decode(codec.encode(record)) == record
+    assert pickle.loads(pickle.dumps(record)) == record
+
+
+def test_records_are_immutable():
+    record = freeze_block(make_block())
+    with pytest.raises(AttributeError):
+        record.nonce = 8
+    with pytest.raises(TypeError):
+        record["nonce"] = 8
+    with pytest.raises(AttributeError):
+        record["transactions"][0].digest = b""
+
+
+def test_transaction_keeps_its_digest_and_signature():
+    key, address = generate_keypair(seed=bytes(32))
+    transaction = sign_transaction(
+        {"inputs": ("x",), "outputs": [("y", 5, address)], "from": address}, key
+    )
+    record = Transaction(transaction)
+    assert record == transaction
+    assert record.digest == transaction_digest(transaction)
+    assert record["outputs"] == [("y", 5, address)]
+
+    signature_cache.clear()
+    assert verify_transaction(record)
+
+
+def test_legacy_blocks_stay_dicts():
+    block = make_block()
+    del block["version"]
+    frozen = freeze_block(block)
+    assert type(frozen) is dict
+    assert frozen["hash"] == cryptographic_hash(block)
+
+
+def test_records_take_less_memory():
+    params = dict(benchmark.DEFAULTS, blocks=50)
+    results = benchmark.bench_memory(random.Random(0), params)
+    dicts = results["dicts"]["bytes_per_block"]
+    assert results["records"]["bytes_per_block"] < 0.75 * dicts
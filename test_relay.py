@@ -0,0 +1,225 @@
+import pytest
+
+import miner
+
+
+class Recorder:
+    def __init__(self):
+        self.sent = []
+
+    async def __call__(self, data, fallback=None):
+        self.sent.append(data)
+
+
+@pytest.fixture
+def pair(make_miner, mine_chain):
+    source = make_miner()
+    source.send_to_all = Recorder()
+    mine_chain(source, 1)
+    node = make_miner(peer=source)
+    node.send_to_all = Recorder()
+    miner.asyncio_run(node.sync())
+
+    # Pay someone, so the next block has a transaction in it.
+    source.add_outbound_transaction({"outputs": [{"amount": 10, "address": "bob"}]})
+    [transaction_msg] = source.send_to_all.sent[-1:]
+    return source, node, transaction_msg["transaction"]
+
+
+def mine_compact_block(source):
+    source.mine_one_block()
+    [compact_msg] = source.send_to_all.sent[-1:]
+    return compact_msg["compact_block"]
+
+
+def test_compact_block_rebuilt_from_mempool(event_loop, pair):
+    source, node, transaction = pair
+    node.handle_transaction_msg(transaction)
+
+    compact = mine_compact_block(source)
+    assert len(compact["short_ids"]) == 1
+    assert "transactions" not in compact
+
+    node.consume_message({"compact_block": compact})
+    assert node.previous_block_id == source.previous_block_id
+    assert node.blocks[-1]["transactions"] == (transaction,)
+
+    # It's passed on to our own peers, still compact.
+    event_loop.run_until_complete(miner.asyncio.sleep(0))
+    assert node.send_to_all.sent[-1] == {"compact_block": compact}
+
+
+def test_missing_transactions_are_fetched(event_loop, pair):
+    source, node, transaction = pair
+
+    node.consume_message({"compact_block": mine_compact_block(source)})
+    event_loop.run_until_complete(miner.asyncio.sleep(0.01))
+    assert node.previous_block_id == source.previous_block_id
+    assert node.blocks[-1]["transactions"] == (transaction,)
+
+
+def test_missing_transactions_come_from_the_announcer(event_loop, pair, make_miner):
+    source, node, transaction = pair
+    # Our other peers haven't seen the transaction, or the block.
+    stranger = make_miner()
+    asked = []
+
+    async def request_from_random(request, callback):
+        asked.append("random")
+        callback(stranger.consume_message(request))
+
+    async def request_from(url, request, callback):
+        asked.append(url)
+        callback(source.consume_message(request))
+
+    node.request_from_random = request_from_random
+    node.request_from = request_from
+    node.consume_message({"compact_block": mine_compact_block(source)}, "ws://source")
+    event_loop.run_until_complete(miner.asyncio.sleep(0.01))
+    assert asked == ["ws://source"]
+    assert node.previous_block_id == source.previous_block_id
+    assert node.blocks[-1]["transactions"] == (transaction,)
+
+
+def test_unreachable_announcer_falls_back_to_another_peer(event_loop, pair):
+    source, node, transaction = pair
+
+    async def request_from(url, request, callback):
+        raise ConnectionRefusedError(url)
+
+    node.request_from = request_from
+    node.consume_message({"compact_block": mine_compact_block(source)}, "ws://gone")
+    event_loop.run_until_complete(miner.asyncio.sleep(0.01))
+    assert node.previous_block_id == source.previous_block_id
+
+
+def test_block_with_the_wrong_transactions_is_rejected(event_loop, pair):
+    source, node, transaction = pair
+    source.mine_one_block()
+    block = miner.without_hash(source.blocks[-1])
+
+    # The header still hashes correctly, but no longer matches the body.
+    assert not node.accept_block({**block, "transactions": ()})
+    assert node.accept_block(block)
+    assert node.previous_block_id == source.previous_block_id
+
+
+def test_batch_is_signed_and_sent_as_one_message(event_loop, pair, mine_chain):
+    source, node, _ = pair
+    mine_chain(source, 50)
+    payments = [{"outputs": [{"amount": 1, "address": "carol"}]}] * 50
+    payments.append({"outputs": [{"amount": 10**9, "address": "carol"}]})
+
+    results = event_loop.run_until_complete(source.submit_transactions(payments))
+    assert results[:-1] == [{"msg": "OK"}] * 50
+    assert results[-1] == {"error": "Insufficient funds!"}
+    [batch] = source.send_to_all.sent[-1:]
+    [transaction] = batch["transactions"]
+    # One output for each payment, and one for our change.
+    assert len(transaction["outputs"]) == 51
+    assert len(source.mempool) == 1
+
+
+def test_batch_pays_everyone_from_one_coin(event_loop, make_miner, mine_chain):
+    source = make_miner()
+    mine_chain(source, 1)
+    node = make_miner(peer=source)
+    miner.asyncio_run(node.sync())
+    source.send_to_all = Recorder()
+    payments = [{"outputs": [{"amount": 100, "address": "bob"}]}] * 3
+
+    results = event_loop.run_until_complete(source.submit_transactions(payments))
+    assert results == [{"msg": "OK"}] * 3
+    [batch] = source.send_to_all.sent
+    assert all(node.accept_transaction(t) for t in batch["transactions"])
+
+    # Our change isn't confirmed yet, so there's nothing left to pay with.
+    results = event_loop.run_until_complete(source.submit_transactions(payments))
+    assert (
+        results
+        == [{"error": "No unreserved coins: wait for pending payments to confirm"}] * 3
+    )
+
+    source.mine_one_block()
+    assert node.accept_block(miner.without_hash(source.blocks[-1]))
+    results = event_loop.run_until_complete(source.submit_transactions(payments))
+    assert results == [{"msg": "OK"}] * 3
+
+
+def test_payment_rejected_by_mempool_spends_nothing(make_miner, mine_chain):
+    source = make_miner()
+    mine_chain(source, 1)
+    source.mempool.max_count = 0
+    coins = list(source.unspent_transactions.outputs(source.address))
+
+    result = source.add_outbound_transaction(
+        {"outputs": [{"amount": 100, "address": "bob"}]}
+    )
+    assert result == {"error": "Rejected by mempool"}
+    assert list(source.unspent_transactions.outputs(source.address)) == coins
+
+
+def test_received_batches_are_relayed_together(event_loop, pair):
+    source, node, transaction = pair
+    node.consume_message({"transactions": [transaction, transaction]})
+    event_loop.run_until_complete(miner.asyncio.sleep(0))
+    assert node.send_to_all.sent[-1:] == [{"transactions": [transaction]}]
+    assert len(node.mempool) == 1
+
+
+def test_mining_thread_hands_blocks_to_the_loop(event_loop, pair):
+    source, node, transaction = pair
+    node.handle_transaction_msg(transaction)
+    event_loop.run_until_complete(node.start_mining())
+
+    async def wait_for_blocks(height):
+        while node.height < height:
+            await miner.asyncio.sleep(0.01)
+
+    try:
+        event_loop.run_until_complete(
+            miner.asyncio.wait_for(wait_for_blocks(source.height + 2), 10)
+        )
+    finally:
+        node.stop_mining()
+        # Let the last block's broadcast finish before the loop closes.
+        event_loop.run_until_complete(miner.asyncio.sleep(0.05))
+    assert node.blocks[source.height]["transactions"] == (transaction,)
+    assert node.blocks[-1]["previous_block_hash"] == node.blocks[-2]["hash"]
+    compact_blocks = [m for m in node.send_to_all.sent if "compact_block" in m]
+    assert len(compact_blocks) >= 2
+
+
+def test_block_with_duplicate_transactions_is_rejected(make_miner, mine_chain):
+    source = make_miner()
+    mine_chain(source, 3)
+    node = make_miner(peer=source)
+    miner.asyncio_run(node.sync())
+    for _ in range(3):
+        source.add_outbound_transaction({"outputs": [{"amount": 1, "address": "bob"}]})
+    source.mine_one_block()
+    block = miner.without_hash(source.blocks[-1])
+    transactions = block["transactions"]
+    assert len(transactions) == 3
+
+    # The last transaction pairs with itself either way, so the root matches.
+    duplicated = {**block, "transactions": (*transactions, transactions[-1])}
+    assert node.root_matches_transactions(duplicated)
+    assert not node.accept_block(duplicated)
+    assert node.accept_block(block)
+    assert node.previous_block_id == source.previous_block_id
+
+
+def test_mined_block_leaves_out_unspendable_transactions(event_loop, pair):
+    source, node, transaction = pair
+    # Slip in a transaction spending an output nobody has.
+    stale = miner.sign_transaction(
+        {"inputs": ("gone",), "outputs": [("x", 1, b"bob")], "from": source.address},
+        source.private_key,
+    )
+    source.mempool.add(stale, 0)
+
+    source.mine_one_block()
+    assert source.blocks[-1]["transactions"] == (transaction,)
+    assert len(source.mempool) == 0
+    assert node.accept_block(miner.without_hash(source.blocks[-1]))
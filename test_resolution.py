@@ -1,3 +1,5 @@
+import miner
+from merkle import transactions_root
 from miner import Miner
 
 m = Miner(None, None)
@@ -69,3 +71,97 @@ def test_fill_gap():
 
     expected = ["1", "2", "3", "new4", "new5", "new6"]
     assert [x["id"] for x in m.blocks] == expected
+
+
+def test_reorg_restores_outputs_our_own_payment_spent(make_miner, mine_chain):
+    node = make_miner()
+    mine_chain(node, 1)
+    rival = make_miner(peer=node)
+    miner.asyncio_run(rival.sync())
+    confirmed = dict(node.unspent_transactions)
+
+    # Pending payments leave our unspent outputs alone until they're mined.
+    assert node.add_outbound_transaction(
+        {"outputs": [{"amount": 10, "address": "bob"}]}
+    ) == {"msg": "OK"}
+    assert dict(node.unspent_transactions) == confirmed
+    [payment] = node.mempool.transactions()
+    mine_chain(node, 1)
+    assert payment["inputs"][0] not in node.unspent_transactions
+
+    # A longer fork without the payment undoes it, and it waits to be mined again.
+    mine_chain(rival, 2)
+    for block in rival.blocks[1:]:
+        assert node.accept_block(miner.without_hash(block))
+    assert node.previous_block_id == rival.previous_block_id
+    assert dict(node.unspent_transactions) == dict(rival.unspent_transactions)
+    assert node.mempool.transactions() == [payment]
+
+
+def paid_fork(make_miner, mine_chain):
+    """
+    A node one block into a fork, and a rival two blocks into another whose
+    last block pays with outputs only that fork has.
+    """
+    rival = make_miner()
+    mine_chain(rival, 1)
+    node = make_miner(peer=rival)
+    miner.asyncio_run(node.sync())
+    mine_chain(node, 1)
+
+    mine_chain(rival, 1)
+    payment = {"outputs": [{"amount": 1500, "address": "bob"}]}
+    assert rival.add_outbound_transaction(payment) == {"msg": "OK"}
+    mine_chain(rival, 1)
+    return node, rival
+
+
+def test_fork_may_spend_its_own_outputs(make_miner, mine_chain):
+    node, rival = paid_fork(make_miner, mine_chain)
+    [payment] = rival.blocks[-1]["transactions"]
+    assert rival.blocks[-2]["mine"][0] in payment["inputs"]
+
+    for block in rival.blocks[1:]:
+        assert node.accept_block(miner.without_hash(block))
+    assert node.previous_block_id == rival.previous_block_id
+    assert dict(node.unspent_transactions) == dict(rival.unspent_transactions)
+
+
+def test_invalid_fork_keeps_our_chain(make_miner, mine_chain):
+    node, rival = paid_fork(make_miner, mine_chain)
+    mine_chain(node, 1)
+    before = dict(node.unspent_transactions)
+    tip = node.previous_block_id
+
+    # Build a block on the rival's fork which spends the same outputs again.
+    [payment] = rival.blocks[-1]["transactions"]
+    block = rival.block_template()
+    block["transactions"] = (payment,)
+    block["merkle_root"] = transactions_root(block["transactions"])
+    block["nonce"] = rival.mining_backend.search(block, rival.target, lambda: False)
+
+    for fork_block in rival.blocks[1:]:
+        assert node.accept_block(miner.without_hash(fork_block))
+    assert not node.accept_block(block)
+    assert node.previous_block_id == tip
+    assert dict(node.unspent_transactions) == before
+    assert block["id"] not in node.tree.nodes
+
+
+def test_reorg_drops_payments_whose_coins_it_took_away(make_miner, mine_chain):
+    rival = make_miner()
+    mine_chain(rival, 1)
+    node = make_miner(peer=rival)
+    miner.asyncio_run(node.sync())
+
+    # Spend the reward from a block the rival's longer fork will replace.
+    mine_chain(node, 1)
+    payment = {"outputs": [{"amount": 10, "address": "bob"}]}
+    assert node.add_outbound_transaction(payment) == {"msg": "OK"}
+    mine_chain(rival, 2)
+    for block in rival.blocks[1:]:
+        assert node.accept_block(miner.without_hash(block))
+    assert node.mempool.transactions() == []
+
+    mine_chain(node, 1)
+    assert rival.accept_block(miner.without_hash(node.blocks[-1]))
@@ -0,0 +1,66 @@
+import miner
+import signing
+from signing import SignatureCache, generate_keypair, sign_transaction
+from signing import signature_cache, verify_transaction, verify_transactions
+
+KEY, ADDRESS = generate_keypair(seed=bytes(32))
+
+
+def make_transaction(amount=5):
+    return {"inputs": ("x",), "outputs": [("y", amount, ADDRESS)], "from": ADDRESS}
+
+
+def test_unencodable_transactions_fail_verification():
+    transaction = sign_transaction(make_transaction(), KEY)
+    assert not verify_transaction({**transaction, "outputs": [object()]})
+    assert not verify_transaction({**transaction, "from": 5})
+    assert not verify_transaction({**transaction, "signature": None})
+    assert not verify_transaction({**transaction, "signature": b"short"})
+    del transaction["from"]
+    assert not verify_transaction(transaction)
+
+
+def test_tampered_transactions_fail_verification():
+    transaction = sign_transaction(make_transaction(), KEY)
+    signature_cache.clear()
+    assert verify_transaction(transaction)
+    assert not verify_transaction({**transaction, "outputs": [("y", 6, ADDRESS)]})
+
+
+def test_bad_signature_fails_a_parallel_batch():
+    batch = [sign_transaction(make_transaction(n), KEY) for n in range(50)]
+    assert len(batch) > signing.PARALLEL_THRESHOLD
+    signature_cache.clear()
+    assert verify_transactions(batch)
+
+    forged = {**batch[20], "outputs": [("y", 10**6, ADDRESS)]}
+    assert not verify_transactions(batch[:20] + [forged] + batch[21:])
+
+
+def test_cache_evicts_least_recently_used():
+    cache = SignatureCache(maxsize=2)
+    for digest in (b"a", b"b", b"a", b"c"):
+        cache.add(digest)
+    assert b"a" in cache and b"c" in cache and b"b" not in cache
+    assert cache.stats()["evictions"] == 1
+    assert len(cache) == 2
+
+
+def test_block_reuses_signatures_checked_by_the_mempool(make_miner, mine_chain):
+    source = make_miner()
+    mine_chain(source, 1)
+    node = make_miner(peer=source)
+    miner.asyncio_run(node.sync())
+    source.add_outbound_transaction({"outputs": [{"amount": 10, "address": "bob"}]})
+    [transaction] = source.mempool.transactions()
+
+    signature_cache.clear()
+    checked = signing.verifications.value()
+    assert node.accept_transaction(transaction)
+    assert signing.verifications.value() == checked + 1
+
+    source.mine_one_block()
+    hits = signature_cache.hits
+    assert node.accept_block(miner.without_hash(source.blocks[-1]))
+    assert signing.verifications.value() == checked + 1
+    assert signature_cache.hits > hits
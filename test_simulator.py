@@ -0,0 +1,52 @@
+import asyncio
+import json
+
+import simulator
+
+PARAMS = dict(
+    simulator.DEFAULTS,
+    nodes=8,
+    peers=3,
+    blocks=4,
+    interval=0.1,
+    latency=0.005,
+    payments=0,
+)
+
+
+def test_blocks_reach_every_node():
+    report = simulator.simulate(PARAMS)
+    assert report["blocks_mined"] == 4
+    assert report["chain_height"] == 4
+    assert report["orphan_rate"] == 0
+    assert report["nodes_on_best_tip"] == 1
+    assert report["propagation"]["100%_of_nodes"]["blocks_reaching"] == 4
+    assert report["bytes_per_node"]["sent_mean"] > 0
+    assert json.loads(json.dumps(report)) == report
+
+
+def wait_until(loop, condition, timeout=5):
+    """Run the loop until a condition holds, rather than for a fixed time."""
+
+    async def wait():
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    loop.run_until_complete(asyncio.wait_for(wait(), timeout))
+
+
+def test_partitioned_nodes_catch_up_once_healed():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    simulation = simulator.Simulation(PARAMS)
+    nodes = simulation.nodes
+    simulation.split()
+
+    simulation.mine(nodes[0])
+    wait_until(loop, lambda: all(node.height == 1 for node in nodes[:4]))
+    assert all(node.height == 0 for node in nodes[4:])
+
+    loop.run_until_complete(simulation.heal())
+    tip = nodes[0].previous_block_id
+    wait_until(loop, lambda: all(node.previous_block_id == tip for node in nodes))
+    simulator.close_loop(loop)
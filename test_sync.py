@@ -0,0 +1,85 @@
+import pytest
+
+import miner
+
+
+@pytest.fixture
+def small_pages(monkeypatch):
+    monkeypatch.setattr(miner, "MAX_HEADERS", 10)
+    monkeypatch.setattr(miner, "PAGE_SIZE", 3)
+
+
+def test_sync_downloads_whole_chain(small_pages, make_miner, mine_chain):
+    source = make_miner()
+    mine_chain(source, 25)
+
+    node = make_miner(peer=source)
+    miner.asyncio_run(node.sync())
+    assert [b["id"] for b in node.blocks] == [b["id"] for b in source.blocks]
+    assert node.balances() == source.balances()
+
+
+def test_sync_only_fetches_missing_blocks(small_pages, make_miner, mine_chain):
+    source = make_miner()
+    mine_chain(source, 12)
+    node = make_miner(peer=source)
+    miner.asyncio_run(node.sync())
+
+    mine_chain(source, 4)
+    assert len(source.headers_after(node.block_locator())["headers"]) == 4
+    miner.asyncio_run(node.sync())
+    assert node.previous_block_id == source.previous_block_id
+
+
+def test_locator_is_sparse(make_miner):
+    node = make_miner()
+    node.blocks = [{"id": str(n), "previous_block": str(n - 1)} for n in range(100)]
+    locator = node.block_locator()
+    assert locator[:10] == [str(n) for n in range(99, 89, -1)]
+    assert locator[-1] == "0"
+    assert len(locator) < 20
+
+
+def test_sync_past_a_snapshot_longer_than_one_headers_reply(
+    small_pages, make_miner, mine_chain
+):
+    source = make_miner()
+    mine_chain(source, 20)
+    snapshot = source.snapshot()
+    mine_chain(source, 5)
+
+    node = make_miner(peer=source)
+    node.use_snapshot(snapshot)
+    miner.asyncio_run(node.sync())
+    assert [b["id"] for b in node.blocks] == [b["id"] for b in source.blocks]
+    assert node.balances() == source.balances()
+    # Only the blocks after the snapshot were replayed.
+    assert list(node.undo_data) == [b["id"] for b in source.blocks[20:]]
+
+
+def test_snapshot_checkpoint_needs_proof_of_work_and_matching_headers(
+    make_miner, mine_chain
+):
+    source = make_miner()
+    mine_chain(source, 3)
+    blocks = [miner.without_hash(b) for b in source.blocks]
+    headers = {b["id"]: b["hash"] for b in source.blocks}
+
+    def checkpoint(node):
+        node.use_snapshot(source.snapshot())
+        return node.apply_trusted_snapshot(blocks)
+
+    # Headers we were never sent don't vouch for the blocks.
+    node = make_miner()
+    assert checkpoint(node) == blocks and not node.blocks
+
+    # Nor do blocks with too little work behind them.
+    node = make_miner()
+    node.snapshot_headers = headers
+    node._difficulty = 64
+    assert checkpoint(node) == blocks and not node.blocks
+
+    node = make_miner()
+    node.snapshot_headers = headers
+    assert checkpoint(node) == []
+    assert node.balances() == source.balances()
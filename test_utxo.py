@@ -0,0 +1,70 @@
+from utxo import UnspentTransaction, UtxoSet, UtxoView
+
+
+def test_balances_follow_adds_and_spends():
+    utxos = UtxoSet([UnspentTransaction("a", 5, b"alice")])
+    utxos["b"] = ("b", 7, b"alice")
+    utxos["c"] = ("c", 3, b"bob")
+    assert utxos.balances() == {b"alice": 12, b"bob": 3}
+
+    del utxos["a"]
+    assert utxos.balance(b"alice") == 7
+    assert utxos.pop("c") == UnspentTransaction("c", 3, b"bob")
+    assert utxos.balances() == {b"alice": 7}
+    assert utxos.balance(b"bob") == 0
+
+
+def test_outputs_by_address():
+    utxos = UtxoSet()
+    utxos["a"] = ("a", 5, b"alice")
+    utxos["b"] = ("b", 7, b"bob")
+    assert list(utxos.outputs(b"alice")) == [UnspentTransaction("a", 5, b"alice")]
+    assert list(utxos.outputs(b"carol")) == []
+
+
+def test_overwriting_an_output_moves_it():
+    utxos = UtxoSet()
+    utxos["a"] = ("a", 5, b"alice")
+    utxos["a"] = ("a", 2, b"bob")
+    assert utxos.balances() == {b"bob": 2}
+    assert len(utxos) == 1
+
+
+def make_block(mine, *transactions):
+    return {"mine": mine, "transactions": transactions}
+
+
+def test_undo_reverses_apply_block():
+    utxos = UtxoSet([UnspentTransaction("a", 5, b"alice")])
+    before = dict(utxos)
+    block = make_block(
+        ("reward", 1000, b"miner"),
+        {"inputs": ("a",), "outputs": [("b", 5, b"bob")]},
+        # Spends an output created earlier in the same block.
+        {"inputs": ("b",), "outputs": [("c", 5, b"carol")]},
+    )
+
+    undo = utxos.apply_block(block)
+    assert set(utxos) == {"reward", "c"}
+
+    utxos.undo(undo)
+    assert dict(utxos) == before
+    assert utxos.balances() == {b"alice": 5}
+
+
+def test_undo_keeps_outputs_which_existed_before_the_block():
+    utxos = UtxoSet([UnspentTransaction("b", 5, b"bob")])
+    undo = utxos.apply_block(
+        make_block((), {"inputs": (), "outputs": [("b", 5, b"bob")]})
+    )
+    utxos.undo(undo)
+    assert dict(utxos) == {"b": UnspentTransaction("b", 5, b"bob")}
+
+
+def test_view_follows_spends_without_changing_the_set():
+    utxos = UtxoSet([UnspentTransaction("a", 5, b"alice")])
+    view = UtxoView(utxos)
+    view.apply_transaction({"inputs": ("a",), "outputs": [("b", 5, b"bob")]})
+    assert view.get("a") is None
+    assert view.get("b") == UnspentTransaction("b", 5, b"bob")
+    assert "a" in utxos and "b" not in utxos
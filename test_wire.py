@@ -0,0 +1,54 @@
+import pytest
+
+import wire
+from bench_wire import make_chain
+from gossip import dumps, loads
+from signing import generate_keypair, sign_transaction, signature_cache
+from signing import verify_transaction
+
+
+def test_round_trip_known_kinds():
+    for message in (
+        {"block": make_chain(1)[0]},
+        {"peers": ["ws://0.0.0.0:1234"]},
+        {"ping": True},
+    ):
+        frame = wire.encode(message)
+        assert frame[3] != wire.GENERIC
+        assert wire.decode(frame) == message
+
+
+def test_round_trip_generic():
+    message = {"request_blockchain": True, "since": None}
+    frame = wire.encode(message)
+    assert frame[3] == wire.GENERIC
+    assert wire.decode(frame) == message
+
+
+def test_newer_versions_are_rejected():
+    frame = bytearray(wire.encode({"ping": True}))
+    frame[2] = wire.WIRE_VERSION + 1
+    with pytest.raises(ValueError):
+        wire.decode(bytes(frame))
+
+
+def test_old_peers_get_pyon():
+    message = {"blocks": make_chain(2)}
+    assert dumps(message) == repr(message)
+    assert isinstance(dumps(message, wire.WIRE_VERSION), bytes)
+    for version in (wire.PYON_VERSION, wire.WIRE_VERSION):
+        assert loads(dumps(message, version)) == message
+
+
+def test_signatures_survive_the_round_trip():
+    key, address = generate_keypair(seed=bytes(32))
+    transaction = sign_transaction(
+        {"inputs": ("x",), "outputs": [("y", 5, address)], "from": address}, key
+    )
+    decoded = wire.decode(wire.encode({"transaction": transaction}))["transaction"]
+    assert list(decoded) != list(transaction)
+
+    signature_cache.clear()
+    assert verify_transaction(decoded)
+    assert verify_transaction(loads(dumps({"transaction": decoded}))["transaction"])
+    assert not verify_transaction({**decoded, "outputs": [("y", 6, address)]})
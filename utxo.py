@@ -0,0 +1,146 @@
+from collections import namedtuple
+from collections.abc import MutableMapping
+
+UnspentTransaction = namedtuple("UnspentTransaction", "id amount address")
+
+
+class UtxoSet(MutableMapping):
+    """
+    Unspent transaction outputs by ID, with a secondary index from each
+    address to its outputs and a running balance per address. Behaves
+    like the plain dict it replaces, so outputs can still be set and
+    deleted by ID.
+    """
+
+    def __init__(self, outputs=()):
+        self._outputs = {}
+        self._by_address = {}
+        self._balances = {}
+        for output in outputs:
+            self.add(output)
+
+    def __getitem__(self, output_id):
+        return self._outputs[output_id]
+
+    def __setitem__(self, output_id, output):
+        output = UnspentTransaction(*output)
+        if output_id in self._outputs:
+            del self[output_id]
+        self._outputs[output_id] = output
+        self._by_address.setdefault(output.address, {})[output_id] = output
+        self._balances[output.address] = self.balance(output.address) + output.amount
+
+    def __delitem__(self, output_id):
+        output = self._outputs.pop(output_id)
+        address_outputs = self._by_address[output.address]
+        del address_outputs[output_id]
+        self._balances[output.address] -= output.amount
+        if not address_outputs:
+            del self._by_address[output.address]
+            del self._balances[output.address]
+
+    def __contains__(self, output_id):
+        return output_id in self._outputs
+
+    def __iter__(self):
+        return iter(self._outputs)
+
+    def __len__(self):
+        return len(self._outputs)
+
+    def __repr__(self):
+        return repr(self._outputs)
+
+    def keys(self):
+        return self._outputs.keys()
+
+    def values(self):
+        return self._outputs.values()
+
+    def items(self):
+        return self._outputs.items()
+
+    def add(self, output):
+        self[output[0]] = output
+
+    def outputs(self, address):
+        """Every unspent output belonging to one address."""
+        return self._by_address.get(address, {}).values()
+
+    def balance(self, address):
+        return self._balances.get(address, 0)
+
+    def balances(self):
+        return dict(self._balances)
+
+    def apply_block(self, block):
+        """
+        Spend a block's inputs and add its outputs. Return undo data: the
+        outputs the block spent or replaced, and the IDs of those it created.
+        """
+        spent = {}
+        created = set()
+
+        def remove(output_id):
+            output = self._outputs.get(output_id)
+            if output is None:
+                return
+            if output_id in created:
+                created.discard(output_id)
+            elif output_id not in spent:
+                spent[output_id] = output
+            del self[output_id]
+
+        def add(output):
+            output = UnspentTransaction(*output)
+            remove(output.id)
+            created.add(output.id)
+            self[output.id] = output
+
+        if block["mine"]:
+            add(block["mine"])
+        for transaction in block["transactions"]:
+            for transaction_input in transaction["inputs"]:
+                remove(transaction_input)
+            for output in transaction["outputs"]:
+                add(output)
+        return tuple(spent.values()), tuple(created)
+
+    def undo(self, undo_data):
+        """Reverse apply_block, given the undo data it returned."""
+        spent, created = undo_data
+        for output_id in created:
+            self.pop(output_id, None)
+        for output in spent:
+            self.add(output)
+
+    def snapshot(self):
+        """Every unspent output as plain tuples, ready to be encoded."""
+        return tuple(tuple(output) for output in self._outputs.values())
+
+
+class UtxoView:
+    """
+    How a set of unspent outputs would look after some spends, without
+    changing it, so a block's transactions can be checked in order.
+    """
+
+    def __init__(self, unspent):
+        self.unspent = unspent
+        self.created = {}
+        self.spent = set()
+
+    def get(self, output_id, default=None):
+        if output_id in self.created:
+            return self.created[output_id]
+        if output_id in self.spent:
+            return default
+        return self.unspent.get(output_id, default)
+
+    def apply_transaction(self, transaction):
+        for transaction_input in transaction["inputs"]:
+            self.created.pop(transaction_input, None)
+            self.spent.add(transaction_input)
+        for output in transaction["outputs"]:
+            output = UnspentTransaction(*output)
+            self.created[output.id] = output
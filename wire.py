@@ -0,0 +1,53 @@
+"""
+Binary framing for gossip messages, replacing PyON (repr() and
+ast.literal_eval()) between nodes which both understand it.
+
+A frame is MAGIC, the wire version, a byte saying what kind of message it
+is, and then the codec encoding of the message. Messages with a single
+well-known key, like {"block": ...}, only encode the value under that key.
+"""
+
+import codec
+
+MAGIC = b"BC"
+WIRE_VERSION = 1
+
+# Peers which never told us their wire version only speak PyON.
+PYON_VERSION = 0
+
+GENERIC = 0
+KINDS = {
+    "block": 1,
+    "transaction": 2,
+    "peers": 3,
+    "peer": 4,
+    "ping": 5,
+    "pong": 6,
+    "blocks": 7,
+    "compact_block": 8,
+}
+KEYS = {kind: key for key, kind in KINDS.items()}
+
+HEADER_SIZE = len(MAGIC) + 2
+
+
+def encode(message):
+    """Frame a message dict as bytes."""
+    if len(message) == 1:
+        [(key, value)] = message.items()
+        if key in KINDS:
+            return MAGIC + bytes([WIRE_VERSION, KINDS[key]]) + codec.encode(value)
+    return MAGIC + bytes([WIRE_VERSION, GENERIC]) + codec.encode(message)
+
+
+def decode(frame):
+    """Turn a frame made by `encode` back into a message dict."""
+    if frame[: len(MAGIC)] != MAGIC:
+        raise ValueError("Not a wire frame")
+    version, kind = frame[len(MAGIC)], frame[len(MAGIC) + 1]
+    if version > WIRE_VERSION:
+        raise ValueError(f"Unsupported wire version {version}")
+    value = codec.decode(memoryview(frame)[HEADER_SIZE:])
+    if kind == GENERIC:
+        return value
+    return {KEYS[kind]: value}